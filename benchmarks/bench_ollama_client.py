@@ -0,0 +1,121 @@
+"""Benchmark STONE's Ollama clients against the in-process fake server.
+
+Compares a fresh requests.post per chat turn (the old behaviour) with the
+pooled OllamaClient, then measures concurrent streaming throughput with the
+thread-per-stream client and the asyncio client.
+
+    python benchmarks/bench_ollama_client.py --calls 200 --streams 32 --json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STONE_CONTEXT_DB", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+import requests  # noqa: E402
+
+from benchmarks.fake_ollama import FakeOllama  # noqa: E402
+from benchmarks.stats import summarize  # noqa: E402
+from stone import AsyncOllamaClient, OllamaClient, aiohttp  # noqa: E402
+
+PAYLOAD = {"model": "fake-llama:latest", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+
+
+def consume(response):
+    return sum(1 for _ in OllamaClient.iter_chunks(response))
+
+
+def bench_fresh_connections(url, calls):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        with requests.post(f"{url}/api/chat", json=PAYLOAD, stream=True, timeout=30) as response:
+            consume(response)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_pooled(url, calls):
+    client = OllamaClient(url)
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        with client.chat(PAYLOAD) as response:
+            consume(response)
+        latencies.append(time.perf_counter() - start)
+    client.close()
+    return latencies
+
+
+def bench_threaded_streams(url, streams):
+    client = OllamaClient(url, pool_size=streams)
+
+    def one():
+        with client.chat(PAYLOAD) as response:
+            return consume(response)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(streams) as pool:
+        chunks = sum(pool.map(lambda _: one(), range(streams)))
+    elapsed = time.perf_counter() - start
+    client.close()
+    return chunks / elapsed
+
+
+async def bench_async_streams(url, streams):
+    client = AsyncOllamaClient(url, pool_size=streams)
+
+    async def one():
+        return sum([1 async for _ in client.chat_stream(PAYLOAD)])
+
+    start = time.perf_counter()
+    chunks = sum(await asyncio.gather(*(one() for _ in range(streams))))
+    elapsed = time.perf_counter() - start
+    await client.close()
+    return chunks / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200, help="sequential short chats per client")
+    parser.add_argument("--tokens", type=int, default=8, help="tokens per sequential chat")
+    parser.add_argument("--streams", type=int, default=32, help="concurrent streams")
+    parser.add_argument("--rate", type=float, default=100.0, help="tokens/s per concurrent stream")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = {}
+    with FakeOllama(tokens_per_second=0, response_tokens=args.tokens) as fake:
+        before = fake.connections
+        results["fresh_connection"] = summarize(bench_fresh_connections(fake.url, args.calls))
+        results["fresh_connection"]["connections"] = fake.connections - before
+        before = fake.connections
+        results["pooled_client"] = summarize(bench_pooled(fake.url, args.calls))
+        results["pooled_client"]["connections"] = fake.connections - before
+
+    with FakeOllama(tokens_per_second=args.rate, response_tokens=64) as fake:
+        results["threaded_streams_chunks_per_s"] = bench_threaded_streams(fake.url, args.streams)
+        if aiohttp is not None:
+            results["async_streams_chunks_per_s"] = asyncio.run(bench_async_streams(fake.url, args.streams))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name in ("fresh_connection", "pooled_client"):
+        r = results[name]
+        print(f"{name:<18} mean {r['mean_ms']:.2f} ms  p50 {r['p50_ms']:.2f} ms  "
+              f"p95 {r['p95_ms']:.2f} ms  connections {r['connections']}")
+    print(f"{args.streams} threaded streams: {results['threaded_streams_chunks_per_s']:.0f} chunks/s")
+    if "async_streams_chunks_per_s" in results:
+        print(f"{args.streams} async streams:    {results['async_streams_chunks_per_s']:.0f} chunks/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Benchmark the python tool: a fresh interpreter per call vs the sandbox pool.
+
+Runs the same snippets through run_python_subprocess (the old path, one
+`python -c` per call) and through SandboxPool's pre-started workers, and
+reports per-call latency.
+
+    python benchmarks/bench_python_tool.py --calls 50 --json
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STONE_CONTEXT_DB", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+from benchmarks.stats import summarize  # noqa: E402
+from stone import SandboxPool, run_python_subprocess  # noqa: E402
+
+SNIPPETS = {
+    "print": "print('hello world')",
+    "stdlib": "import statistics, json\nprint(json.dumps(statistics.mean(range(10000))))",
+    "loop": "print(sum(i * i for i in range(200000)))",
+}
+
+
+def timed(func, code, calls):
+    latencies = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        func(code)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--calls", type=int, default=50, help="calls per snippet and path")
+    parser.add_argument("--workers", type=int, default=2, help="sandbox pool size")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    pool = SandboxPool(size=args.workers)
+    pool.start()
+    pool.run("pass")  # Wait until a worker has finished its imports
+    results = {}
+    try:
+        for name, code in SNIPPETS.items():
+            results[name] = {
+                "subprocess": summarize(timed(run_python_subprocess, code, args.calls)),
+                "sandbox_pool": summarize(timed(pool.run, code, args.calls)),
+            }
+        results["pool"] = pool.stats()
+    finally:
+        pool.stop()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name in SNIPPETS:
+        for path in ("subprocess", "sandbox_pool"):
+            r = results[name][path]
+            print(f"{name:<8} {path:<13} mean {r['mean_ms']:7.2f} ms  p50 {r['p50_ms']:7.2f} ms  "
+                  f"p95 {r['p95_ms']:7.2f} ms")
+    print(f"pool: {results['pool']['runs']} runs, {results['pool']['recycled']} workers recycled")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""Benchmark RAGMemory storage and retrieval at increasing corpus sizes.
+
+For each size a deterministic synthetic corpus is generated: sessions,
+memories whose background words follow a Zipf distribution plus a few terms
+from one of many topics, and knowledge-base topics.  Each size runs in two
+fresh processes against its own database:
+
+    build   store_memory / store_knowledge throughput, through write-behind
+    query   startup (import + index load), index rebuild time and the
+            RSS it adds per memory, search latency per mode, get_knowledge latency and
+            recall@k against a labelled query set
+
+A query is two topic terms taken from a sampled memory, optionally scoped
+to that memory's session; its relevant set is every memory in scope with the
+same topic holding both terms, so recall@k is exact.
+
+    python benchmarks/bench_retrieval.py --sizes 10000 100000 --json
+    python benchmarks/bench_retrieval.py --sizes 1000000 --queries 500 --output retrieval.json
+    python benchmarks/bench_retrieval.py --sizes 200000 --ivf-probes 16 64 256   # IVF recall check
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.stats import summarize  # noqa: E402
+
+CONSONANTS = "bcdfghklmnprstvz"
+VOWELS = "aeiou"
+MODES = ("keyword", "vector", "hybrid")
+
+
+def rss_bytes():
+    """Current resident set size, or 0 where /proc is unavailable"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+class Corpus:
+    """Deterministic synthetic memories, sessions and knowledge topics.
+
+    Background words are drawn from a Zipf(s) distribution over `vocabulary`
+    pronounceable words; each memory also carries `topic_terms` of the 12
+    key terms of one of `topics` topics, which is what queries look for.
+    """
+
+    TERMS_PER_TOPIC = 12
+
+    def __init__(self, size, seed=0, vocabulary=20000, topics=None, words=14, topic_terms=3,
+                 memories_per_session=40, zipf=1.1, stop_words=frozenset()):
+        self.size = size
+        self.seed = seed
+        self.words = words
+        self.topic_terms = topic_terms
+        self.sessions = max(1, size // memories_per_session)
+        self.topics = topics or max(50, size // 200)
+        rng = random.Random(seed)
+        pool = self._words(rng, vocabulary + self.topics * self.TERMS_PER_TOPIC, stop_words)
+        self.vocabulary = pool[:vocabulary]
+        self.topic_words = [pool[vocabulary + t * self.TERMS_PER_TOPIC:vocabulary + (t + 1) * self.TERMS_PER_TOPIC]
+                            for t in range(self.topics)]
+        self.cum_weights = list(itertools.accumulate(1 / rank ** zipf for rank in range(1, vocabulary + 1)))
+
+    @staticmethod
+    def _words(rng, count, stop_words):
+        seen = set()
+        words = []
+        while len(words) < count:
+            word = "".join(rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(rng.randint(2, 4)))
+            if word not in seen and word not in stop_words:
+                seen.add(word)
+                words.append(word)
+        return words
+
+    def memories(self):
+        """Yield (index, session_id, topic, topic terms, content) for every memory"""
+        rng = random.Random(self.seed + 1)
+        for i in range(self.size):
+            topic = rng.randrange(self.topics)
+            terms = rng.sample(self.topic_words[topic], self.topic_terms)
+            words = rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=self.words) + terms
+            rng.shuffle(words)
+            yield i, f"session-{rng.randrange(self.sessions)}", topic, terms, " ".join(words)
+
+    def knowledge(self):
+        """Yield (topic, content) knowledge-base entries, one per topic"""
+        for topic, terms in enumerate(self.topic_words):
+            yield f"topic-{topic}-{terms[0]}", " ".join(terms)
+
+    def queries(self, count, scoped_share=0.5):
+        """Labelled queries: [{query, session_id, relevant contents}]"""
+        rng = random.Random(self.seed + 2)
+        picks = sorted(rng.sample(range(self.size), min(count, self.size)))
+        specs = {}
+        for i in picks:
+            specs[i] = rng.random() < scoped_share
+        chosen = {}
+        for i, session_id, topic, terms, content in self.memories():
+            if i in specs:
+                pair = tuple(rng.sample(terms, 2))
+                chosen[i] = {"query": " ".join(pair), "pair": pair, "topic": topic,
+                             "session_id": session_id if specs[i] else None, "relevant": []}
+        by_topic = {}
+        for spec in chosen.values():
+            by_topic.setdefault(spec["topic"], []).append(spec)
+        for i, session_id, topic, terms, content in self.memories():
+            for spec in by_topic.get(topic, ()):
+                if (set(spec["pair"]) <= set(terms)
+                        and spec["session_id"] in (None, session_id)):
+                    spec["relevant"].append(content)
+        return [{k: v for k, v in spec.items() if k not in ("pair", "topic")} for spec in chosen.values()]
+
+
+def build(args):
+    """Child process: store the corpus and return insert throughput"""
+    import stone
+
+    corpus = Corpus(args.size, args.seed, stop_words=stone.STOP_WORDS)
+    memories = corpus.memories()
+    memory_seconds = 0.0
+    while chunk := list(itertools.islice(memories, 10000)):
+        # Generate outside the timed region so only storage is measured
+        start = time.perf_counter()
+        for i, session_id, topic, terms, content in chunk:
+            stone.rag_memory.store_memory(session_id, content, importance=1 + i % 5)
+        memory_seconds += time.perf_counter() - start
+    start = time.perf_counter()
+    while stone.write_behind.stats()["queue_depth"]:
+        stone.write_behind.drain()
+    memory_seconds += time.perf_counter() - start
+
+    start = time.perf_counter()
+    topics = 0
+    for topic, content in corpus.knowledge():
+        stone.rag_memory.store_knowledge(topic, content, source="benchmark")
+        topics += 1
+    stone.write_behind.drain()
+    knowledge_seconds = time.perf_counter() - start
+
+    with open(args.queries_file, "w") as f:
+        json.dump(corpus.queries(args.queries), f)
+    stone.write_behind.stop()
+    if stone.rag_memory.vectors is not None:
+        stone.rag_memory.vectors.flush()
+    return {
+        "memories": args.size,
+        "sessions": corpus.sessions,
+        "topics": corpus.topics,
+        "store_memory_per_second": args.size / memory_seconds,
+        "store_knowledge_per_second": topics / knowledge_seconds,
+        "db_bytes": sum(os.path.getsize(stone.CONTEXT_DB + s) for s in ("", "-wal")
+                        if os.path.exists(stone.CONTEXT_DB + s)),
+    }
+
+
+def measure_search(memory, queries, mode, k):
+    latencies = []
+    recalls = []
+    for spec in queries:
+        start = time.perf_counter()
+        hits = memory.search_memory(spec["query"], spec["session_id"], limit=k, mode=mode)
+        latencies.append(time.perf_counter() - start)
+        relevant = set(spec["relevant"])
+        found = sum(1 for hit in hits if hit["content"] in relevant)
+        recalls.append(found / min(k, len(relevant)))
+    return dict(summarize(latencies), **{f"recall_at_{k}": statistics.fmean(recalls)})
+
+
+def query(args):
+    """Child process: startup, index build, memory, search latency and recall"""
+    start = time.perf_counter()
+    import stone
+    startup = time.perf_counter() - start
+
+    # A second RAGMemory over the same rows isolates the indexes' own memory
+    baseline = rss_bytes()
+    start = time.perf_counter()
+    rebuilt = stone.RAGMemory()
+    index_build = time.perf_counter() - start
+    index_rss = rss_bytes() - baseline
+    del rebuilt
+
+    with open(args.queries_file) as f:
+        queries = json.load(f)
+    memory = stone.rag_memory
+    modes = MODES if memory.vectors is not None else ("keyword",)
+    results = {mode: measure_search(memory, queries, mode, args.k) for mode in modes}
+
+    # The IVF quantizer is opt-in (VECTOR_IVF_MIN_ROWS); train it here to see what it costs in recall
+    ivf, ivf_train = {}, None
+    if args.ivf_probes and memory.vectors is not None:
+        start = time.perf_counter()
+        memory.vectors.train_ivf()
+        ivf_train = time.perf_counter() - start
+        for probes in args.ivf_probes:
+            memory.vectors.ivf_probes = probes
+            ivf[probes] = {mode: measure_search(memory, queries, mode, args.k) for mode in ("vector", "hybrid")}
+
+    topics = [row[0] for row in stone.db.query("SELECT topic FROM knowledge_base")]
+    rng = random.Random(args.seed)
+    lookups = [rng.choice(topics) for _ in range(len(queries))]
+    latencies = []
+    for i, topic in enumerate(lookups):
+        # Alternate whole topic names with inner substrings
+        needle = topic if i % 2 == 0 else topic.split("-", 2)[2]
+        start = time.perf_counter()
+        stone.rag_memory.get_knowledge(needle)
+        latencies.append(time.perf_counter() - start)
+
+    index = memory.index.stats()
+    return {
+        "startup_s": startup,
+        "index_build_s": index_build,
+        "rss_mb_after_startup": baseline / 2**20 if baseline else None,
+        "rss_bytes_per_memory": index_rss / args.size if baseline else None,
+        "keyword_index_bytes_per_memory": index["approx_bytes"] / args.size,
+        "vector_bytes_per_memory": (memory.vectors.stats()["bytes_on_disk"] / args.size
+                                    if memory.vectors is not None else None),
+        "ivf_lists": memory.vectors.stats()["ivf_lists"] if memory.vectors is not None else None,
+        "search": results,
+        "ivf_train_s": ivf_train,
+        "ivf_search": ivf,
+        "get_knowledge": summarize(latencies),
+    }
+
+
+def run_child(phase, size, workdir, args):
+    env = dict(os.environ, STONE_CONTEXT_DB=os.path.join(workdir, f"retrieval-{size}.db"))
+    command = [sys.executable, os.path.abspath(__file__), "--phase", phase, "--size", str(size),
+               "--seed", str(args.seed), "--queries", str(args.queries), "-k", str(args.k),
+               "--queries-file", os.path.join(workdir, f"queries-{size}.json"),
+               "--ivf-probes", *map(str, args.ivf_probes)]
+    out = subprocess.run(command, env=env, capture_output=True, text=True, cwd=ROOT)
+    if out.returncode:
+        raise RuntimeError(f"{phase} phase for {size} memories failed:\n{out.stderr}")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def print_report(results, k):
+    for r in results:
+        print(f"{r['memories']:>9,} memories  {r['sessions']:,} sessions  {r['topics']:,} topics  "
+              f"db {r['db_bytes'] / 2**20:.1f} MB")
+        print(f"    store_memory {r['store_memory_per_second']:,.0f}/s  "
+              f"store_knowledge {r['store_knowledge_per_second']:,.0f}/s")
+        rss = r["rss_bytes_per_memory"]
+        print(f"    startup {r['startup_s']:.2f}s  index build {r['index_build_s']:.2f}s  "
+              f"RSS {'n/a' if rss is None else f'{rss:,.0f} B'}/memory  "
+              f"keyword index {r['keyword_index_bytes_per_memory']:,.0f} B/memory  "
+              f"IVF lists {r['ivf_lists'] or 0}")
+        for mode, s in r["search"].items():
+            print(f"    search {mode:<8} p50 {s['p50_ms']:7.2f} ms  p95 {s['p95_ms']:7.2f} ms  "
+                  f"p99 {s['p99_ms']:7.2f} ms  recall@{k} {s[f'recall_at_{k}']:.3f}")
+        for probes, searches in r["ivf_search"].items():
+            for mode, s in searches.items():
+                print(f"    IVF {probes:>4} probes {mode:<6} p50 {s['p50_ms']:7.2f} ms  p95 {s['p95_ms']:7.2f} ms  "
+                      f"p99 {s['p99_ms']:7.2f} ms  recall@{k} {s[f'recall_at_{k}']:.3f}")
+        g = r["get_knowledge"]
+        print(f"    get_knowledge   p50 {g['p50_ms']:7.2f} ms  p95 {g['p95_ms']:7.2f} ms  p99 {g['p99_ms']:7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="corpus sizes")
+    parser.add_argument("--queries", type=int, default=200, help="labelled queries per size")
+    parser.add_argument("-k", type=int, default=5, help="results per search (recall@k)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ivf-probes", type=int, nargs="*", default=[],
+                        help="also train the opt-in IVF quantizer and search with these probe counts")
+    parser.add_argument("--workdir", help="keep databases here instead of a temporary directory")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    parser.add_argument("--phase", choices=("build", "query"), help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--queries-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.phase:
+        print(json.dumps((build if args.phase == "build" else query)(args)))
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="stone-retrieval-")
+    results = []
+    for size in args.sizes:
+        result = run_child("build", size, workdir, args)
+        result.update(run_child("query", size, workdir, args))
+        results.append(result)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_report(results, args.k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""Benchmark tool dispatch cost as the number of registered tools grows.
+
+Compares the old dispatcher (lowercase the message, then re.search each
+tool's pattern in turn) with ToolRegistry's single combined alternation, for
+a message that matches no tool (the common case) and one that matches the
+last registered tool.
+
+    python benchmarks/bench_tool_dispatch.py --tools 5 50 200 500 --json
+"""
+
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("STONE_CONTEXT_DB", os.path.join(tempfile.mkdtemp(), "bench.db"))
+
+from stone import ToolRegistry  # noqa: E402
+
+MISS = "Can you explain how transformers handle long context windows in practice?"
+
+
+def build(count):
+    registry = ToolRegistry()
+    for i in range(count):
+        registry.register(f"tool{i}", rf"verb{i}\s+(?:with\s+)?(.+)", f"Synthetic tool {i}")(lambda arg: arg)
+    return registry
+
+
+def sequential_dispatch(tools, message):
+    message_lower = message.lower().strip()
+    for name, tool in tools.items():
+        match = re.search(tool["pattern"], message_lower)
+        if match:
+            return name, match.group(1).strip()
+    return None, None
+
+
+def time_per_call(func, number):
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tools", type=int, nargs="+", default=[5, 50, 200, 500], help="registry sizes")
+    parser.add_argument("--number", type=int, default=2000, help="dispatches per timing run")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = []
+    for count in args.tools:
+        registry = build(count)
+        hit = f"please Verb{count - 1} with Some Argument"
+        assert registry.dispatch(hit) == (f"tool{count - 1}", "Some Argument")
+        assert sequential_dispatch(registry.tools, hit)[0] == f"tool{count - 1}"
+        registry.dispatch(MISS)  # Compile outside the timed loop
+        results.append({
+            "tools": count,
+            "sequential_miss_us": time_per_call(lambda: sequential_dispatch(registry.tools, MISS), args.number),
+            "combined_miss_us": time_per_call(lambda: registry.dispatch(MISS), args.number),
+            "sequential_hit_us": time_per_call(lambda: sequential_dispatch(registry.tools, hit), args.number),
+            "combined_hit_us": time_per_call(lambda: registry.dispatch(hit), args.number),
+        })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'tools':>6} {'seq miss':>10} {'comb miss':>10} {'seq hit':>10} {'comb hit':>10}  (us/message)")
+    for r in results:
+        print(f"{r['tools']:>6} {r['sequential_miss_us']:>10.2f} {r['combined_miss_us']:>10.2f} "
+              f"{r['sequential_hit_us']:>10.2f} {r['combined_hit_us']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
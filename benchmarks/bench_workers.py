@@ -0,0 +1,243 @@
+"""Multi-worker scaling: the loadtest mix against 1, 2, 4... stone.py workers.
+
+For each worker count, starts that many stone.py processes sharing one
+throwaway database, each with its own STONE_WORKER_ID, the Socket.IO
+message queue pointed at an in-process FakeRedis, and the maintenance task
+enabled on the first worker only.  Clients are pinned to worker
+i % workers, standing in for a sticky load balancer.
+
+After the load phase a probe checks cross-worker consistency: it reads a
+session's context on the last worker (so it is cached there), saves a
+"remember ..." message through the first worker, and times until the last
+worker returns the new memory from search and the new turn from its
+context cache.
+
+    python benchmarks/bench_workers.py --workers 1,2,4 --clients 24 --duration 20
+    python benchmarks/bench_workers.py --server-mode async --output workers.json
+
+FakeOllama, FakeRedis and all clients share this process, so on small
+machines the harness itself can become the ceiling; compare the per-worker
+CPU figures before reading a flat curve as a server limit.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_ollama import FakeOllama  # noqa: E402
+from benchmarks.fake_redis import FakeRedis  # noqa: E402
+from benchmarks.loadtest import (  # noqa: E402
+    OPERATIONS, LoadClient, ProcessMonitor, git_commit, parse_mix, start_server)
+from benchmarks.stats import summarize  # noqa: E402
+
+
+def parse_counts(text):
+    counts = [int(part) for part in text.split(",") if part.strip()]
+    if not counts or min(counts) < 1:
+        raise argparse.ArgumentTypeError("expected comma-separated worker counts, e.g. 1,2,4")
+    return counts
+
+
+def start_workers(count, fake_ollama, fake_redis, workdir, server_mode):
+    """Start `count` workers one after another so only the first runs migrations"""
+    workers = []
+    try:
+        for i in range(count):
+            env = {"STONE_WORKER_ID": f"w{i}", "STONE_MESSAGE_QUEUE": fake_redis.url,
+                   "STONE_MAINTENANCE": "1" if i == 0 else "0", "STONE_SERVER_MODE": server_mode}
+            workers.append(start_server(fake_ollama.url, workdir, env=env, log_name=f"worker-{i}.log"))
+    except Exception:
+        stop_workers(workers)
+        raise
+    return workers
+
+
+def stop_workers(workers):
+    for proc, _ in workers:
+        proc.terminate()
+    for proc, _ in workers:
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def probe_visibility(writer, reader, timeout=10.0):
+    """Milliseconds until a memory and a context turn saved on `writer` are visible on `reader`"""
+    session_id = f"probe-{time.monotonic_ns()}"
+    token = f"zq{time.monotonic_ns() % 10**8}"
+    message = f"Remember that the probe word is {token}"
+    requests.get(reader + "/api/context", params={"session_id": session_id}, timeout=10)
+    start = time.perf_counter()
+    requests.post(writer + "/api/save_context", timeout=10, json={
+        "session_id": session_id, "role": "user", "message": message}).raise_for_status()
+    lag = {"memory_ms": None, "context_ms": None}
+    while time.perf_counter() - start < timeout and None in lag.values():
+        elapsed = (time.perf_counter() - start) * 1000
+        if lag["memory_ms"] is None:
+            memories = requests.get(reader + "/api/memory/search", timeout=10, params={
+                "query": token, "session_id": session_id, "mode": "keyword"}).json()["memories"]
+            if any(token in m["content"] for m in memories):
+                lag["memory_ms"] = elapsed
+        if lag["context_ms"] is None:
+            turns = requests.get(reader + "/api/context", params={"session_id": session_id},
+                                 timeout=10).json()["messages"]
+            if any(t["message"] == message for t in turns):
+                lag["context_ms"] = elapsed
+        time.sleep(0.01)
+    return lag
+
+
+def run_workers(args, count, fake_redis):
+    workdir = tempfile.mkdtemp(prefix=f"stone-workers-{count}-")
+    fake = FakeOllama(tokens_per_second=args.rate, response_tokens=args.tokens, models=(args.model,),
+                      latency=args.latency, seed=args.seed).start()
+    published, delivered = fake_redis.published, fake_redis.delivered
+    workers = []
+    try:
+        workers = start_workers(count, fake, fake_redis, workdir, args.server_mode)
+        urls = [url for _, url in workers]
+        monitors = [ProcessMonitor(proc.pid).start() for proc, _ in workers]
+        start = time.monotonic()
+        deadline = start + args.ramp + args.duration
+        clients = [LoadClient(i, urls[i % count], args.model, args.mix, deadline, args.seed * 1000 + i,
+                              args.chat_timeout) for i in range(args.clients)]
+        threads = []
+        for client in clients:
+            threads.append(threading.Thread(target=client.run, daemon=True))
+            threads[-1].start()
+            if args.ramp:
+                time.sleep(args.ramp / args.clients)
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        servers = [monitor.stop() for monitor in monitors]
+        visibility = probe_visibility(urls[0], urls[-1])
+        feeds = [requests.get(url + "/api/stats", timeout=10).json().get("change_feed") for url in urls]
+    finally:
+        stop_workers(workers)
+        fake.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    operations = {}
+    for op in OPERATIONS:
+        operations[op] = summarize([lat for c in clients for lat in c.latencies[op]])
+        operations[op]["errors"] = sum(c.failed[op] for c in clients)
+    completed = sum(o["count"] for o in operations.values())
+    servers = [s for s in servers if s]
+    return {
+        "workers": count,
+        "throughput": {
+            "elapsed_s": elapsed,
+            "ops_per_second": completed / elapsed,
+            "chats_per_second": operations["chat"]["count"] / elapsed,
+        },
+        "operations": operations,
+        "time_to_first_token": summarize([t for c in clients for t in c.ttft]),
+        "errors": dict(sum((c.errors for c in clients), Counter()).most_common()),
+        "servers": {
+            "cpu_percent": sum(s["cpu_percent"] for s in servers),
+            "cpu_percent_per_worker": [s["cpu_percent"] for s in servers],
+            "rss_mb_peak": sum(s["rss_mb_peak"] for s in servers),
+        },
+        "visibility": visibility,
+        "change_feed": feeds,
+        "message_queue": {"published": fake_redis.published - published,
+                          "delivered": fake_redis.delivered - delivered},
+    }
+
+
+def run(args):
+    started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    with FakeRedis() as fake_redis:
+        runs = [run_workers(args, count, fake_redis) for count in args.workers]
+    baseline = runs[0]["throughput"]["ops_per_second"]
+    for result in runs:
+        result["throughput"]["speedup"] = result["throughput"]["ops_per_second"] / baseline if baseline else None
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": started_at,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "label": args.label,
+        },
+        "config": {
+            "workers": args.workers, "clients": args.clients, "duration_s": args.duration, "ramp_s": args.ramp,
+            "mix": args.mix, "model": args.model, "seed": args.seed, "server_mode": args.server_mode,
+            "fake_ollama": {"tokens_per_second": args.rate, "tokens": args.tokens, "latency_s": args.latency},
+        },
+        "runs": runs,
+    }
+
+
+def print_report(results):
+    config = results["config"]
+    print(f"{config['clients']} clients for {config['duration_s']:.0f}s per run, mix {config['mix']}, "
+          f"{config['server_mode']} workers")
+    print(f"{'workers':>7} {'ops/s':>8} {'chats/s':>8} {'speedup':>8} {'chat p95':>10} {'ttft p50':>10} "
+          f"{'cpu %':>7} {'rss MB':>8} {'memory':>9} {'context':>9} {'errors':>7}")
+    for r in results["runs"]:
+        chat, ttft, lag = r["operations"]["chat"], r["time_to_first_token"], r["visibility"]
+        lag_ms = lambda value: "never" if value is None else f"{value:.0f} ms"
+        print(f"{r['workers']:>7} {r['throughput']['ops_per_second']:>8.1f} "
+              f"{r['throughput']['chats_per_second']:>8.1f} {r['throughput']['speedup']:>7.2f}x "
+              f"{chat.get('p95_ms', 0):>7.0f} ms {ttft.get('p50_ms', 0):>7.0f} ms "
+              f"{r['servers']['cpu_percent']:>7.0f} {r['servers']['rss_mb_peak']:>8.1f} "
+              f"{lag_ms(lag['memory_ms']):>9} {lag_ms(lag['context_ms']):>9} {sum(r['errors'].values()):>7}")
+    for r in results["runs"]:
+        for error, count in r["errors"].items():
+            print(f"{r['workers']} workers, error x{count}: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=parse_counts, default=parse_counts("1,2,4"),
+                        help="comma-separated worker counts to run, e.g. 1,2,4")
+    parser.add_argument("--clients", type=int, default=24, help="concurrent simulated users per run")
+    parser.add_argument("--duration", type=float, default=15, help="seconds of load after ramp-up")
+    parser.add_argument("--ramp", type=float, default=2, help="seconds over which clients connect")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=6,save=3,search=1"),
+                        help="operation weights, e.g. chat=6,save=3,search=1")
+    parser.add_argument("--model", default="fake-llama:latest")
+    parser.add_argument("--rate", type=float, default=50.0, help="fake tokens per second per stream")
+    parser.add_argument("--tokens", type=int, default=64, help="fake tokens per response")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake seconds before the first token")
+    parser.add_argument("--chat-timeout", type=float, default=120, help="seconds to wait for one chat")
+    parser.add_argument("--server-mode", choices=("threading", "async"), default="threading",
+                        help="STONE_SERVER_MODE for every worker")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--keep", action="store_true", help="keep each run's database and worker logs")
+    parser.add_argument("--label", help="free-form note stored with the results")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""In-process fake Ollama server for tests and benchmarks.
+
+Serves /api/tags and /api/chat, streaming NDJSON token chunks at a
+configurable rate so STONE's Ollama clients can be exercised without a model.
+It speaks HTTP/1.1 with keep-alive and chunked encoding, like Ollama.
+A fixed latency before the first token (prompt evaluation) and a failure
+rate (HTTP 500 responses) can be added to simulate a loaded backend.
+
+    python benchmarks/fake_ollama.py --port 11434 --rate 50 --latency 0.2 --failure-rate 0.01
+
+or in-process:
+
+    with FakeOllama(tokens_per_second=200) as fake:
+        client = OllamaClient(fake.url)
+"""
+
+import argparse
+import json
+import random
+import re
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = ("the quick brown fox jumps over a lazy dog while STONE streams "
+         "tokens from a fake model to every connected client").split()
+
+
+def prompt_tokens(messages):
+    """Rough stand-in for the prompt_eval_count a real tokenizer would report"""
+    return sum(len(re.findall(r"\w+|[^\w\s]", m.get("content", ""))) + 4 for m in messages)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # Go's net/http (and so Ollama) disables Nagle; without this small
+        # chunks stall on delayed ACKs over reused connections
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.fake.lock:
+            self.server.fake.connections += 1
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionResetError:
+            pass  # The client dropped an idle keep-alive connection
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        fake = self.server.fake
+        if self.path == "/api/tags":
+            self._send_json(200, {"models": [{"name": name, "model": name} for name in fake.models]})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        fake = self.server.fake
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if self.path != "/api/chat":
+            self._send_json(404, {"error": "not found"})
+            return
+        with fake.lock:
+            fake.requests += 1
+            failed = fake.random.random() < fake.failure_rate
+            if failed:
+                fake.failures += 1
+        if fake.latency:
+            time.sleep(fake.latency)
+        if failed:
+            self._send_json(500, {"error": "simulated failure"})
+            return
+        model = body.get("model", fake.models[0])
+        tokens = [WORDS[i % len(WORDS)] + " " for i in range(fake.response_tokens)]
+        if not body.get("stream", True):
+            self._send_json(200, fake.chunk(model, "".join(tokens), done=True))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        interval = 1.0 / fake.tokens_per_second if fake.tokens_per_second else 0
+        start = time.perf_counter()
+        try:
+            for i, token in enumerate(tokens):
+                if interval:
+                    delay = start + i * interval - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                self._write_chunk(fake.chunk(model, token))
+            self._write_chunk(fake.chunk(model, "", done=True, eval_count=len(tokens),
+                                         prompt_eval_count=prompt_tokens(body.get("messages", [])),
+                                         eval_duration=int((time.perf_counter() - start) * 1e9),
+                                         total_duration=int((time.perf_counter() - start) * 1e9)))
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            with fake.lock:
+                fake.aborted += 1
+            self.close_connection = True
+
+    def _write_chunk(self, obj):
+        data = json.dumps(obj).encode() + b"\n"
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+
+class FakeOllama:
+    """Threaded fake Ollama HTTP server; use as a context manager or start()/stop()"""
+
+    def __init__(self, host="127.0.0.1", port=0, tokens_per_second=50.0,
+                 response_tokens=64, models=("fake-llama:latest",), latency=0.0, failure_rate=0.0, seed=None):
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.models = list(models)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.aborted = 0
+        self.failures = 0
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def chunk(self, model, content, done=False, **extra):
+        chunk = {
+            "model": model,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "message": {"role": "assistant", "content": content},
+            "done": done,
+        }
+        chunk.update(extra)
+        return chunk
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Ollama server streaming NDJSON tokens")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--rate", type=float, default=50.0, help="tokens per second per stream (0 = unthrottled)")
+    parser.add_argument("--tokens", type=int, default=64, help="tokens per response")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the first token")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of chats answered with HTTP 500")
+    args = parser.parse_args()
+    fake = FakeOllama(args.host, args.port, args.rate, args.tokens,
+                      latency=args.latency, failure_rate=args.failure_rate)
+    print(f"Fake Ollama listening on {fake.url} ({args.rate} tok/s, {args.tokens} tokens/response, "
+          f"{args.latency}s latency, {args.failure_rate:.0%} failures)")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
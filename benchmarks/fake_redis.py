@@ -0,0 +1,218 @@
+"""In-process Redis stand-in speaking enough RESP for Socket.IO message queues.
+
+Implements HELLO, PING, ECHO, SELECT, CLIENT, INFO, QUIT, PUBLISH, SUBSCRIBE
+and UNSUBSCRIBE over RESP2 and RESP3 (redis-py 8 negotiates RESP3 by
+default), which is what python-socketio's RedisManager and AsyncRedisManager
+use, so multi-worker setups can be tested without a Redis server.  Nothing
+is stored; it is a pub/sub hub only.
+
+    python benchmarks/fake_redis.py --port 6379
+
+or in-process:
+
+    with FakeRedis() as fake:
+        os.environ["STONE_MESSAGE_QUEUE"] = fake.url
+"""
+
+import argparse
+import socketserver
+import threading
+
+
+def encode(value, kind=b"*"):
+    """RESP encoding of str/bytes (bulk), int, None (nil bulk), dicts and lists
+
+    `kind` selects the aggregate type for a top-level list: b"*" for an
+    array, b">" for a RESP3 push frame.
+    """
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        value = value.encode()
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, dict):
+        return b"%%%d\r\n" % len(value) + b"".join(encode(k) + encode(v) for k, v in value.items())
+    return kind + b"%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.write_lock = threading.Lock()
+        self.channels = set()
+        self.protocol = 2
+        with self.server.fake.lock:
+            self.server.fake.connections += 1
+
+    def send(self, data):
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def push(self, items):
+        """Out-of-band pub/sub frame: a push in RESP3, a plain array in RESP2"""
+        self.send(encode(items, b">" if self.protocol == 3 else b"*"))
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.split()  # Inline command, e.g. from telnet
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2])
+        return args
+
+    def handle(self):
+        fake = self.server.fake
+        try:
+            while True:
+                args = self.read_command()
+                if args is None:
+                    break
+                if not args:
+                    continue
+                command = args[0].upper().decode()
+                handler = getattr(self, f"do_{command}", None)
+                if handler is None:
+                    self.send(b"-ERR unknown command '%s'\r\n" % args[0])
+                elif handler(*args[1:]) is False:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            fake.unsubscribe(self, list(self.channels))
+
+    def do_HELLO(self, protover=b"2", *args):
+        if protover not in (b"2", b"3"):
+            self.send(b"-NOPROTO unsupported protocol version\r\n")
+            return
+        self.protocol = int(protover)
+        info = {b"server": b"redis", b"version": b"7.0.0", b"proto": self.protocol,
+                b"id": id(self) & 0xFFFF, b"mode": b"standalone", b"role": b"master", b"modules": []}
+        if self.protocol == 2:
+            info = [item for pair in info.items() for item in pair]
+        self.send(encode(info))
+
+    def do_PING(self, message=None):
+        if self.channels and self.protocol == 2:
+            self.send(encode([b"pong", message or b""]))
+        else:
+            self.send(b"+PONG\r\n" if message is None else encode(message))
+
+    def do_ECHO(self, message):
+        self.send(encode(message))
+
+    def do_SELECT(self, index):
+        self.send(b"+OK\r\n")
+
+    def do_CLIENT(self, *args):
+        self.send(b"+OK\r\n")
+
+    def do_INFO(self, *args):
+        self.send(encode(b"# Server\r\nredis_version:7.0.0-fake\r\n"))
+
+    def do_QUIT(self):
+        self.send(b"+OK\r\n")
+        return False
+
+    def do_PUBLISH(self, channel, message):
+        self.send(encode(self.server.fake.publish(channel, message)))
+
+    def do_SUBSCRIBE(self, *channels):
+        for channel in channels:
+            self.server.fake.subscribe(self, channel)
+            self.push([b"subscribe", channel, len(self.channels)])
+
+    def do_UNSUBSCRIBE(self, *channels):
+        channels = channels or list(self.channels)
+        if not channels:
+            self.push([b"unsubscribe", None, 0])
+        for channel in channels:
+            self.server.fake.unsubscribe(self, [channel])
+            self.push([b"unsubscribe", channel, len(self.channels)])
+
+
+class FakeRedis:
+    """Threaded pub/sub-only Redis stand-in; use as a context manager or start()/stop()"""
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.connections = 0
+        self.published = 0
+        self.delivered = 0
+        self.server = socketserver.ThreadingTCPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    def subscribe(self, handler, channel):
+        with self.lock:
+            self.subscribers.setdefault(channel, set()).add(handler)
+            handler.channels.add(channel)
+
+    def unsubscribe(self, handler, channels):
+        with self.lock:
+            for channel in channels:
+                handler.channels.discard(channel)
+                subscribers = self.subscribers.get(channel)
+                if subscribers:
+                    subscribers.discard(handler)
+
+    def publish(self, channel, message):
+        with self.lock:
+            self.published += 1
+            receivers = list(self.subscribers.get(channel, ()))
+        delivered = 0
+        for handler in receivers:
+            try:
+                handler.push([b"message", channel, message])
+                delivered += 1
+            except OSError:
+                pass
+        with self.lock:
+            self.delivered += delivered
+        return delivered
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pub/sub-only Redis stand-in for Socket.IO message queues")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    fake = FakeRedis(args.host, args.port)
+    print(f"Fake Redis listening on {fake.url}")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
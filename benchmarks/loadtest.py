@@ -0,0 +1,463 @@
+"""End-to-end load test: concurrent Socket.IO clients against a real stone.py.
+
+Starts a FakeOllama in this process and stone.py as a subprocess pointed at
+it (with a throwaway database), then runs N clients for a fixed duration.
+Each client has its own session and loops over a weighted mix of:
+
+    chat    send_message over Socket.IO, waiting for response_complete/error
+    save    POST /api/save_context
+    search  GET /api/memory/search
+
+The run reports throughput, per-operation and time-to-first-token
+percentiles, server CPU and RSS, and SQLite lock waits (scraped from
+/metrics before and after).  --output writes the results as JSON with
+sorted keys so runs can be diffed between commits.
+
+    python benchmarks/loadtest.py --clients 20 --duration 30 --output before.json
+    python benchmarks/loadtest.py --clients 50 --latency 0.3 --failure-rate 0.02 --mix chat=6,save=3,search=1
+    python benchmarks/loadtest.py --server http://localhost:5000 --pid 1234   # an already running server
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import requests
+import socketio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_ollama import FakeOllama  # noqa: E402
+from benchmarks.stats import summarize  # noqa: E402
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+STONE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "stone.py")
+
+PROMPTS = [
+    "What is the difference between a process and a thread?",
+    "Summarize the main ideas behind write-ahead logging in two sentences.",
+    "Remember that my favourite database is SQLite",
+    "Give me three name ideas for a home lab server",
+    "This is important: the deploy window is Friday at noon",
+    "How do I profile a slow Python function?",
+    "Note that the staging cluster uses port 8443",
+    "Explain backpressure in streaming systems like I'm new to it",
+]
+SEARCH_TERMS = ["sqlite", "deploy friday", "port", "database", "staging cluster", "favourite"]
+OPERATIONS = ("chat", "save", "search")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r} (expected {', '.join(OPERATIONS)})")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(fake_url, workdir, timeout=30, env=None, log_name="server.log"):
+    """Launch stone.py on a free port with the workdir's database; return (process, url)
+
+    `env` adds or overrides environment variables, e.g. STONE_WORKER_ID when
+    several servers share one workdir.
+    """
+    port = free_port()
+    env = dict(os.environ, OLLAMA_BASE_URL=fake_url, STONE_PORT=str(port),
+               STONE_CONTEXT_DB=os.path.join(workdir, "loadtest.db"), PYTHONUNBUFFERED="1", **(env or {}))
+    log = open(os.path.join(workdir, log_name), "w")
+    proc = subprocess.Popen([sys.executable, STONE], env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"stone.py exited with {proc.returncode}; see {log.name}")
+        try:
+            if requests.get(url + "/api/stats", timeout=1).ok:
+                return proc, url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError(f"stone.py did not start within {timeout}s; see {log.name}")
+
+
+def read_process(pid):
+    """(cpu seconds, rss bytes) for pid, or None where neither psutil nor /proc is available"""
+    if psutil is not None:
+        proc = psutil.Process(pid)
+        times = proc.cpu_times()
+        return times.user + times.system, proc.memory_info().rss
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            resident = int(f.read().split()[1])
+    except OSError:
+        return None
+    return ((int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"),
+            resident * os.sysconf("SC_PAGE_SIZE"))
+
+
+class ProcessMonitor:
+    """Samples a process's CPU time and RSS on a background thread"""
+
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            sample = read_process(self.pid)
+            if sample is None:
+                return
+            self.samples.append((time.monotonic(), *sample))
+            if self._stop.wait(self.interval):
+                return
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        sample = read_process(self.pid)
+        if sample is not None:
+            self.samples.append((time.monotonic(), *sample))
+        if len(self.samples) < 2:
+            return None
+        (t0, cpu0, _), (t1, cpu1, _) = self.samples[0], self.samples[-1]
+        rss = [s[2] for s in self.samples]
+        return {
+            "cpu_percent": (cpu1 - cpu0) / (t1 - t0) * 100,
+            "cpu_seconds": cpu1 - cpu0,
+            "rss_mb_peak": max(rss) / 2**20,
+            "rss_mb_mean": statistics.fmean(rss) / 2**20,
+        }
+
+
+_SAMPLE_RE = re.compile(r'^(\w+)(?:\{(.*)\})? (\S+)$')
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def scrape(url):
+    """Parse /metrics into {(name, ((label, value), ...)): float}"""
+    samples = {}
+    for line in requests.get(url + "/metrics", timeout=10).text.splitlines():
+        match = _SAMPLE_RE.match(line)
+        if match:
+            name, labels, value = match.groups()
+            samples[(name, tuple(sorted(_LABEL_RE.findall(labels or ""))))] = float(value)
+    return samples
+
+
+def histogram_delta(before, after, name):
+    """Per-label-set count, sum and cumulative buckets observed between two scrapes"""
+    series = {}
+    for (metric, labels), value in after.items():
+        if not metric.startswith(name):
+            continue
+        delta = value - before.get((metric, labels), 0.0)
+        key = tuple(pair for pair in labels if pair[0] != "le")
+        entry = series.setdefault(key, {"buckets": []})
+        if metric == name + "_count":
+            entry["count"] = int(delta)
+        elif metric == name + "_sum":
+            entry["sum"] = delta
+        elif metric == name + "_bucket":
+            entry["buckets"].append((float(dict(labels)["le"]), delta))
+    return series
+
+
+def bucket_quantile(buckets, count, q):
+    """Upper bound of the histogram bucket holding quantile q"""
+    for bound, cumulative in sorted(buckets):
+        if cumulative >= q * count:
+            return bound
+    return float("inf")
+
+
+def lock_waits(before, after):
+    waits = {}
+    for key, entry in histogram_delta(before, after, "stone_sqlite_lock_wait_seconds").items():
+        count = entry.get("count", 0)
+        if not count:
+            continue
+        fast = dict(entry["buckets"]).get(0.001, 0)
+        waits[dict(key).get("lock", "")] = {
+            "count": count,
+            "total_ms": entry.get("sum", 0.0) * 1000,
+            "mean_ms": entry.get("sum", 0.0) / count * 1000,
+            "p99_ms_le": bucket_quantile(entry["buckets"], count, 0.99) * 1000,
+            "over_1ms": int(count - fast),
+        }
+    return waits
+
+
+class LoadClient:
+    """One simulated user: a Socket.IO connection, an HTTP session and a private session_id"""
+
+    def __init__(self, index, url, model, mix, deadline, seed, chat_timeout):
+        self.url = url
+        self.model = model
+        self.session_id = f"load-{index}"
+        self.deadline = deadline
+        self.chat_timeout = chat_timeout
+        self.random = random.Random(seed)
+        self.mix = mix
+        self.latencies = {op: [] for op in OPERATIONS}
+        self.ttft = []
+        self.errors = Counter()
+        self.failed = Counter()
+        self.http = requests.Session()
+        self.sio = socketio.Client(reconnection=False)
+        self._done = threading.Event()
+        self._request_id = None
+        self._first_token = None
+        self._error = None
+        self.sio.on("response_token", self._on_token)
+        self.sio.on("response_complete", self._on_complete)
+        self.sio.on("error", self._on_error)
+
+    def _current(self, data):
+        # Late events from a chat that already timed out must not end the next one
+        return data.get("request_id", self._request_id) == self._request_id
+
+    def _on_token(self, data):
+        if self._first_token is None:
+            self._first_token = time.perf_counter()
+
+    def _on_complete(self, data):
+        if self._current(data):
+            self._done.set()
+
+    def _on_error(self, data):
+        if self._current(data):
+            self._error = data.get("message", "error")
+            self._done.set()
+
+    def chat(self):
+        self._done.clear()
+        self._first_token = self._error = None
+        self._request_id = uuid.uuid4().hex
+        start = time.perf_counter()
+        self.sio.emit("send_message", {"model": self.model, "message": self.random.choice(PROMPTS),
+                                       "session_id": self.session_id, "request_id": self._request_id})
+        if not self._done.wait(self.chat_timeout):
+            # Stop the server streaming into the next chat's timings
+            self.sio.emit("cancel_generation", {"request_id": self._request_id})
+            return "chat timed out"
+        if self._error:
+            return self._error
+        if self._first_token is not None:
+            self.ttft.append(self._first_token - start)
+
+    def save(self):
+        response = self.http.post(self.url + "/api/save_context", timeout=30, json={
+            "session_id": self.session_id, "role": self.random.choice(("user", "assistant")),
+            "message": self.random.choice(PROMPTS)})
+        if not response.ok:
+            return f"save_context HTTP {response.status_code}"
+
+    def search(self):
+        response = self.http.get(self.url + "/api/memory/search", timeout=30, params={
+            "query": self.random.choice(SEARCH_TERMS), "session_id": self.session_id})
+        if not response.ok:
+            return f"memory search HTTP {response.status_code}"
+
+    def run(self):
+        try:
+            self.sio.connect(self.url, transports=["websocket"], wait_timeout=10)
+        except socketio.exceptions.ConnectionError as e:
+            self.errors[f"connect: {e}"] += 1
+            return
+        names, weights = list(self.mix), list(self.mix.values())
+        try:
+            while time.monotonic() < self.deadline:
+                op = self.random.choices(names, weights)[0]
+                start = time.perf_counter()
+                try:
+                    error = getattr(self, op)()
+                except (requests.RequestException, socketio.exceptions.SocketIOError) as e:
+                    error = f"{op}: {type(e).__name__}"
+                if error:
+                    self.errors[error] += 1
+                    self.failed[op] += 1
+                else:
+                    self.latencies[op].append(time.perf_counter() - start)
+        finally:
+            self.sio.disconnect()
+            self.http.close()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(STONE),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+    fake = proc = None
+    workdir = tempfile.mkdtemp(prefix="stone-loadtest-")
+    if args.server:
+        url, pid = args.server.rstrip("/"), args.pid
+    else:
+        fake = FakeOllama(tokens_per_second=args.rate, response_tokens=args.tokens, models=(args.model,),
+                          latency=args.latency, failure_rate=args.failure_rate, seed=args.seed).start()
+        proc, url = start_server(fake.url, workdir)
+        pid = proc.pid
+
+    try:
+        before = scrape(url)
+        monitor = ProcessMonitor(pid).start() if pid else None
+        start = time.monotonic()
+        deadline = start + args.ramp + args.duration
+        clients = [LoadClient(i, url, args.model, args.mix, deadline, args.seed * 1000 + i, args.chat_timeout)
+                   for i in range(args.clients)]
+        threads = []
+        for i, client in enumerate(clients):
+            threads.append(threading.Thread(target=client.run, daemon=True))
+            threads[-1].start()
+            if args.ramp:
+                time.sleep(args.ramp / args.clients)
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+        server = monitor.stop() if monitor else None
+        after = scrape(url)
+        stats = requests.get(url + "/api/stats", timeout=10).json()
+    finally:
+        if proc is not None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        if fake is not None:
+            fake.stop()
+
+    errors = sum((c.errors for c in clients), Counter())
+    operations = {}
+    for op in OPERATIONS:
+        operations[op] = summarize([lat for c in clients for lat in c.latencies[op]])
+        operations[op]["errors"] = sum(c.failed[op] for c in clients)
+    completed = sum(o["count"] for o in operations.values())
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "started_at": started_at,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "label": args.label,
+        },
+        "config": {
+            "clients": args.clients, "duration_s": args.duration, "ramp_s": args.ramp, "mix": args.mix,
+            "model": args.model, "seed": args.seed,
+            "fake_ollama": None if args.server else {
+                "tokens_per_second": args.rate, "tokens": args.tokens,
+                "latency_s": args.latency, "failure_rate": args.failure_rate},
+        },
+        "throughput": {
+            "elapsed_s": elapsed,
+            "ops_per_second": completed / elapsed,
+            "chats_per_second": operations["chat"]["count"] / elapsed,
+        },
+        "operations": operations,
+        "time_to_first_token": summarize([t for c in clients for t in c.ttft]),
+        "errors": dict(errors.most_common()),
+        "server": server,
+        "sqlite_lock_waits": lock_waits(before, after),
+        "scheduler": stats.get("scheduler"),
+        "write_behind": stats.get("write_behind"),
+        "fake_ollama": None if fake is None else {
+            "requests": fake.requests, "failures": fake.failures,
+            "connections": fake.connections, "aborted": fake.aborted},
+    }
+
+
+def print_report(results):
+    config, throughput = results["config"], results["throughput"]
+    print(f"{config['clients']} clients for {throughput['elapsed_s']:.1f}s, mix {config['mix']}")
+    print(f"throughput: {throughput['ops_per_second']:.1f} ops/s, {throughput['chats_per_second']:.1f} chats/s")
+    rows = [(op, results["operations"][op]) for op in OPERATIONS]
+    rows.append(("ttft", results["time_to_first_token"]))
+    for name, r in rows:
+        if r["count"]:
+            print(f"  {name:<7} n={r['count']:<6} p50 {r['p50_ms']:8.1f} ms  p95 {r['p95_ms']:8.1f} ms  "
+                  f"p99 {r['p99_ms']:8.1f} ms  errors {r.get('errors', 0)}")
+    if results["server"]:
+        s = results["server"]
+        print(f"server: {s['cpu_percent']:.0f}% CPU, RSS peak {s['rss_mb_peak']:.1f} MB "
+              f"(mean {s['rss_mb_mean']:.1f} MB)")
+    for lock, w in results["sqlite_lock_waits"].items():
+        print(f"sqlite {lock} lock: {w['count']} acquisitions, {w['over_1ms']} waited >1 ms, "
+              f"total {w['total_ms']:.1f} ms, p99 <= {w['p99_ms_le']:.2f} ms")
+    for error, count in results["errors"].items():
+        print(f"error x{count}: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of load after ramp-up")
+    parser.add_argument("--ramp", type=float, default=2, help="seconds over which clients connect")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("chat=6,save=3,search=1"),
+                        help="operation weights, e.g. chat=6,save=3,search=1")
+    parser.add_argument("--model", default="fake-llama:latest")
+    parser.add_argument("--rate", type=float, default=50.0, help="fake tokens per second per stream")
+    parser.add_argument("--tokens", type=int, default=64, help="fake tokens per response")
+    parser.add_argument("--latency", type=float, default=0.0, help="fake seconds before the first token")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of fake chats failing with 500")
+    parser.add_argument("--chat-timeout", type=float, default=120, help="seconds to wait for one chat")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--server", help="load an already running server instead of starting one")
+    parser.add_argument("--pid", type=int, help="with --server, the process to sample for CPU/RSS")
+    parser.add_argument("--label", help="free-form note stored with the results")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print machine-readable results")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,10 @@
 
 from flask import Flask, render_template_string, request, jsonify, Response
 from flask_socketio import SocketIO, emit
+from socketio import AsyncServer, AsyncRedisManager
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import os
 import uuid
@@ -14,25 +16,731 @@ from datetime import datetime
 import subprocess
 import re
 import threading
+import socket
 import time
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict
 import hashlib
+import heapq
+import math
+import sys
+import bisect
+from array import array
+import queue
+from contextlib import contextmanager, asynccontextmanager
+import zlib
+import asyncio
+import io
+import ast
+import operator
+import atexit
+import contextvars
+import functools
+import hmac
+import select
+import signal
+import struct
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import numpy as np
+except ImportError:  # Vector search is optional
+    np = None
+
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:  # Only needed by AsyncOllamaClient and the async server mode
+    aiohttp = web = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'stone-secret-key-change-in-production'
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins="*")
 
 # Configuration
-OLLAMA_BASE_URL = "http://127.0.0.1:11434"
-PORT = 5000
-CONTEXT_DB = "stone_context.db"
+OLLAMA_BASE_URL = os.environ.get("OLLAMA_BASE_URL", "http://127.0.0.1:11434")
+PORT = int(os.environ.get("STONE_PORT", 5000))
+CONTEXT_DB = os.environ.get("STONE_CONTEXT_DB", "stone_context.db")
 
-# Initialize SQLite database for context storage and RAG memory
-def init_db():
-    conn = sqlite3.connect(CONTEXT_DB)
-    c = conn.cursor()
-    
+OLLAMA_CONNECT_TIMEOUT = 5  # Seconds to establish a connection to Ollama
+OLLAMA_READ_TIMEOUT = 300  # Max seconds between streamed chunks (model load + slow generations)
+OLLAMA_POOL_SIZE = 32  # Keep-alive connections held open to Ollama
+
+STREAM_MODE = "coalesce"  # "coalesce" batches tokens into frames; "token" emits one frame per token
+STREAM_FLUSH_MS = 30  # Max time tokens wait in a coalesced frame
+STREAM_FLUSH_BYTES = 512  # Flush a coalesced frame early once it holds this many characters
+
+MAX_GENERATIONS_PER_MODEL = 2  # In-flight Ollama generations per model
+MODEL_CONCURRENCY = {}  # Per-model overrides, e.g. {"llama3:70b": 1}
+GENERATION_QUEUE_SIZE = 64  # Generations allowed to wait for a slot before new ones are rejected
+
+CONTEXT_CACHE_TURNS = 20  # Recent turns cached per session
+CONTEXT_CACHE_SESSIONS = 10000  # Sessions kept in the context cache
+CONTEXT_CACHE_BYTES = 64 * 1024 * 1024  # Approximate memory cap for the context cache
+
+RESPONSE_CACHE_ENABLED = False  # Replay stored answers for identical prompts instead of calling Ollama
+RESPONSE_CACHE_TTL = 24 * 3600  # Seconds a cached response stays valid
+RESPONSE_CACHE_ENTRIES = 1000  # Responses held in memory (LRU)
+RESPONSE_CACHE_MAX_ROWS = 10000  # Responses kept in SQLite; trimmed by the retention task
+RESPONSE_CACHE_EXCLUDE_MODELS = set()  # Models that are never cached, e.g. {"llama3:70b"}
+
+TOOL_WORKERS = 8  # Threads running tool calls for all sessions
+TOOL_TIMEOUT = 15  # Default seconds a tool call may take before its result is reported as timed out
+TOOL_MAX_CONCURRENCY = 4  # Default simultaneous calls per tool
+TOOL_MAX_CALLS_PER_MESSAGE = 4  # Tool calls run from one chat message (one per line)
+
+SANDBOX_POOL_SIZE = 2  # Pre-started Python sandbox workers (0 = plain subprocess per call)
+SANDBOX_MAX_RUNS = 50  # Runs before a worker is replaced
+SANDBOX_TIMEOUT = 10  # Wall-clock seconds per run
+SANDBOX_CPU_SECONDS = 5  # CPU seconds per run
+SANDBOX_MEMORY_MB = 256  # Address-space limit per worker
+SANDBOX_MAX_FILES = 32  # Open file descriptors per worker
+SANDBOX_MAX_OUTPUT = 64 * 1024  # Characters of output before a run is stopped
+SANDBOX_PREIMPORT = ("math", "json", "random", "re", "itertools", "collections", "datetime", "statistics")
+
+WEATHER_PROVIDER = "wttr"  # "wttr" (wttr.in) or "stub" (deterministic, offline)
+WEATHER_TTL = 600  # Seconds a weather result is served as fresh
+WEATHER_STALE_TTL = 3600  # Seconds a result may be served while it is refreshed in the background
+WEATHER_CACHE_SIZE = 1000  # Cities kept in the weather cache
+
+CALC_MAX_LENGTH = 500  # Characters accepted by the calculate tool
+CALC_MAX_RESULT_BITS = 4096  # Largest integer (about 1230 digits) any step may produce
+CALC_MAX_OPERATIONS = 10000  # Evaluation steps per expression
+CALC_MAX_ROUND_DIGITS = 100  # Largest |ndigits| accepted by round()
+CALC_CACHE_SIZE = 1024  # Compiled expressions kept, keyed by normalised text
+
+TRACE_BUFFER_SIZE = 500  # Recent request traces kept for /debug/traces
+TRACE_FILE = None  # Also append every trace as a JSON line to this path
+ADMIN_TOKEN = os.environ.get("STONE_ADMIN_TOKEN")  # Required by /debug/* endpoints (unset = disabled)
+PROFILE_MAX_SECONDS = 60  # Longest capture /debug/profile accepts
+PROFILE_INTERVAL_MS = 5  # Stack sampling interval
+
+SERVER_MODE = os.environ.get("STONE_SERVER_MODE", "threading")  # "threading" (Werkzeug) or "async" (aiohttp)
+ASYNC_DB_WORKERS = 16  # Async mode: threads running SQLite work, tools and HTTP routes
+
+# Multi-worker deployments: several processes sharing CONTEXT_DB behind a sticky load balancer
+WORKER_ID = os.environ.get("STONE_WORKER_ID")  # Unique per process; enables the change feed when set
+MESSAGE_QUEUE = os.environ.get("STONE_MESSAGE_QUEUE")  # Socket.IO message queue, e.g. redis://localhost:6379/0
+RUN_MAINTENANCE = os.environ.get("STONE_MAINTENANCE", "1") != "0"  # Run the retention task (one worker only)
+CHANGE_FEED_POLL_MS = 200  # How often other workers' memory and context changes are applied
+CHANGE_LOG_RETENTION_S = 600  # change_log rows kept for workers that fall behind
+
+# Retention policies applied by the hourly maintenance task:
+#   keep_last        newest rows kept (per session when per_session is True)
+#   max_age_days     rows older than this are removed regardless of keep_last
+#   keep_importance  rag_memory rows at or above this importance are never removed
+RETENTION_POLICIES = {
+    "context": {"keep_last": 100, "per_session": True, "max_age_days": None},
+    "rag_memory": {"keep_last": 1000, "per_session": False, "max_age_days": None, "keep_importance": None},
+    "response_cache": {"keep_last": RESPONSE_CACHE_MAX_ROWS, "per_session": False,
+                       "max_age_days": RESPONSE_CACHE_TTL / 86400},
+}
+RETENTION_CHUNK_SIZE = 500  # Rows deleted per write transaction
+RETENTION_PAUSE_MS = 10  # Pause between chunks so request writes can take the lock
+RETENTION_VACUUM_PAGES = 1000  # Pages returned to the OS per incremental_vacuum step
+
+NUM_CTX = 4096  # Context window requested from Ollama
+MODEL_NUM_CTX = {}  # Per-model overrides, e.g. {"llama3.1:8b": 8192}
+MODEL_LABEL_REFRESH_S = 60  # Minimum seconds between /api/tags lookups for unknown metric labels
+PROMPT_RESPONSE_RESERVE = 1024  # Tokens of the window left free for the reply
+PROMPT_MEMORY_SHARE = 0.25  # Max fraction of the prompt budget spent on memories
+PROMPT_MEMORY_CANDIDATES = 8  # Memories retrieved per turn before budgeting
+PROMPT_TURN_HALF_LIFE = 4  # Turns back at which a history turn's recency weight halves
+
+DB_POOL_SIZE = 8  # Max pooled SQLite connections shared across threads
+WRITE_BEHIND_ENABLED = True  # Batch context/memory/knowledge inserts on a writer thread (False = write inline)
+WRITE_BEHIND_BATCH_SIZE = 256  # Max inserts grouped into one transaction
+WRITE_BEHIND_FLUSH_MS = 50  # Max time an insert waits before its batch is committed
+WRITE_BEHIND_QUEUE_SIZE = 10000  # Pending inserts before writers block
+MEMORY_RECENCY_HALF_LIFE_DAYS = 30  # Age at which a memory's recency boost halves
+MEMORY_CANDIDATE_FACTOR = 10  # BM25 candidates fetched per requested result before re-ranking
+MEMORY_INDEX_MAX_DOCS = 200000  # In-memory keyword index capacity; older memories fall back to FTS5
+MEMORY_SEARCH_MODE = "hybrid"  # Default retrieval: "keyword", "vector" or "hybrid" (vector needs numpy)
+VECTOR_DIM = 256  # Width of the hashed n-gram embeddings
+VECTOR_MIN_SIMILARITY = 0.25  # Cosine similarity below which vector hits are ignored
+VECTOR_IVF_MIN_ROWS = 0  # Opt-in IVF coarse quantizer above this many memories (0 = never); costs recall
+VECTOR_IVF_LISTS = 1024  # IVF clusters
+VECTOR_IVF_PROBES = 16  # IVF clusters scanned per query
+
+if WORKER_ID is not None and not re.fullmatch(r'[\w-]+', WORKER_ID):
+    raise SystemExit(f"STONE_WORKER_ID must be letters, digits, '_' or '-', got {WORKER_ID!r}")
+
+socketio = SocketIO(app, cors_allowed_origins="*", message_queue=MESSAGE_QUEUE)
+
+# Metrics: histograms and gauges rendered in the Prometheus text format at /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+def _label_pairs(names, values, extra=()):
+    pairs = []
+    for name, value in list(zip(names, values)) + list(extra):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Histogram:
+    """Bucketed observations per label set.
+
+    observe() is a bisect plus two additions under a lock, cheap enough to
+    leave on in every request path; buckets are only made cumulative when
+    /metrics is scraped.
+    """
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self._series.items()]
+        for labels, counts, total in sorted(snapshot):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = '+Inf' if bound == math.inf else repr(float(bound))
+                labels_le = _label_pairs(self.labelnames, labels, [('le', le)])
+                lines.append(f"{self.name}_bucket{labels_le} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_pairs(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_label_pairs(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class Gauge:
+    """A value read from a callback when /metrics is scraped"""
+
+    def __init__(self, name, documentation, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+
+    def render(self):
+        try:
+            value = self.func()
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, name, documentation, buckets=LATENCY_BUCKETS, labelnames=()):
+        metric = Histogram(name, documentation, buckets, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, documentation, func):
+        metric = Gauge(name, documentation, func)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+time_to_first_token = metrics.histogram(
+    'stone_time_to_first_token_seconds', 'Time from receiving a chat message to its first streamed token',
+    labelnames=('model',))
+tokens_per_second = metrics.histogram(
+    'stone_generation_tokens_per_second', 'Generation speed reported by Ollama',
+    (1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 150, 200, 300), ('model',))
+generation_seconds = metrics.histogram(
+    'stone_generation_seconds', 'Total time handling a chat message, by outcome', labelnames=('model', 'outcome'))
+ollama_request_seconds = metrics.histogram(
+    'stone_ollama_request_seconds', 'Time until Ollama returns response headers', labelnames=('endpoint',))
+sqlite_statement_seconds = metrics.histogram(
+    'stone_sqlite_statement_seconds', 'SQLite statement latency by statement kind and table',
+    FAST_BUCKETS, ('statement',))
+rag_search_seconds = metrics.histogram(
+    'stone_rag_search_seconds', 'RAG memory search latency', FAST_BUCKETS, ('mode',))
+rag_search_results = metrics.histogram(
+    'stone_rag_search_results', 'Memories returned per RAG search', (0, 1, 2, 3, 5, 8, 13, 20, 50), ('mode',))
+sqlite_lock_wait_seconds = metrics.histogram(
+    'stone_sqlite_lock_wait_seconds', 'Time spent waiting for a pooled connection or the SQLite write lock',
+    FAST_BUCKETS, ('lock',))
+tool_seconds = metrics.histogram(
+    'stone_tool_seconds', 'Tool execution time', labelnames=('tool', 'outcome'))
+connected_sids = set()
+metrics.gauge('stone_active_sockets', 'Connected Socket.IO clients', lambda: len(connected_sids))
+metrics.gauge('stone_inflight_generations', 'Chat generations in progress', lambda: len(generations))
+metrics.gauge('stone_db_size_bytes', 'SQLite database size including WAL',
+              lambda: sum(os.path.getsize(CONTEXT_DB + suffix) for suffix in ('', '-wal')
+                          if os.path.exists(CONTEXT_DB + suffix)))
+
+_statement_labels = {}
+_STATEMENT_RE = re.compile(r'^\s*(\w+)(?:.*?\b(?:FROM|INTO|UPDATE|TABLE|INDEX|TRIGGER)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+))?',
+                           re.IGNORECASE | re.DOTALL)
+
+def statement_label(sql):
+    """Low-cardinality label for a SQL statement, e.g. 'SELECT context'"""
+    label = _statement_labels.get(sql)
+    if label is None:
+        match = _STATEMENT_RE.match(sql)
+        if match is None:
+            label = 'OTHER'
+        elif match.group(1).upper() == 'PRAGMA':
+            label = 'PRAGMA ' + sql.split()[1].split('=')[0].split('(')[0]
+        else:
+            label = ' '.join(filter(None, (match.group(1).upper(), match.group(2))))
+        if len(_statement_labels) < 10000:
+            _statement_labels[sql] = label
+    return label
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that records every statement's latency"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            sqlite_statement_seconds.observe(time.perf_counter() - start, statement_label(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            sqlite_statement_seconds.observe(time.perf_counter() - start, statement_label(sql))
+
+    def fetchall(self, sql, parameters=()):
+        """Run a read and fetch every row, timing both"""
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters).fetchall()
+        finally:
+            sqlite_statement_seconds.observe(time.perf_counter() - start, statement_label(sql))
+
+# Request tracing and profiling
+class RequestTrace:
+    """Phase timings for one chat request.
+
+    mark(name) closes the phase that started at the previous mark (or at
+    the start of the request), so a linear pipeline needs one call per step.
+    """
+
+    def __init__(self, request_id, **attrs):
+        self.request_id = request_id
+        self.attrs = attrs
+        self.started_at = now_ms()
+        self.phases = []
+        self.outcome = None
+        self.error = None
+        self._start = self._last = time.perf_counter()
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, (now - self._last) * 1000))
+        self._last = now
+
+    def as_dict(self):
+        return {
+            'request_id': self.request_id,
+            'started_at': ms_to_iso(self.started_at),
+            'total_ms': round(self.total_ms, 3),
+            'outcome': self.outcome,
+            'error': self.error,
+            'phases': [{'phase': name, 'ms': round(ms, 3)} for name, ms in self.phases],
+            **self.attrs,
+        }
+
+class Tracer:
+    """Keeps the last TRACE_BUFFER_SIZE request traces, optionally mirrored to a JSONL file"""
+
+    def __init__(self, size=TRACE_BUFFER_SIZE, path=TRACE_FILE):
+        self.traces = deque(maxlen=size)
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def start(self, request_id, **attrs):
+        return RequestTrace(request_id, **attrs)
+
+    def finish(self, trace, outcome):
+        trace.outcome = outcome
+        trace.total_ms = (time.perf_counter() - trace._start) * 1000
+        with self._lock:
+            self.traces.append(trace)
+            if self.path:
+                if self._file is None:
+                    self._file = open(self.path, 'a', buffering=1, encoding='utf-8')
+                self._file.write(json.dumps(trace.as_dict()) + '\n')
+
+    def recent(self, limit=50, min_ms=0.0):
+        with self._lock:
+            traces = list(self.traces)
+        return [t.as_dict() for t in reversed(traces) if t.total_ms >= min_ms][:limit]
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+tracer = Tracer()
+
+class StackSampler:
+    """Wall-clock sampling profiler covering every thread.
+
+    Samples sys._current_frames() every PROFILE_INTERVAL_MS and counts
+    collapsed stacks ("thread;outer;...;inner count" lines), the format read
+    by flamegraph.pl and speedscope.  Only one capture runs at a time.
+    """
+
+    IDLE_FUNCTIONS = frozenset({'wait', 'select', 'sleep', 'accept', 'poll', 'get', 'readinto',
+                                '_wait_for_tstate_lock', 'recv_into', 'read', '_worker'})
+
+    def __init__(self, interval_ms=PROFILE_INTERVAL_MS):
+        self.interval = interval_ms / 1000
+        self._busy = threading.Lock()
+
+    def capture(self, seconds, include_idle=True):
+        """Return (collapsed stack counts, samples taken)"""
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError("a profile is already being captured")
+        try:
+            counts = defaultdict(int)
+            me = threading.get_ident()
+            deadline = time.monotonic() + seconds
+            samples = 0
+            while time.monotonic() < deadline:
+                names = {t.ident: t.name for t in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    if not include_idle and frame.f_code.co_name in self.IDLE_FUNCTIONS:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, f"thread-{ident}"))
+                    counts[';'.join(reversed(stack))] += 1
+                samples += 1
+                time.sleep(self.interval)
+            return counts, samples
+        finally:
+            self._busy.release()
+
+profiler = StackSampler()
+
+# Storage layer: one pool of persistent SQLite connections for the whole server
+class Database:
+    """Thread-safe pool of persistent SQLite connections.
+
+    Connections are opened once in WAL mode with tuned pragmas and handed out
+    to whichever thread needs one.  Python's sqlite3 keeps a per-connection
+    cache of prepared statements keyed on the SQL text, so as long as
+    connections live in the pool the statements below are compiled once and
+    reused on every call.
+    """
+
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-16000",      # 16 MB page cache per connection
+        "PRAGMA mmap_size=268435456",    # 256 MB memory-mapped I/O
+        "PRAGMA busy_timeout=5000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA recursive_triggers=ON",  # INSERT OR REPLACE fires delete triggers
+    )
+
+    def __init__(self, path, pool_size=DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self.setup = []  # Extra per-connection statements, e.g. TEMP triggers
+        self._pool = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False,
+                               cached_statements=256, factory=TimedConnection)
+        for statement in self.PRAGMAS + tuple(self.setup):
+            conn.execute(statement)
+        return conn
+
+    def _acquire(self):
+        # Every acquisition is observed, uncontended ones as 0, so the
+        # histogram count is the number of acquisitions
+        try:
+            conn = self._pool.get_nowait()
+            sqlite_lock_wait_seconds.observe(0.0, 'pool')
+            return conn
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.pool_size:
+                self._opened += 1
+                try:
+                    conn = self._open()
+                except Exception:
+                    self._opened -= 1
+                    raise
+                sqlite_lock_wait_seconds.observe(0.0, 'pool')
+                return conn
+        start = time.perf_counter()
+        conn = self._pool.get()
+        sqlite_lock_wait_seconds.observe(time.perf_counter() - start, 'pool')
+        return conn
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._pool.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection for reads"""
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self):
+        """Borrow a connection inside a write transaction, committed on success"""
+        conn = self._acquire()
+        try:
+            # Take the write lock up front so busy_timeout applies instead of
+            # failing later on a read-to-write lock upgrade
+            start = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            sqlite_lock_wait_seconds.observe(time.perf_counter() - start, 'write')
+            yield conn
+            conn.commit()
+        finally:
+            self._release(conn)
+
+    def execute(self, sql, params=()):
+        """Run a single write statement in its own transaction"""
+        with self.transaction() as conn:
+            return conn.execute(sql, params)
+
+    def query(self, sql, params=()):
+        """Run a read statement and return all rows"""
+        with self.connection() as conn:
+            return conn.fetchall(sql, params)
+
+    def close_all(self):
+        """Close every idle pooled connection"""
+        while True:
+            try:
+                conn = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._opened -= 1
+
+db = Database(CONTEXT_DB)
+
+# Write-behind batching for inserts
+class WriteBehindQueue:
+    """Background writer that groups queued inserts into shared transactions.
+
+    A batch is committed once WRITE_BEHIND_BATCH_SIZE writes are waiting or
+    WRITE_BEHIND_FLUSH_MS after its first write arrived.  Each write carries
+    a key (usually the session id); wait_for(key) flushes immediately and
+    blocks until that key's writes are committed, which gives callers
+    read-your-writes.  Optional callbacks receive the write's lastrowid on
+    the writer thread after commit.  With WRITE_BEHIND_ENABLED off every
+    write runs inline instead.
+    """
+
+    FLUSH_NOW = object()
+    STOP = object()
+
+    def __init__(self, enabled=WRITE_BEHIND_ENABLED, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                 flush_ms=WRITE_BEHIND_FLUSH_MS, queue_size=WRITE_BEHIND_QUEUE_SIZE):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_after = flush_ms / 1000
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._pending = defaultdict(int)
+        self._pending_total = 0
+        self._cond = threading.Condition()
+        self.batches = 0
+        self.rows = 0
+        self.errors = 0
+        self.total_flush = 0.0
+        self.max_flush = 0.0
+        self._thread = None
+        if enabled:
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+
+    def submit(self, sql, params, key=None, callback=None):
+        """Queue an insert; callback(lastrowid) runs once it is committed"""
+        if self._thread is None:
+            cursor = db.execute(sql, params)
+            if callback:
+                callback(cursor.lastrowid)
+            return
+        with self._cond:
+            self._pending[key] += 1
+            self._pending_total += 1
+        self._queue.put((sql, params, key, callback))
+
+    def wait_for(self, key, timeout=10.0):
+        """Block until every write queued under key has been committed"""
+        with self._cond:
+            if not self._pending.get(key):
+                return
+        self._queue.put(self.FLUSH_NOW)
+        with self._cond:
+            self._cond.wait_for(lambda: not self._pending.get(key), timeout)
+
+    def drain(self, timeout=30.0):
+        """Block until everything queued so far has been committed"""
+        if self._thread is None:
+            return
+        self._queue.put(self.FLUSH_NOW)
+        with self._cond:
+            self._cond.wait_for(lambda: self._pending_total == 0, timeout)
+
+    def stop(self):
+        """Flush all pending writes and stop the writer thread"""
+        if self._thread is None:
+            return
+        self._queue.put(self.STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self.STOP:
+                break
+            batch = [] if item is self.FLUSH_NOW else [item]
+            deadline = time.monotonic() + self.flush_after
+            while batch and len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is self.STOP:
+                    stopping = True
+                    # Commit everything still queued before exiting
+                    while True:
+                        try:
+                            item = self._queue.get_nowait()
+                        except queue.Empty:
+                            break
+                        if item is not self.FLUSH_NOW and item is not self.STOP:
+                            batch.append(item)
+                    break
+                if item is self.FLUSH_NOW:
+                    break
+                batch.append(item)
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch):
+        start = time.perf_counter()
+        rowids = []
+        try:
+            with db.transaction() as c:
+                for sql, params, _, _ in batch:
+                    rowids.append(c.execute(sql, params).lastrowid)
+        except Exception as e:
+            # Retry one by one so a single bad row does not sink the batch
+            print(f"Write-behind batch failed ({e}); retrying rows individually")
+            rowids = []
+            for sql, params, _, _ in batch:
+                try:
+                    rowids.append(db.execute(sql, params).lastrowid)
+                except Exception as row_error:
+                    self.errors += 1
+                    rowids.append(None)
+                    print(f"Write-behind insert dropped: {row_error}")
+        elapsed = time.perf_counter() - start
+        for (_, _, _, callback), rowid in zip(batch, rowids):
+            if callback and rowid is not None:
+                try:
+                    callback(rowid)
+                except Exception as e:
+                    print(f"Write-behind callback error: {e}")
+        with self._cond:
+            for _, _, key, _ in batch:
+                self._pending[key] -= 1
+                if not self._pending[key]:
+                    del self._pending[key]
+            self._pending_total -= len(batch)
+            self.batches += 1
+            self.rows += len(batch)
+            self.total_flush += elapsed
+            self.max_flush = max(self.max_flush, elapsed)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'enabled': self._thread is not None,
+                'queue_depth': self._pending_total,
+                'batches': self.batches,
+                'rows': self.rows,
+                'errors': self.errors,
+                'avg_batch_size': self.rows / self.batches if self.batches else 0.0,
+                'avg_flush_ms': self.total_flush / self.batches * 1000 if self.batches else 0.0,
+                'max_flush_ms': self.max_flush * 1000,
+            }
+
+write_behind = WriteBehindQueue()
+atexit.register(write_behind.stop)
+
+def now_ms():
+    """Current time as integer epoch milliseconds, the stored timestamp format"""
+    return int(time.time() * 1000)
+
+def ms_to_iso(ms):
+    """Render a stored epoch-millis timestamp as local ISO time for API responses"""
+    return datetime.fromtimestamp(ms / 1000).isoformat() if ms else None
+
+def iso_to_epoch(timestamp):
+    """Convert a legacy ISO timestamp to epoch seconds (0 if unparseable)"""
+    try:
+        return datetime.fromisoformat(timestamp).timestamp()
+    except (TypeError, ValueError):
+        return 0.0
+
+# Schema migrations: applied in order at startup, recorded in schema_version
+MIGRATIONS = []
+
+def migration(version, transaction=True):
+    """Register a schema migration.
+
+    Each runs once inside its own write transaction, unless transaction is
+    False (needed for statements such as VACUUM), in which case it gets a
+    plain pooled connection.
+    """
+    def register(func):
+        MIGRATIONS.append((version, func, transaction))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+@migration(1)
+def create_base_tables(c):
     # Context table
     c.execute('''CREATE TABLE IF NOT EXISTS context 
                 (session_id TEXT, timestamp TEXT, message TEXT, role TEXT)''')
@@ -46,170 +754,2368 @@ def init_db():
     c.execute('''CREATE TABLE IF NOT EXISTS knowledge_base 
                 (topic TEXT, content TEXT, source TEXT, timestamp TEXT,
                  PRIMARY KEY (topic, source))''')
+
+def create_rag_memory_fts(c, rowid_column):
+    """Full-text index over rag_memory, kept in sync by triggers"""
+    c.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS rag_memory_fts USING fts5
+                 (content, content='rag_memory', content_rowid='{rowid_column}',
+                  tokenize='porter unicode61')''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS rag_memory_fts_ai AFTER INSERT ON rag_memory BEGIN
+                     INSERT INTO rag_memory_fts (rowid, content) VALUES (new.{rowid_column}, new.content);
+                 END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS rag_memory_fts_ad AFTER DELETE ON rag_memory BEGIN
+                     INSERT INTO rag_memory_fts (rag_memory_fts, rowid, content)
+                     VALUES ('delete', old.{rowid_column}, old.content);
+                 END''')
+    c.execute(f'''CREATE TRIGGER IF NOT EXISTS rag_memory_fts_au AFTER UPDATE ON rag_memory BEGIN
+                     INSERT INTO rag_memory_fts (rag_memory_fts, rowid, content)
+                     VALUES ('delete', old.{rowid_column}, old.content);
+                     INSERT INTO rag_memory_fts (rowid, content) VALUES (new.{rowid_column}, new.content);
+                 END''')
+    # Backfill memories stored before the index existed
+    c.execute("INSERT INTO rag_memory_fts (rag_memory_fts) VALUES ('rebuild')")
+
+@migration(2)
+def add_rag_memory_fts(c):
+    if not c.execute("SELECT 1 FROM sqlite_master WHERE name = 'rag_memory_fts'").fetchone():
+        create_rag_memory_fts(c, 'rowid')
+
+@migration(3)
+def integer_timestamps_and_indexes(c):
+    """Rebuild the tables with epoch-millis ts columns, stable integer keys and indexes.
+
+    Existing rowids are carried over as the new integer primary keys, so the
+    on-disk vector index stays aligned with rag_memory.
+    """
+    c.create_function('iso_to_ms', 1, lambda ts: int(iso_to_epoch(ts) * 1000), deterministic=True)
     
-    conn.commit()
-    conn.close()
+    c.execute('''CREATE TABLE context_v3
+                (id INTEGER PRIMARY KEY, session_id TEXT, ts INTEGER NOT NULL,
+                 message TEXT, role TEXT)''')
+    c.execute('''INSERT INTO context_v3 (id, session_id, ts, message, role)
+                SELECT rowid, session_id, iso_to_ms(timestamp), message, role FROM context''')
+    c.execute("DROP TABLE context")
+    c.execute("ALTER TABLE context_v3 RENAME TO context")
+    c.execute("CREATE INDEX context_session_ts ON context (session_id, ts)")
+    
+    c.execute("DROP TABLE IF EXISTS rag_memory_fts")
+    c.execute('''CREATE TABLE rag_memory_v3
+                (doc_id INTEGER PRIMARY KEY AUTOINCREMENT, id TEXT UNIQUE, session_id TEXT,
+                 content TEXT, keywords TEXT, ts INTEGER NOT NULL, importance INTEGER DEFAULT 1)''')
+    c.execute('''INSERT INTO rag_memory_v3 (doc_id, id, session_id, content, keywords, ts, importance)
+                SELECT rowid, id, session_id, content, keywords, iso_to_ms(timestamp), importance
+                FROM rag_memory''')
+    c.execute("DROP TABLE rag_memory")
+    c.execute("ALTER TABLE rag_memory_v3 RENAME TO rag_memory")
+    c.execute("CREATE INDEX rag_memory_session_importance_ts ON rag_memory (session_id, importance, ts)")
+    c.execute("CREATE INDEX rag_memory_importance_ts ON rag_memory (importance, ts)")
+    c.execute("CREATE INDEX rag_memory_ts ON rag_memory (ts)")
+    create_rag_memory_fts(c, 'doc_id')
+    
+    c.execute('''CREATE TABLE knowledge_base_v3
+                (topic TEXT, content TEXT, source TEXT, ts INTEGER NOT NULL,
+                 PRIMARY KEY (topic, source))''')
+    c.execute('''INSERT INTO knowledge_base_v3 (topic, content, source, ts)
+                SELECT topic, content, source, iso_to_ms(timestamp) FROM knowledge_base''')
+    c.execute("DROP TABLE knowledge_base")
+    c.execute("ALTER TABLE knowledge_base_v3 RENAME TO knowledge_base")
+    c.execute("CREATE INDEX knowledge_base_topic ON knowledge_base (topic COLLATE NOCASE)")
+
+@migration(4, transaction=False)
+def enable_incremental_vacuum(c):
+    """Switch to auto_vacuum=INCREMENTAL so retention can return freed pages in small steps.
+
+    Changing the mode of an existing file needs a full VACUUM, a one-off
+    rewrite of the whole database that blocks other connections while it
+    runs (roughly a second per few hundred MB).  New and already converted
+    databases skip it.  If another process holds the database the VACUUM
+    fails; startup continues in the old mode and retention skips the
+    incremental step until a manual VACUUM finishes the switch.
+    """
+    if c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return
+    c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    try:
+        c.execute("VACUUM")  # Required for the mode change to take effect on an existing file
+    except sqlite3.OperationalError as e:
+        print(f"Could not VACUUM to enable incremental vacuum ({e}); "
+              f"run VACUUM on {CONTEXT_DB} while STONE is stopped to finish the switch")
+
+@migration(5)
+def add_response_cache(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS response_cache
+                 (cache_key TEXT PRIMARY KEY, model TEXT NOT NULL, session_id TEXT,
+                  response TEXT NOT NULL, prompt_tokens INTEGER, ts INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS response_cache_session ON response_cache (session_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS response_cache_ts ON response_cache (ts)")
+
+@migration(6)
+def add_change_log(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS change_log
+                 (seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, kind TEXT NOT NULL,
+                  ref INTEGER, session_id TEXT, ts INTEGER NOT NULL)''')
+    c.execute("CREATE INDEX IF NOT EXISTS change_log_ts ON change_log (ts)")
+
+def run_migrations():
+    """Apply every migration newer than the database's schema_version"""
+    with db.transaction() as c:
+        c.execute('''CREATE TABLE IF NOT EXISTS schema_version
+                    (version INTEGER PRIMARY KEY, applied_at INTEGER NOT NULL)''')
+    for version, func, transactional in MIGRATIONS:
+        if not transactional:
+            current = db.query("SELECT COALESCE(MAX(version), 0) FROM schema_version")[0][0]
+            if version <= current:
+                continue
+            with db.connection() as c:
+                func(c)
+            db.execute("INSERT OR IGNORE INTO schema_version (version, applied_at) VALUES (?, ?)",
+                       (version, now_ms()))
+            print(f"Applied schema migration {version}: {func.__name__}")
+            continue
+        with db.transaction() as c:
+            # Re-read inside the write lock so concurrent starters apply each step once
+            current = c.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+            if version <= current:
+                continue
+            func(c)
+            c.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)", (version, now_ms()))
+            print(f"Applied schema migration {version}: {func.__name__}")
+
+# Initialize SQLite database for context storage and RAG memory
+def init_db():
+    run_migrations()
 
 init_db()
 
+def change_log_triggers(origin):
+    """TEMP triggers recording this worker's rag_memory and context writes in change_log.
+
+    They run inside the writing transaction, so other workers see a change
+    exactly when its rows are committed, whichever code path wrote them.
+    """
+    now = "CAST((julianday('now') - 2440587.5) * 86400000 AS INTEGER)"
+    events = (('memory_insert', 'INSERT', 'rag_memory', 'memory+', 'NEW.doc_id', 'NEW.session_id'),
+              ('memory_delete', 'DELETE', 'rag_memory', 'memory-', 'OLD.doc_id', 'OLD.session_id'),
+              ('context_insert', 'INSERT', 'context', 'context', 'NULL', 'NEW.session_id'),
+              ('context_delete', 'DELETE', 'context', 'context', 'NULL', 'OLD.session_id'))
+    return [f"""CREATE TEMP TRIGGER IF NOT EXISTS change_log_{name} AFTER {op} ON main.{table}
+                BEGIN
+                    INSERT INTO change_log (origin, kind, ref, session_id, ts)
+                    VALUES ('{origin}', '{kind}', {ref}, {session}, {now});
+                END"""
+            for name, op, table, kind, ref, session in events]
+
+if WORKER_ID:
+    db.setup.extend(change_log_triggers(WORKER_ID))
+    db.close_all()  # Reopen pooled connections with the triggers installed
+    # Changes committed from here on are replayed by the change feed
+    CHANGE_FEED_START = db.query("SELECT COALESCE(MAX(seq), 0) FROM change_log")[0][0]
+
+STOP_WORDS = frozenset({'the', 'is', 'at', 'which', 'on', 'and', 'a', 'to', 'are', 'as', 'was', 'with', 'for', 'be', 'have', 'this', 'that', 'will', 'you', 'they', 'of', 'it', 'in', 'or', 'an', 'what', 'when', 'where', 'how', 'why', 'who'})
+
+def rank_score(relevance, importance, epoch, now):
+    """Blend a text relevance score with importance and recency"""
+    age_days = max(now - epoch, 0) / 86400 if epoch else 0
+    recency = 0.5 ** (age_days / MEMORY_RECENCY_HALF_LIFE_DAYS)
+    return relevance * (1 + 0.5 * ((importance or 1) - 1)) * (0.5 + 0.5 * recency)
+
+# In-memory keyword index
+class KeywordIndex:
+    """Posting-list index from keyword to rag_memory rowids.
+
+    Each keyword maps to a sorted array of integer rowids; per-document
+    metadata (session, importance, timestamp) is held once per rowid and the
+    memory text itself stays in SQLite until a result is returned.  Deleted
+    rowids are tombstoned and swept from the posting lists in bulk.  Once
+    more than max_docs memories exist the oldest are evicted and the index
+    reports itself incomplete so callers can fall back to FTS5.
+    """
+
+    def __init__(self, max_docs=MEMORY_INDEX_MAX_DOCS):
+        self.max_docs = max_docs
+        self.postings = {}
+        self.docs = {}
+        self.tombstones = set()
+        self.complete = True
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def add(self, doc_id, terms, session_id, importance, epoch):
+        with self._lock:
+            if doc_id in self.tombstones:
+                # SQLite reused a deleted rowid; drop stale postings first
+                self._compact()
+            session_id = self._sessions.setdefault(session_id, session_id)
+            self.docs[doc_id] = (session_id, importance or 1, epoch)
+            for term in set(terms):
+                posting = self.postings.get(term)
+                if posting is None:
+                    self.postings[term] = array('q', (doc_id,))
+                elif posting[-1] < doc_id:
+                    posting.append(doc_id)
+                else:
+                    pos = bisect.bisect_left(posting, doc_id)
+                    if pos == len(posting) or posting[pos] != doc_id:
+                        posting.insert(pos, doc_id)
+            while len(self.docs) > self.max_docs:
+                oldest = next(iter(self.docs))  # docs are added in rowid order
+                del self.docs[oldest]
+                self.tombstones.add(oldest)
+                self.complete = False
+            self._maybe_compact()
+
+    def remove(self, doc_ids):
+        with self._lock:
+            for doc_id in doc_ids:
+                if self.docs.pop(doc_id, None) is not None:
+                    self.tombstones.add(doc_id)
+            self._maybe_compact()
+
+    def _maybe_compact(self):
+        if len(self.tombstones) > max(1024, len(self.docs) // 4):
+            self._compact()
+
+    def _compact(self):
+        dead = self.tombstones
+        for term in list(self.postings):
+            kept = array('q', (d for d in self.postings[term] if d not in dead))
+            if kept:
+                self.postings[term] = kept
+            else:
+                del self.postings[term]
+        self.tombstones = set()
+        live_sessions = {meta[0] for meta in self.docs.values()}
+        self._sessions = {sid: sid for sid in live_sessions}
+
+    def search(self, terms, session_id=None, limit=5, match_all=False, now=None):
+        """Return the best (score, doc_id) pairs for the given keywords"""
+        now = now or time.time()
+        with self._lock:
+            total = len(self.docs) or 1
+            lists = [(term, self.postings.get(term)) for term in dict.fromkeys(terms)]
+            if match_all:
+                if any(posting is None for _, posting in lists):
+                    return []
+                lists.sort(key=lambda item: len(item[1]))
+                candidates = set(lists[0][1])
+                for _, posting in lists[1:]:
+                    candidates.intersection_update(posting)
+                    if not candidates:
+                        return []
+            relevance = defaultdict(float)
+            for term, posting in lists:
+                if not posting:
+                    continue
+                idf = math.log(1 + total / len(posting))
+                for doc_id in posting:
+                    if match_all and doc_id not in candidates:
+                        continue
+                    relevance[doc_id] += idf
+            scored = []
+            for doc_id, rel in relevance.items():
+                meta = self.docs.get(doc_id)
+                if meta is None or (session_id and meta[0] != session_id):
+                    continue
+                scored.append((rank_score(rel, meta[1], meta[2], now), doc_id))
+        return heapq.nlargest(limit, scored)
+
+    def stats(self):
+        """Report index size and an estimate of its memory footprint"""
+        with self._lock:
+            posting_bytes = sum(sys.getsizeof(p) for p in self.postings.values())
+            key_bytes = sum(sys.getsizeof(t) for t in self.postings)
+            doc_bytes = sys.getsizeof(self.docs) + sum(sys.getsizeof(m) for m in self.docs.values())
+            return {
+                'documents': len(self.docs),
+                'terms': len(self.postings),
+                'postings': sum(len(p) for p in self.postings.values()),
+                'tombstones': len(self.tombstones),
+                'complete': self.complete,
+                'max_documents': self.max_docs,
+                'approx_bytes': (sys.getsizeof(self.postings) + posting_bytes + key_bytes
+                                 + doc_bytes + sys.getsizeof(self.tombstones)),
+            }
+
+# Semantic vector index
+class HashingEmbedder:
+    """Offline embedder: signed feature hashing of character n-grams.
+
+    Any object with a ``dim`` attribute and an ``embed(text)`` method returning
+    a float32 vector of that size can be passed to RAGMemory instead.
+    """
+
+    def __init__(self, dim=VECTOR_DIM, ngram_sizes=(3, 4)):
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+
+    def embed(self, text):
+        buckets = []
+        signs = []
+        for word in re.findall(r'\w+', text.lower()):
+            if word in STOP_WORDS or len(word) < 2:
+                continue
+            word = f" {word} "
+            for n in self.ngram_sizes:
+                for i in range(len(word) - n + 1):
+                    h = zlib.crc32(word[i:i + n].encode())
+                    buckets.append(h % self.dim)
+                    signs.append(1.0 if h & 0x80000000 else -1.0)
+        vec = np.bincount(buckets, weights=signs, minlength=self.dim).astype(np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+
+class VectorIndex:
+    """Memory-mapped float32 matrix of normalized embeddings keyed by rowid.
+
+    Rows live contiguously in ``<path>.vec`` with their rag_memory rowids in
+    ``<path>.vecids`` (-1 marks free slots); deletes move the last row into
+    the hole.  Top-k is a single matrix-vector product plus argpartition.
+    Past ivf_min_rows (off by default) an IVF coarse quantizer (k-means
+    centroids) restricts each query to the rows of the nearest few
+    clusters.  It is trained on a background thread and swapped in when
+    done; until then searches keep scanning every row.
+    """
+
+    def __init__(self, path, dim, ivf_min_rows=VECTOR_IVF_MIN_ROWS,
+                 ivf_lists=VECTOR_IVF_LISTS, ivf_probes=VECTOR_IVF_PROBES):
+        self.path = path
+        self.dim = dim
+        self.ivf_min_rows = ivf_min_rows
+        self.ivf_lists = ivf_lists
+        self.ivf_probes = ivf_probes
+        self.centroids = None
+        self.trained_rows = 0
+        self._training = None
+        self._dirty = None  # Positions written while training runs
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        vec_path, ids_path = f"{self.path}.vec", f"{self.path}.vecids"
+        capacity = 0
+        if os.path.exists(ids_path) and os.path.exists(vec_path):
+            capacity = os.path.getsize(ids_path) // 8
+            if os.path.getsize(vec_path) != capacity * self.dim * 4:
+                capacity = 0  # Dimension changed or files torn; rebuild from SQLite
+        if capacity:
+            self.vectors = np.memmap(vec_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+            self.ids = np.memmap(ids_path, dtype=np.int64, mode='r+', shape=(capacity,))
+            free = np.flatnonzero(self.ids < 0)
+            self.count = int(free[0]) if len(free) else capacity
+        else:
+            self.vectors = self.ids = None
+            self.count = 0
+            self._resize(1024)
+        self.positions = {int(rowid): i for i, rowid in enumerate(self.ids[:self.count])}
+        self.sessions = np.zeros(len(self.ids), dtype=np.int32)
+        self.session_codes = {}
+        self.assignments = np.full(len(self.ids), -1, dtype=np.int32)
+
+    def _resize(self, capacity):
+        vec_path, ids_path = f"{self.path}.vec", f"{self.path}.vecids"
+        old = len(self.ids) if self.ids is not None else 0
+        for arr in (self.vectors, self.ids):
+            if arr is not None:
+                arr.flush()
+        self.vectors = self.ids = None
+        with open(vec_path, 'ab') as f:
+            f.truncate(capacity * self.dim * 4)
+        with open(ids_path, 'ab') as f:
+            f.truncate(capacity * 8)
+        self.vectors = np.memmap(vec_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.ids = np.memmap(ids_path, dtype=np.int64, mode='r+', shape=(capacity,))
+        self.ids[old:] = -1
+        if old:
+            self.sessions = np.concatenate([self.sessions, np.zeros(capacity - old, np.int32)])
+            self.assignments = np.concatenate([self.assignments, np.full(capacity - old, -1, np.int32)])
+
+    def _session_code(self, session_id):
+        return self.session_codes.setdefault(session_id, len(self.session_codes) + 1)
+
+    def add(self, rowid, vector, session_id):
+        with self._lock:
+            pos = self.positions.get(rowid)
+            if pos is None:
+                if self.count == len(self.ids):
+                    self._resize(len(self.ids) * 2)
+                pos = self.count
+                self.count += 1
+                self.positions[rowid] = pos
+                self.ids[pos] = rowid
+            self.vectors[pos] = vector
+            self.sessions[pos] = self._session_code(session_id)
+            if self.centroids is not None:
+                self.assignments[pos] = int(np.argmax(self.centroids @ vector))
+            if self._dirty is not None:
+                self._dirty.add(pos)
+
+    def set_session(self, rowid, session_id):
+        pos = self.positions.get(rowid)
+        if pos is not None:
+            self.sessions[pos] = self._session_code(session_id)
+
+    def remove(self, rowids):
+        with self._lock:
+            for rowid in rowids:
+                pos = self.positions.pop(int(rowid), None)
+                if pos is None:
+                    continue
+                last = self.count - 1
+                if pos != last:
+                    moved = int(self.ids[last])
+                    self.vectors[pos] = self.vectors[last]
+                    self.ids[pos] = moved
+                    self.sessions[pos] = self.sessions[last]
+                    self.assignments[pos] = self.assignments[last]
+                    self.positions[moved] = pos
+                self.ids[last] = -1
+                self.assignments[last] = -1
+                self.count = last
+                if self._dirty is not None:
+                    self._dirty.add(pos)
+
+    def train_ivf(self, iterations=8, sample_size=100000, block=65536):
+        """Fit the coarse quantizer with a few rounds of spherical k-means.
+
+        The lock is held only to copy the sample and each block of rows, so
+        searches and adds carry on meanwhile; rows written during training
+        are reassigned when the new centroids are swapped in.
+        """
+        with self._lock:
+            n = self.count
+            lists = min(self.ivf_lists, max(n // 39, 1))
+            rng = np.random.default_rng(0)
+            sample = np.asarray(self.vectors[np.sort(rng.choice(n, size=min(n, sample_size), replace=False))])
+            self._dirty = set()
+        try:
+            centroids = sample[rng.choice(len(sample), size=lists, replace=False)].copy()
+            for _ in range(iterations):
+                nearest = np.argmax(sample @ centroids.T, axis=1)
+                for c in range(lists):
+                    members = sample[nearest == c]
+                    if len(members):
+                        centroid = members.sum(axis=0)
+                        centroids[c] = centroid / (np.linalg.norm(centroid) or 1.0)
+            assignments = np.empty(n, dtype=np.int32)
+            for start in range(0, n, block):
+                with self._lock:
+                    rows = np.asarray(self.vectors[start:min(start + block, n, self.count)])
+                assignments[start:start + len(rows)] = np.argmax(rows @ centroids.T, axis=1)
+            with self._lock:
+                count = self.count
+                final = np.full(len(self.ids), -1, dtype=np.int32)
+                done = min(n, count)
+                final[:done] = assignments[:done]
+                redo = np.array(sorted({p for p in self._dirty if p < done} | set(range(done, count))),
+                                dtype=np.int64)
+                if len(redo):
+                    final[redo] = np.argmax(np.asarray(self.vectors[redo]) @ centroids.T, axis=1)
+                self.assignments = final
+                self.centroids = centroids
+                self.trained_rows = count
+        finally:
+            with self._lock:
+                self._dirty = None
+                self._training = None
+
+    def search(self, vector, k=5, session_id=None):
+        """Return (similarity, rowid) pairs for the k nearest rows"""
+        with self._lock:
+            if (self.ivf_min_rows and self.count >= self.ivf_min_rows
+                    and self.count >= 2 * self.trained_rows and self._training is None):
+                self._training = threading.Thread(target=self.train_ivf, name='ivf-train', daemon=True)
+                self._training.start()
+            n = self.count
+            if not n:
+                return []
+            rows = None
+            if self.centroids is not None:
+                probes = np.argpartition(-(self.centroids @ vector),
+                                         min(self.ivf_probes, len(self.centroids) - 1))[:self.ivf_probes]
+                rows = np.flatnonzero(np.isin(self.assignments[:n], probes))
+            if session_id is not None:
+                code = self.session_codes.get(session_id)
+                if code is None:
+                    return []
+                mask = self.sessions[:n] == code
+                rows = np.flatnonzero(mask) if rows is None else rows[mask[rows]]
+            if rows is None:
+                scores = self.vectors[:n] @ vector
+            else:
+                if not len(rows):
+                    return []
+                scores = self.vectors[rows] @ vector
+            k = min(k, len(scores))
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            rowids = self.ids[top] if rows is None else self.ids[rows[top]]
+            return [(float(scores[i]), int(r)) for i, r in zip(top, rowids)]
+
+    def flush(self):
+        with self._lock:
+            self.vectors.flush()
+            self.ids.flush()
+
+    def stats(self):
+        return {
+            'vectors': self.count,
+            'capacity': len(self.ids),
+            'dim': self.dim,
+            'ivf_lists': 0 if self.centroids is None else len(self.centroids),
+            'bytes_on_disk': len(self.ids) * (self.dim * 4 + 8),
+        }
+
 # RAG Memory System
 class RAGMemory:
-    def __init__(self):
-        self.keyword_index = defaultdict(list)
+    SEARCH_MODES = ('keyword', 'vector', 'hybrid')
+    
+    def __init__(self, embedder=None):
+        self.index = KeywordIndex()
+        self.listeners = []
+        self.embedder = None
+        self.vectors = None
+        if np is not None:
+            self.embedder = embedder or HashingEmbedder()
+            # The memory-mapped file is private to each worker process
+            path = f"{CONTEXT_DB}.{WORKER_ID}" if WORKER_ID else CONTEXT_DB
+            self.vectors = VectorIndex(path, self.embedder.dim)
         self.load_memory_index()
     
     def extract_keywords(self, text):
         """Extract keywords from text using simple regex"""
         # Remove common words and extract meaningful terms
-        common_words = {'the', 'is', 'at', 'which', 'on', 'and', 'a', 'to', 'are', 'as', 'was', 'with', 'for', 'be', 'have', 'this', 'that', 'will', 'you', 'they', 'of', 'it', 'in', 'or', 'an', 'what', 'when', 'where', 'how', 'why', 'who'}
         words = re.findall(r'\b[a-zA-Z]{3,}\b', text.lower())
-        return [word for word in words if word not in common_words]
+        return [word for word in words if word not in STOP_WORDS]
     
     def store_memory(self, session_id, content, importance=1):
         """Store content in RAG memory with keyword indexing"""
-        memory_id = hashlib.md5(f"{session_id}_{content}_{datetime.now()}".encode()).hexdigest()
+        ts = now_ms()
+        memory_id = hashlib.md5(f"{session_id}_{content}_{ts}".encode()).hexdigest()
         keywords = self.extract_keywords(content)
         
-        conn = sqlite3.connect(CONTEXT_DB)
-        c = conn.cursor()
+        def index(doc_id):
+            # Update in-memory indexes once the row is committed
+            self.index.add(doc_id, keywords, session_id, importance, ts / 1000)
+            if self.vectors is not None:
+                self.vectors.add(doc_id, self.embedder.embed(content), session_id)
+            for callback in self.listeners:
+                callback(session_id, local=True)
         
-        c.execute("""INSERT OR REPLACE INTO rag_memory 
-                    (id, session_id, content, keywords, timestamp, importance) 
-                    VALUES (?, ?, ?, ?, ?, ?)""",
-                 (memory_id, session_id, content, ' '.join(keywords), 
-                  datetime.now().isoformat(), importance))
+        write_behind.submit("""INSERT OR REPLACE INTO rag_memory 
+                               (id, session_id, content, keywords, ts, importance) 
+                               VALUES (?, ?, ?, ?, ?, ?)""",
+                            (memory_id, session_id, content, ' '.join(keywords), 
+                             ts, importance), key=session_id, callback=index)
+    
+    def subscribe(self, callback):
+        """Register callback(session_id, local), called after a memory is committed.
+
+        local is False for memories stored by another worker process.
+        """
+        self.listeners.append(callback)
+    
+    def index_rows(self, rowids):
+        """Add rows committed by another worker to the in-memory indexes"""
+        sessions = set()
+        for start in range(0, len(rowids), 500):
+            chunk = rowids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for doc_id, session_id, keywords, importance, ts, content in db.query(
+                    f"""SELECT doc_id, session_id, keywords, importance, ts, content
+                        FROM rag_memory WHERE doc_id IN ({placeholders})""", chunk):
+                self.index.add(doc_id, keywords.split() if keywords else [], session_id, importance, ts / 1000)
+                if self.vectors is not None:
+                    self.vectors.add(doc_id, self.embedder.embed(content), session_id)
+                sessions.add(session_id)
+        for session_id in sessions:
+            for callback in self.listeners:
+                callback(session_id, local=False)
+    
+    def forget(self, rowids):
+        """Drop deleted rag_memory rows from the in-memory indexes"""
+        self.index.remove(rowids)
+        if self.vectors is not None:
+            self.vectors.remove(rowids)
+    
+    def search_memory(self, query, session_id=None, limit=5, match_all=False, mode=None):
+        """Search memory, recording latency and result count"""
+        mode = mode or MEMORY_SEARCH_MODE
+        if self.vectors is None:
+            mode = 'keyword'
+        start = time.perf_counter()
+        results = self._search_memory(query, session_id, limit, match_all, mode)
+        rag_search_seconds.observe(time.perf_counter() - start, mode)
+        rag_search_results.observe(len(results), mode)
+        return results
+    
+    def _search_memory(self, query, session_id, limit, match_all, mode):
+        """Search memory by keyword, embedding similarity or both.
+
+        Keyword ranking comes from the in-memory posting lists when they cover
+        every stored memory, otherwise from the FTS5 index with BM25; either
+        way it is boosted by importance and recency, and with match_all only
+        memories containing every keyword qualify.  Vector ranking uses cosine
+        similarity of hashed n-gram embeddings.  Hybrid merges both rankings
+        with reciprocal rank fusion.
+        """
+        query_keywords = list(dict.fromkeys(self.extract_keywords(query)))
+        if session_id:
+            write_behind.wait_for(session_id)
+        else:
+            write_behind.drain()
         
-        conn.commit()
-        conn.close()
+        if not query_keywords and (mode == 'keyword' or not query.strip()):
+            if session_id:
+                results = db.query("""SELECT content, importance, ts FROM rag_memory 
+                                     WHERE session_id = ?
+                                     ORDER BY importance DESC, ts DESC LIMIT ?""",
+                                   (session_id, limit))
+            else:
+                results = db.query("""SELECT content, importance, ts FROM rag_memory 
+                                     ORDER BY importance DESC, ts DESC LIMIT ?""",
+                                   (limit,))
+            return [{'content': r[0], 'importance': r[1], 'timestamp': ms_to_iso(r[2])} for r in results]
         
-        # Update in-memory index
-        for keyword in keywords:
-            self.keyword_index[keyword].append({
-                'id': memory_id,
-                'content': content,
-                'importance': importance,
-                'timestamp': datetime.now().isoformat()
-            })
+        if mode == 'keyword':
+            rowids = self.keyword_hits(query_keywords, session_id, limit, match_all)
+        elif mode == 'vector':
+            rowids = self.vector_hits(query, session_id, limit)
+        else:
+            fused = defaultdict(float)
+            keyword_ranking = self.keyword_hits(query_keywords, session_id, limit * 2, match_all)
+            vector_ranking = self.vector_hits(query, session_id, limit * 2)
+            if match_all:
+                # Only memories containing every keyword qualify, as in keyword mode
+                allowed = set(keyword_ranking)
+                vector_ranking = [rowid for rowid in vector_ranking if rowid in allowed]
+            for ranking in (keyword_ranking, vector_ranking):
+                for rank, rowid in enumerate(ranking):
+                    fused[rowid] += 1.0 / (60 + rank)
+            rowids = heapq.nlargest(limit, fused, key=fused.get)
+        return self.load_rows(rowids)
     
-    def search_memory(self, query, session_id=None, limit=5):
-        """Search memory using keyword matching"""
-        query_keywords = self.extract_keywords(query)
-        
-        conn = sqlite3.connect(CONTEXT_DB)
-        c = conn.cursor()
+    def keyword_hits(self, query_keywords, session_id, limit, match_all):
+        """Rank rowids by keyword relevance"""
+        if not query_keywords:
+            return []
+        if self.index.complete:
+            return [doc_id for _, doc_id in self.index.search(query_keywords, session_id, limit, match_all)]
+        return self.search_fts(query_keywords, session_id, limit, match_all)
+    
+    def vector_hits(self, query, session_id, limit):
+        """Rank rowids by embedding similarity"""
+        hits = self.vectors.search(self.embedder.embed(query), limit, session_id)
+        return [rowid for score, rowid in hits if score >= VECTOR_MIN_SIMILARITY]
+    
+    def load_rows(self, rowids):
+        """Fetch memory rows for ranked rowids, preserving rank order"""
+        if not rowids:
+            return []
+        placeholders = ','.join('?' * len(rowids))
+        rows = {r[0]: r[1:] for r in db.query(
+            f"SELECT doc_id, content, importance, ts FROM rag_memory WHERE doc_id IN ({placeholders})",
+            rowids)}
+        return [{'content': rows[i][0], 'importance': rows[i][1], 'timestamp': ms_to_iso(rows[i][2])}
+                for i in rowids if i in rows]
+    
+    def search_fts(self, query_keywords, session_id, limit, match_all):
+        """Rank rowids with BM25 over the FTS5 index"""
+        operator = ' AND ' if match_all else ' OR '
+        fts_query = operator.join(f'"{kw}"' for kw in query_keywords)
+        candidates = limit * MEMORY_CANDIDATE_FACTOR
         
         if session_id:
-            c.execute("""SELECT content, importance, timestamp FROM rag_memory 
-                        WHERE session_id = ? AND keywords LIKE ?
-                        ORDER BY importance DESC, timestamp DESC LIMIT ?""",
-                     (session_id, f"%{' '.join(query_keywords)}%", limit))
+            results = db.query("""SELECT m.doc_id, m.importance, m.ts, bm25(rag_memory_fts)
+                                 FROM rag_memory_fts JOIN rag_memory m ON m.doc_id = rag_memory_fts.rowid
+                                 WHERE rag_memory_fts MATCH ? AND m.session_id = ?
+                                 ORDER BY bm25(rag_memory_fts) LIMIT ?""",
+                               (fts_query, session_id, candidates))
+        else:
+            results = db.query("""SELECT m.doc_id, m.importance, m.ts, bm25(rag_memory_fts)
+                                 FROM rag_memory_fts JOIN rag_memory m ON m.doc_id = rag_memory_fts.rowid
+                                 WHERE rag_memory_fts MATCH ?
+                                 ORDER BY bm25(rag_memory_fts) LIMIT ?""",
+                               (fts_query, candidates))
+        
+        now = time.time()
+        ranked = sorted(results, key=lambda r: rank_score(-r[3], r[1], r[2] / 1000, now),
+                        reverse=True)
+        return [r[0] for r in ranked[:limit]]
+    
+    def store_knowledge(self, topic, content, source="user"):
+        """Store persistent knowledge"""
+        write_behind.submit("""INSERT OR REPLACE INTO knowledge_base 
+                               (topic, content, source, ts) VALUES (?, ?, ?, ?)""",
+                            (topic, content, source, now_ms()), key='knowledge_base')
+    
+    def get_knowledge(self, topic):
+        """Retrieve knowledge about topics starting with `topic`, else containing it anywhere
+
+        The prefix lookup is a range search on the knowledge_base_topic
+        (NOCASE) index; only when it finds nothing is every topic scanned
+        for a substring match.
+        """
+        write_behind.wait_for('knowledge_base')
+        pattern = re.sub(r'([%_\\])', r'\\\1', topic)
+        sql = "SELECT content, source, ts FROM knowledge_base WHERE topic LIKE ? ESCAPE '\\'"
+        results = db.query(sql, (f"{pattern}%",)) or db.query(sql, (f"%{pattern}%",))
+        
+        return [{'content': r[0], 'source': r[1], 'timestamp': ms_to_iso(r[2])} for r in results]
+    
+    def load_memory_index(self):
+        """Load memory index on startup"""
+        try:
+            rows = db.query("SELECT doc_id, session_id, keywords, importance, ts FROM rag_memory ORDER BY doc_id")
+            
+            # Build aside and swap, so a reload never serves a half-filled index
+            index = KeywordIndex()
+            for doc_id, session_id, keywords_str, importance, ts in rows:
+                keywords = keywords_str.split() if keywords_str else []
+                index.add(doc_id, keywords, session_id, importance, ts / 1000)
+            self.index = index
+            
+            if self.vectors is not None:
+                self.sync_vectors(rows)
+        except Exception as e:
+            print(f"Warning: Could not load memory index: {e}")
+    
+    def sync_vectors(self, rows):
+        """Reconcile the persisted vector file with rag_memory after a restart"""
+        live = {row[0]: row[1] for row in rows}
+        stale = [rowid for rowid in self.vectors.positions if rowid not in live]
+        self.vectors.remove(stale)
+        missing = [rowid for rowid in live if rowid not in self.vectors.positions]
+        for rowid, session_id in live.items():
+            self.vectors.set_session(rowid, session_id)
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for rowid, content in db.query(
+                    f"SELECT doc_id, content FROM rag_memory WHERE doc_id IN ({placeholders})", chunk):
+                self.vectors.add(rowid, self.embedder.embed(content), live[rowid])
+        self.vectors.flush()
+
+# Initialize RAG Memory
+rag_memory = RAGMemory()
+
+# Per-session context cache
+class SessionContextCache:
+    """Bounded LRU cache of each session's most recent conversation turns.
+
+    save_context writes through to it, so after a session's first load a
+    chat turn reads its history without touching SQLite.  Sessions are
+    evicted least-recently-used once either the session count or the
+    approximate byte size exceeds its cap.
+    """
+
+    ENTRY_OVERHEAD = 120  # Rough per-turn bytes on top of the text itself
+
+    def __init__(self, max_turns=CONTEXT_CACHE_TURNS, max_sessions=CONTEXT_CACHE_SESSIONS,
+                 max_bytes=CONTEXT_CACHE_BYTES):
+        self.max_turns = max_turns
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _size(self, turn):
+        return len(turn[0]) + len(turn[1]) + self.ENTRY_OVERHEAD
+
+    def turns(self, session_id, limit):
+        """Return up to limit (message, role) pairs, oldest first"""
+        with self._lock:
+            cached = self._sessions.get(session_id)
+            if cached is not None:
+                self._sessions.move_to_end(session_id)
+                self.hits += 1
+                return list(cached)[-limit:]
+            self.misses += 1
+            writes = self._writes
+        write_behind.wait_for(session_id)
+        rows = db.query("SELECT message, role FROM context WHERE session_id = ? ORDER BY ts DESC, id DESC LIMIT ?",
+                        (session_id, self.max_turns))
+        turns = deque(((m or '', r or '') for m, r in reversed(rows)), maxlen=self.max_turns)
+        with self._lock:
+            # Only cache the snapshot if no turn was saved while it was being read
+            if writes == self._writes and session_id not in self._sessions:
+                self._sessions[session_id] = turns
+                self._bytes += sum(self._size(t) for t in turns)
+                self._evict()
+        return list(turns)[-limit:]
+
+    def append(self, session_id, role, message):
+        """Write-through for a newly saved turn"""
+        turn = (message or '', role or '')
+        with self._lock:
+            self._writes += 1
+            cached = self._sessions.get(session_id)
+            if cached is None:
+                return
+            if len(cached) == cached.maxlen:
+                self._bytes -= self._size(cached[0])
+            cached.append(turn)
+            self._bytes += self._size(turn)
+            self._sessions.move_to_end(session_id)
+            self._evict()
+
+    def invalidate(self, session_ids):
+        """Forget cached sessions whose stored turns were deleted"""
+        with self._lock:
+            self._writes += 1
+            for session_id in session_ids:
+                turns = self._sessions.pop(session_id, None)
+                if turns is not None:
+                    self._bytes -= sum(self._size(t) for t in turns)
+
+    def clear(self):
+        """Forget every cached session"""
+        with self._lock:
+            self._writes += 1
+            self._sessions.clear()
+            self._bytes = 0
+
+    def _evict(self):
+        while self._sessions and (len(self._sessions) > self.max_sessions or self._bytes > self.max_bytes):
+            _, turns = self._sessions.popitem(last=False)
+            self._bytes -= sum(self._size(t) for t in turns)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'sessions': len(self._sessions),
+                'approx_bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+context_cache = SessionContextCache()
+
+# Token-budgeted prompt assembly
+class TokenEstimator:
+    """Cheap per-model token counts without loading a tokenizer.
+
+    Text is split into word pieces and punctuation, which tracks BPE/SentencePiece
+    counts closely for prose and code.  The raw count for a piece of text is
+    cached, and each model gets a correction ratio learned from the
+    prompt_eval_count Ollama reports after every generation.
+    """
+
+    MESSAGE_OVERHEAD = 4  # Role markers and separators added by chat templates
+    MIN_RATIO, MAX_RATIO = 0.5, 4.0
+    # Ollama leaves KV-cache-reused prefix tokens out of prompt_eval_count, so a
+    # count well below the estimate means a cached prefix, not a denser tokenizer
+    CACHE_REUSE_FRACTION = 0.6
+    PIECE_RE = re.compile(r"\w+|[^\w\s]")
+
+    def __init__(self, cache_size=4096):
+        self.ratios = {}
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def raw_count(self, text):
+        with self._lock:
+            count = self._cache.get(text)
+            if count is not None:
+                self._cache.move_to_end(text)
+                return count
+        # Long words are split into several sub-word tokens
+        count = sum(1 + (len(piece) - 1) // 6 for piece in self.PIECE_RE.findall(text))
+        with self._lock:
+            self._cache[text] = count
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return count
+
+    def count(self, model, text):
+        return math.ceil(self.raw_count(text) * self.ratios.get(model, 1.0))
+
+    def count_message(self, model, message):
+        return self.count(model, message['content']) + self.MESSAGE_OVERHEAD
+
+    def calibrate(self, model, estimated, actual):
+        """Move the model's ratio toward what Ollama actually counted"""
+        if not estimated or not actual or actual < estimated * self.CACHE_REUSE_FRACTION:
+            return
+        with self._lock:
+            ratio = self.ratios.get(model, 1.0)
+            observed = ratio * actual / estimated
+            self.ratios[model] = min(self.MAX_RATIO, max(self.MIN_RATIO, 0.8 * ratio + 0.2 * observed))
+
+    def stats(self):
+        with self._lock:
+            return {'cached_texts': len(self._cache), 'model_ratios': dict(self.ratios)}
+
+token_estimator = TokenEstimator()
+
+class PromptTooLong(Exception):
+    """The user's message alone does not fit in the model's prompt budget"""
+
+class PromptBuilder:
+    """Fills a model's context window from a token budget.
+
+    The budget is the model's num_ctx minus PROMPT_RESPONSE_RESERVE.  The
+    current message is always included; memories then take up to
+    PROMPT_MEMORY_SHARE of what is left, in retrieval order; history turns
+    are ranked by recency and by term overlap with the message and admitted
+    whole until the budget runs out.  Selected turns keep their original order.
+    """
+
+    def __init__(self, estimator=token_estimator):
+        self.estimator = estimator
+        self.built = 0
+        self.prompt_tokens = 0
+        self.turns_dropped = 0
+        self.memories_dropped = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def num_ctx(model):
+        return MODEL_NUM_CTX.get(model, NUM_CTX)
+
+    def budget(self, model):
+        return max(0, self.num_ctx(model) - PROMPT_RESPONSE_RESERVE)
+
+    @staticmethod
+    def terms(text):
+        return {w for w in re.findall(r'\w+', text.lower()) if len(w) > 2 and w not in STOP_WORDS}
+
+    def build(self, model, message, history, memories):
+        """Return (messages, prompt_tokens) for a chat request.
+
+        history is a list of (content, role) pairs, oldest first; memories
+        is a list of memory contents, most relevant first.
+        """
+        count = self.estimator.count
+        overhead = self.estimator.MESSAGE_OVERHEAD
+        budget = self.budget(model)
+        used = count(model, message) + overhead
+        if used > budget:
+            raise PromptTooLong(f'Message is too long for {model}: about {used} tokens, '
+                                f'the limit is {budget}')
+
+        header = "\n\nRelevant context from memory:\n"
+        memory_lines = []
+        memory_budget = int((budget - used) * PROMPT_MEMORY_SHARE)
+        memory_used = count(model, header)
+        for content in memories:
+            line = f"- {content}\n"
+            cost = count(model, line)
+            if memory_used + cost > memory_budget:
+                continue
+            memory_lines.append(line)
+            memory_used += cost
+        if memory_lines:
+            used += memory_used
+
+        query_terms = self.terms(message)
+        ranked = []
+        for age, (content, role) in enumerate(reversed(history)):
+            recency = 0.5 ** (age / PROMPT_TURN_HALF_LIFE)
+            relevance = len(query_terms & self.terms(content)) / len(query_terms) if query_terms else 0.0
+            ranked.append((recency * (1 + relevance), age, content, role))
+        ranked.sort(key=lambda r: (-r[0], r[1]))
+        chosen = []
+        for _, age, content, role in ranked:
+            cost = count(model, content) + overhead
+            if used + cost > budget:
+                continue
+            chosen.append((age, content, role))
+            used += cost
+        chosen.sort(reverse=True)
+
+        messages = [{"role": role, "content": content} for _, content, role in chosen]
+        messages.append({"role": "user", "content": message + (header + ''.join(memory_lines) if memory_lines else '')})
+        with self._lock:
+            self.built += 1
+            self.prompt_tokens += used
+            self.turns_dropped += len(history) - len(chosen)
+            self.memories_dropped += len(memories) - len(memory_lines)
+        return messages, used
+
+    def stats(self):
+        with self._lock:
+            return {
+                'prompts_built': self.built,
+                'avg_prompt_tokens': self.prompt_tokens / self.built if self.built else 0.0,
+                'turns_dropped': self.turns_dropped,
+                'memories_dropped': self.memories_dropped,
+                'estimator': self.estimator.stats(),
+            }
+
+prompt_builder = PromptBuilder()
+
+# Ollama client
+class OllamaError(Exception):
+    """Ollama answered with a non-200 status"""
+
+    def __init__(self, status):
+        super().__init__(f"Ollama error: {status}")
+        self.status = status
+
+class OllamaClient:
+    """Blocking Ollama client over a pooled keep-alive requests.Session.
+
+    The read timeout bounds the gap between streamed chunks rather than the
+    whole generation, so long answers are fine as long as tokens keep coming.
+    """
+
+    def __init__(self, base_url=OLLAMA_BASE_URL, pool_size=OLLAMA_POOL_SIZE,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def tags(self, timeout=None):
+        """List installed models"""
+        start = time.perf_counter()
+        response = self.session.get(f"{self.base_url}/api/tags",
+                                    timeout=timeout or self.timeout)
+        ollama_request_seconds.observe(time.perf_counter() - start, 'tags')
+        if response.status_code != 200:
+            raise OllamaError(response.status_code)
+        return response.json()
+
+    def chat(self, payload):
+        """Open a streaming /api/chat request; iterate it with iter_chunks()"""
+        start = time.perf_counter()
+        try:
+            return self.session.post(f"{self.base_url}/api/chat", json=payload,
+                                     stream=True, timeout=self.timeout)
+        finally:
+            ollama_request_seconds.observe(time.perf_counter() - start, 'chat')
+
+    @staticmethod
+    def iter_chunks(response):
+        """Yield decoded NDJSON chunks until the final 'done' chunk.
+
+        The rest of the body is drained afterwards so the connection goes
+        back to the pool instead of being discarded.
+        """
+        lines = response.iter_lines()
+        for line in lines:
+            if not line:
+                continue
+            try:
+                chunk = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            yield chunk
+            if chunk.get('done', False):
+                break
+        for _ in lines:
+            pass
+
+    def close(self):
+        self.session.close()
+
+class AsyncOllamaClient:
+    """asyncio counterpart of OllamaClient built on aiohttp (optional dependency)"""
+
+    def __init__(self, base_url=OLLAMA_BASE_URL, pool_size=OLLAMA_POOL_SIZE,
+                 connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT):
+        if aiohttp is None:
+            raise RuntimeError("AsyncOllamaClient requires aiohttp (pip install aiohttp)")
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._session = None
+
+    def _get_session(self):
+        # Created lazily so it binds to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def tags(self):
+        async with self._get_session().get(f"{self.base_url}/api/tags") as response:
+            if response.status != 200:
+                raise OllamaError(response.status)
+            return await response.json()
+
+    async def chat_stream(self, payload, on_headers=None):
+        """Async generator of decoded NDJSON chunks from a streaming /api/chat"""
+        start = time.perf_counter()
+        async with self._get_session().post(f"{self.base_url}/api/chat", json=payload) as response:
+            ollama_request_seconds.observe(time.perf_counter() - start, 'chat')
+            if on_headers:
+                on_headers()
+            if response.status != 200:
+                raise OllamaError(response.status)
+            async for line in response.content:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    chunk = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                yield chunk
+                if chunk.get('done', False):
+                    break
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+ollama = OllamaClient()
+
+class ModelLabels:
+    """Bounded values for the model label on per-model metrics.
+
+    A chat's model name comes straight from the client, so labelling with
+    it verbatim would let anyone create unlimited time series.  Models that
+    Ollama lists in /api/tags keep their name and everything else is
+    'other'.  The installed set is updated from every /api/models call and,
+    when an unknown name shows up, refreshed on a background thread at most
+    every MODEL_LABEL_REFRESH_S, so a lookup never blocks on Ollama.
+    """
+
+    OTHER = 'other'
+
+    def __init__(self, refresh_interval=MODEL_LABEL_REFRESH_S):
+        self.refresh_interval = refresh_interval
+        self.known = frozenset()
+        self._last_refresh = -math.inf
+        self._lock = threading.Lock()
+
+    def update(self, tags):
+        self.known = frozenset(m['name'] for m in tags.get('models', ()) if m.get('name'))
+
+    def refresh(self):
+        try:
+            self.update(ollama.tags(timeout=10))
+        except Exception as e:
+            print(f"Could not list Ollama models for metric labels: {e}")
+
+    def label(self, model):
+        if model in self.known:
+            return model
+        with self._lock:
+            due = time.monotonic() - self._last_refresh >= self.refresh_interval
+            if due:
+                self._last_refresh = time.monotonic()
+        if due:
+            threading.Thread(target=self.refresh, name='model-labels', daemon=True).start()
+        return self.OTHER
+
+model_labels = ModelLabels()
+
+# Generation scheduling
+class QueueFullError(Exception):
+    """The generation queue is at capacity"""
+
+class GenerationCancelled(Exception):
+    """The generation was cancelled while waiting for a slot"""
+
+class _Ticket:
+    __slots__ = ('granted',)
+
+    def __init__(self):
+        self.granted = False
+
+class GenerationScheduler:
+    """Limits in-flight generations per model and queues the overflow fairly.
+
+    Waiting requests are grouped by session and slots are handed out
+    round-robin across sessions, so one user sending a burst cannot starve
+    the others.  Once GENERATION_QUEUE_SIZE requests are waiting, new ones
+    are rejected with QueueFullError.
+    """
+
+    def __init__(self, max_per_model=MAX_GENERATIONS_PER_MODEL, queue_size=GENERATION_QUEUE_SIZE,
+                 overrides=MODEL_CONCURRENCY):
+        self.max_per_model = max_per_model
+        self.queue_size = queue_size
+        self.overrides = overrides
+        self.running = defaultdict(int)
+        self.waiting = defaultdict(OrderedDict)  # model -> session_id -> deque of tickets
+        self.queued = 0
+        self._cond = threading.Condition()
+        self._wakers = set()  # Callbacks waking coroutines in acquire_async
+        self.admitted = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def limit(self, model):
+        return self.overrides.get(model, self.max_per_model)
+
+    @contextmanager
+    def slot(self, model, session_id, on_queued=None, cancelled=None):
+        """Hold a generation slot for the duration of the block.
+
+        on_queued(position) is called from the waiting thread whenever the
+        request's 1-based queue position changes.  If the cancelled event is
+        set while waiting, the request leaves the queue and
+        GenerationCancelled is raised.
+        """
+        self.acquire(model, session_id, on_queued, cancelled)
+        try:
+            yield
+        finally:
+            self.release(model)
+
+    @asynccontextmanager
+    async def slot_async(self, model, session_id, on_queued=None, cancelled=None):
+        """slot() for coroutines: waiting for a slot suspends instead of blocking a thread"""
+        await self.acquire_async(model, session_id, on_queued, cancelled)
+        try:
+            yield
+        finally:
+            self.release(model)
+
+    def acquire(self, model, session_id, on_queued=None, cancelled=None):
+        start = time.monotonic()
+        with self._cond:
+            ticket = self._enqueue(model, session_id)
+        if ticket is None:
+            return
+        reported = None
+        while True:
+            with self._cond:
+                position = self._poll(model, session_id, ticket, cancelled, start)
+                if position is None:
+                    return
+                if position == reported:
+                    self._cond.wait(1.0)
+                    continue
+            reported = position
+            if on_queued:
+                on_queued(position)
+
+    async def acquire_async(self, model, session_id, on_queued=None, cancelled=None):
+        """acquire() for coroutines; on_queued may be a coroutine function"""
+        start = time.monotonic()
+        with self._cond:
+            ticket = self._enqueue(model, session_id)
+        if ticket is None:
+            return
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        wake = lambda: loop.call_soon_threadsafe(changed.set)
+        with self._cond:
+            self._wakers.add(wake)
+        try:
+            reported = None
+            while True:
+                changed.clear()
+                with self._cond:
+                    position = self._poll(model, session_id, ticket, cancelled, start)
+                if position is None:
+                    return
+                if position != reported:
+                    reported = position
+                    if on_queued:
+                        await on_queued(position)
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            with self._cond:
+                if ticket.granted:
+                    self.release(model)
+                else:
+                    self._withdraw(model, session_id, ticket)
+            raise
+        finally:
+            with self._cond:
+                self._wakers.discard(wake)
+
+    def _enqueue(self, model, session_id):
+        # Called with the lock held; returns None when admitted straight away
+        if self.running[model] < self.limit(model) and not self.waiting[model]:
+            self.running[model] += 1
+            self._admitted(0.0)
+            return None
+        if self.queued >= self.queue_size:
+            self.rejected += 1
+            raise QueueFullError()
+        ticket = _Ticket()
+        self.waiting[model].setdefault(session_id, deque()).append(ticket)
+        self.queued += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queued)
+        return ticket
+
+    def _poll(self, model, session_id, ticket, cancelled, start):
+        # Called with the lock held; None once granted, else the queue position
+        if ticket.granted:
+            self._admitted(time.monotonic() - start)
+            return None
+        if cancelled is not None and cancelled.is_set():
+            self._withdraw(model, session_id, ticket)
+            raise GenerationCancelled()
+        return self._position(model, session_id, ticket)
+
+    def _position(self, model, session_id, ticket):
+        # Round-robin order: every session's first ticket, then every second ticket, ...
+        depth = self.waiting[model][session_id].index(ticket)
+        ahead = depth
+        before = True
+        for sid, tickets in self.waiting[model].items():
+            if sid == session_id:
+                before = False
+            else:
+                ahead += min(len(tickets), depth + 1 if before else depth)
+        return ahead + 1
+
+    def _withdraw(self, model, session_id, ticket):
+        tickets = self.waiting[model][session_id]
+        tickets.remove(ticket)
+        if not tickets:
+            del self.waiting[model][session_id]
+        self.queued -= 1
+        self.cancelled += 1
+        self._notify()
+
+    def wake(self):
+        """Wake waiting requests so they notice cancellation"""
+        with self._cond:
+            self._notify()
+
+    def _notify(self):
+        self._cond.notify_all()
+        for wake in self._wakers:
+            wake()
+
+    def _admitted(self, waited):
+        self.admitted += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+
+    def release(self, model):
+        with self._cond:
+            self.running[model] -= 1
+            sessions = self.waiting[model]
+            if sessions and self.running[model] < self.limit(model):
+                session_id, tickets = next(iter(sessions.items()))
+                ticket = tickets.popleft()
+                del sessions[session_id]
+                if tickets:
+                    sessions[session_id] = tickets  # Back of the rotation
+                ticket.granted = True
+                self.running[model] += 1
+                self.queued -= 1
+            self._notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'in_flight': {m: n for m, n in self.running.items() if n},
+                'queue_depth': self.queued,
+                'max_queue_depth': self.max_queue_depth,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'cancelled': self.cancelled,
+                'avg_wait_seconds': self.total_wait / self.admitted if self.admitted else 0.0,
+                'max_wait_seconds': self.max_wait,
+            }
+
+scheduler = GenerationScheduler()
+
+class Generation:
+    """An in-flight generation that can be cancelled from another thread"""
+
+    def __init__(self, request_id, sid):
+        self.request_id = request_id
+        self.sid = sid
+        self.cancelled = threading.Event()
+        self.response = None
+        self.task = None  # asyncio task streaming this generation in async mode
+        self.started = time.time()
+
+    def cancel(self):
+        self.cancelled.set()
+        scheduler.wake()
+        task = self.task
+        if task is not None:
+            # Interrupt an await on Ollama; re-checked on the loop in case streaming already ended
+            task.get_loop().call_soon_threadsafe(lambda: self.task is not None and self.task.cancel())
+        response = self.response
+        if response is not None:
+            # Shut the socket down so a read blocked waiting on Ollama
+            # returns at once and Ollama sees the client go away
+            conn = getattr(response.raw, '_connection', None)
+            sock = getattr(conn, 'sock', None)
+            try:
+                if sock is not None:
+                    sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class GenerationRegistry:
+    """Active generations by request id, so clients can stop them"""
+
+    def __init__(self):
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def start(self, request_id, sid):
+        generation = Generation(request_id, sid)
+        with self._lock:
+            self._active[request_id] = generation
+        return generation
+
+    def finish(self, request_id):
+        with self._lock:
+            self._active.pop(request_id, None)
+
+    def cancel(self, request_id, sid):
+        """Cancel one generation owned by the given socket"""
+        with self._lock:
+            generation = self._active.get(request_id)
+        if generation is None or generation.sid != sid:
+            return False
+        generation.cancel()
+        return True
+
+    def cancel_sid(self, sid):
+        """Cancel every generation started by a socket"""
+        with self._lock:
+            owned = [g for g in self._active.values() if g.sid == sid]
+        for generation in owned:
+            generation.cancel()
+        return len(owned)
+
+    def __len__(self):
+        return len(self._active)
+
+generations = GenerationRegistry()
+
+# Token streaming to the browser
+class StreamFlusher:
+    """Sends coalesced frames whose STREAM_FLUSH_MS is up while Ollama is quiet.
+
+    A TokenCoalescer only looks at the clock when a token arrives, so a
+    frame left pending before a pause would otherwise wait for the next
+    token.  In threading mode, where the read loop blocks inside requests,
+    coalescers register each pending frame's deadline here; one thread and
+    one heap serve every stream rather than a timer per frame.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self.flushes = 0
+
+    def schedule(self, deadline, coalescer):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stream-flush', daemon=True)
+                self._thread.start()
+            self._seq += 1
+            heapq.heappush(self._heap, (deadline, self._seq, coalescer))
+            if self._heap[0][2] is coalescer:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, coalescer = heapq.heappop(self._heap)
+            try:
+                if coalescer.flush_due():
+                    self.flushes += 1
+            except Exception as e:
+                print(f"Deadline flush failed: {e}")
+
+stream_flusher = StreamFlusher()
+
+class TokenCoalescer:
+    """Collects streamed tokens and forwards them as response_token frames.
+
+    In "coalesce" mode tokens are batched and flushed once STREAM_FLUSH_MS
+    has passed since the last frame or STREAM_FLUSH_BYTES have accumulated;
+    the first token is sent straight away so time-to-first-token is not
+    delayed.  A pending frame is also sent at its deadline if no token
+    arrives: through the StreamFlusher when one is given, otherwise the
+    caller's read loop waits no longer than `deadline`.  "token" mode sends
+    one frame per token.  The full response is accumulated as a list and
+    joined once.
+    """
+
+    def __init__(self, send, mode=STREAM_MODE, flush_ms=STREAM_FLUSH_MS, flush_bytes=STREAM_FLUSH_BYTES,
+                 flusher=None):
+        self.send = send
+        self.coalesce = mode == "coalesce"
+        self.flush_after = flush_ms / 1000
+        self.flush_bytes = flush_bytes
+        self.flusher = flusher
+        self.parts = []
+        self.pending = []
+        self.pending_bytes = 0
+        self.last_flush = None
+        self.closed = False
+        self._lock = threading.Lock()  # The flusher thread sends too
+
+    @property
+    def deadline(self):
+        """Monotonic time the pending frame is due, or None if nothing is pending"""
+        return self.last_flush + self.flush_after if self.pending else None
+
+    def push(self, token):
+        with self._lock:
+            self.parts.append(token)
+            if not self.coalesce:
+                self.send({'token': token})
+                return
+            starts_frame = not self.pending
+            self.pending.append(token)
+            self.pending_bytes += len(token)
+            now = time.monotonic()
+            if (self.last_flush is None or self.pending_bytes >= self.flush_bytes
+                    or now - self.last_flush >= self.flush_after):
+                self._flush(now)
+            elif starts_frame and self.flusher is not None:
+                self.flusher.schedule(self.last_flush + self.flush_after, self)
+
+    def flush(self, now=None):
+        with self._lock:
+            self._flush(now)
+
+    def flush_due(self):
+        """Send the pending frame if its deadline has passed; True if one was sent"""
+        with self._lock:
+            if self.closed or not self.pending or time.monotonic() < self.deadline:
+                return False
+            self._flush()
+            return True
+
+    def close(self):
+        """Drop anything still pending; no frame is sent after this"""
+        with self._lock:
+            self.closed = True
+            self.pending = []
+            self.pending_bytes = 0
+
+    def _flush(self, now=None):
+        if self.pending:
+            self.send({'token': ''.join(self.pending), 'count': len(self.pending)})
+            self.pending = []
+            self.pending_bytes = 0
+        self.last_flush = now or time.monotonic()
+
+    @property
+    def full_response(self):
+        return ''.join(self.parts)
+
+# Response cache for repeated prompts
+class ResponseCache:
+    """Stores finished responses keyed on the exact Ollama request.
+
+    The key hashes the model, the messages (whitespace-normalised) and the
+    options, so a hit means Ollama would have been sent an identical prompt.
+    Entries live in an in-memory LRU backed by the response_cache table;
+    expired entries are ignored on read and removed by the retention task.
+    Entries whose prompt included a session's memories are tagged with that
+    session and dropped when its memory changes.
+    """
+
+    def __init__(self, enabled=RESPONSE_CACHE_ENABLED, ttl=RESPONSE_CACHE_TTL,
+                 max_entries=RESPONSE_CACHE_ENTRIES, exclude_models=RESPONSE_CACHE_EXCLUDE_MODELS):
+        self.enabled = enabled
+        self.ttl_ms = ttl * 1000
+        self.max_entries = max_entries
+        self.exclude_models = exclude_models
+        self._entries = OrderedDict()  # key -> (response, prompt_tokens, session_id, ts)
+        self._queued = defaultdict(list)  # session_id -> [stale] flags of inserts still in write_behind
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.invalidations = 0
+
+    def usable(self, model):
+        return self.enabled and model not in self.exclude_models
+
+    @staticmethod
+    def key(payload):
+        messages = [{'role': m['role'], 'content': ' '.join(m['content'].split())}
+                    for m in payload['messages']]
+        canonical = json.dumps([payload['model'], messages, payload.get('options', {})],
+                               sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode()).hexdigest()
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """Return (response, prompt_tokens) for a live entry, or None"""
+        cutoff = now_ms() - self.ttl_ms
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[3] >= cutoff:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry[0], entry[1]
+                del self._entries[key]
+        write_behind.wait_for('response_cache')
+        rows = db.query("""SELECT response, prompt_tokens, session_id, ts FROM response_cache
+                           WHERE cache_key = ? AND ts >= ?""", (key, cutoff))
+        with self._lock:
+            if not rows:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, rows[0])
+        return rows[0][0], rows[0][1]
+
+    def put(self, key, model, response, prompt_tokens, session_id=None):
+        ts = now_ms()
+        stale = [False]
+        with self._lock:
+            self._remember(key, (response, prompt_tokens, session_id, ts))
+            self.stores += 1
+            if session_id is not None:
+                self._queued[session_id].append(stale)
+        
+        def committed(rowid):
+            # The session's memory changed while this insert sat in the queue,
+            # after invalidate_sessions had already deleted the session's rows
+            with self._lock:
+                queued = self._queued[session_id]
+                queued.remove(stale)
+                if not queued:
+                    del self._queued[session_id]
+            if stale[0]:
+                db.execute("DELETE FROM response_cache WHERE cache_key = ? AND ts = ?", (key, ts))
+        
+        write_behind.submit("""INSERT OR REPLACE INTO response_cache
+                               (cache_key, model, session_id, response, prompt_tokens, ts)
+                               VALUES (?, ?, ?, ?, ?, ?)""",
+                            (key, model, session_id, response, prompt_tokens, ts), key='response_cache',
+                            callback=committed if session_id is not None else None)
+
+    def invalidate_sessions(self, session_ids, persist=True):
+        """Drop entries built from these sessions' memories.
+
+        persist=False only clears this process's copy, for changes another
+        worker has already removed from the table.
+        """
+        if not self.enabled:
+            return
+        session_ids = set(session_ids)
+        with self._lock:
+            stale = [k for k, entry in self._entries.items() if entry[2] in session_ids]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+            # Inserts still queued would land after the DELETE below; their
+            # commit callback removes them instead
+            for session_id in session_ids & self._queued.keys():
+                for flag in self._queued[session_id]:
+                    flag[0] = True
+        if not persist:
+            return
+        # Called from the writer thread too, so this must not queue behind it
+        for session_id in session_ids:
+            db.execute("DELETE FROM response_cache WHERE session_id = ?", (session_id,))
+
+    def forget(self, keys):
+        """Drop rows removed by the retention task"""
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop this process's in-memory entries; the table is left alone"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries_in_memory': len(self._entries),
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'invalidations': self.invalidations,
+            }
+
+response_cache = ResponseCache()
+rag_memory.subscribe(lambda session_id, local: response_cache.invalidate_sessions([session_id], persist=local))
+
+# Function calling tools
+class ToolRegistry:
+    """Chat-command tools, registered with a decorator and dispatched in one regex pass.
+
+    Every tool pattern must have exactly one capturing group (the parameter).
+    The patterns are joined, with their groups made non-capturing, into one
+    case-insensitive alternation that finds where the leftmost command starts
+    in a single scan; only on a hit are the individual patterns tried, at
+    that position alone, to pick the tool (ties go to the tool registered
+    first).  Parameters are taken from the original message, so their case
+    is preserved.
+    """
+
+    def __init__(self):
+        self.tools = {}
+        self._scanner = None
+        self._patterns = []
+        self._lock = threading.Lock()
+
+    def register(self, name, pattern, description, example='', usage=None,
+                 timeout=None, max_concurrency=None):
+        """Decorator adding func as tool name, triggered by pattern"""
+        if re.compile(pattern).groups != 1:
+            raise ValueError(f"Tool pattern for {name!r} needs exactly one capturing group")
+
+        def decorator(func):
+            with self._lock:
+                self.tools[name] = {
+                    'function': func,
+                    'description': description,
+                    'pattern': pattern,
+                    'example': example,
+                    'usage': usage or example,
+                    'timeout': timeout or TOOL_TIMEOUT,
+                    'max_concurrency': max_concurrency or TOOL_MAX_CONCURRENCY,
+                }
+                self._scanner = None
+            return func
+        return decorator
+
+    @staticmethod
+    def _non_capturing(pattern):
+        # Python's re saves every group's marks on each branch attempt, which
+        # makes a combined alternation of capturing patterns quadratic in tools
+        out = []
+        i = 0
+        in_class = False
+        while i < len(pattern):
+            ch = pattern[i]
+            if ch == '\\':
+                out.append(pattern[i:i + 2])
+                i += 2
+                continue
+            if in_class:
+                in_class = ch != ']'
+            elif ch == '[':
+                in_class = True
+                if pattern[i + 1:i + 2] == ']':
+                    out.append('[]')
+                    i += 2
+                    continue
+            elif ch == '(':
+                if pattern[i + 1:i + 2] != '?':
+                    out.append('(?:')
+                    i += 1
+                    continue
+                named = re.match(r'\(\?P<\w+>', pattern[i:])
+                if named:
+                    out.append('(?:')
+                    i += len(named.group())
+                    continue
+            out.append(ch)
+            i += 1
+        return ''.join(out)
+
+    def _compile(self):
+        self._patterns = [(name, re.compile(tool['pattern'], re.IGNORECASE)) for name, tool in self.tools.items()]
+        alternatives = '|'.join(f"(?:{self._non_capturing(tool['pattern'])})" for tool in self.tools.values())
+        self._scanner = re.compile(alternatives or r'(?!)', re.IGNORECASE)
+        return self._scanner
+
+    def dispatch(self, message):
+        """Return (tool name, parameter) for the first command in message, or (None, None)"""
+        with self._lock:
+            scanner = self._scanner or self._compile()
+            patterns = self._patterns
+        message = message.strip()
+        found = scanner.search(message)
+        if not found:
+            return None, None
+        for name, pattern in patterns:
+            match = pattern.match(message, found.start())
+            if match:
+                return name, match.group(1).strip()
+        return None, None
+
+    def dispatch_all(self, message, limit=TOOL_MAX_CALLS_PER_MESSAGE):
+        """Return up to limit (tool name, parameter) calls, at most one per line"""
+        calls = []
+        for line in message.splitlines():
+            name, parameter = self.dispatch(line)
+            if name and parameter:
+                calls.append((name, parameter))
+                if len(calls) == limit:
+                    break
+        return calls
+
+tool_registry = ToolRegistry()
+TOOLS = tool_registry.tools
+
+class ToolContext:
+    """Per-call state for tool functions, read through current_tool_context()"""
+    __slots__ = ('session_id', 'request_id', 'on_output')
+
+    def __init__(self, session_id='default', request_id=None, on_output=None):
+        self.session_id = session_id
+        self.request_id = request_id
+        self.on_output = on_output  # callable(function_name, text) for incremental output
+
+_tool_context = contextvars.ContextVar('tool_context', default=ToolContext())
+
+def current_tool_context():
+    return _tool_context.get()
+
+class ToolTimeout(Exception):
+    pass
+
+class ToolsFailed(Exception):
+    """Every tool call in a message failed, so there is nothing to answer"""
+
+class ToolExecutor:
+    """Runs tool calls on a shared thread pool.
+
+    Each tool has a concurrency limit (a semaphore) and a timeout.  A call
+    that overruns its timeout is reported as failed straight away; Python
+    threads cannot be killed, so the call itself finishes in the background
+    (the Python tool's subprocess has its own limit) while holding its
+    tool's slot.  The ToolContext is carried into the worker with contextvars.
+    """
+
+    def __init__(self, registry, workers=TOOL_WORKERS):
+        self.registry = registry
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tool')
+        self._limits = {}
+        self._lock = threading.Lock()
+        self.counters = defaultdict(lambda: {'calls': 0, 'errors': 0, 'timeouts': 0, 'running': 0, 'seconds': 0.0})
+
+    def _limit(self, name):
+        with self._lock:
+            limit = self._limits.get(name)
+            if limit is None:
+                limit = self._limits[name] = threading.BoundedSemaphore(self.registry.tools[name]['max_concurrency'])
+            return limit
+
+    def _call(self, name, parameter, deadline):
+        tool = self.registry.tools[name]
+        limit = self._limit(name)
+        if not limit.acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise ToolTimeout(f"{name} is busy")
+        counters = self.counters[name]
+        start = time.perf_counter()
+        with self._lock:
+            counters['running'] += 1
+        outcome = 'error'
+        try:
+            result = tool['function'](parameter)
+            outcome = 'ok'
+            return result
+        finally:
+            limit.release()
+            elapsed = time.perf_counter() - start
+            tool_seconds.observe(elapsed, name, outcome)
+            with self._lock:
+                counters['running'] -= 1
+                counters['seconds'] += elapsed
+
+    def run(self, calls, context):
+        """Run (name, parameter) calls in parallel.
+
+        Yields (name, parameter, result, error) in completion order; error is
+        None on success and result is then the tool's return value.
+        """
+        pending = {}
+        for name, parameter in calls:
+            deadline = time.monotonic() + self.registry.tools[name]['timeout']
+            ctx = contextvars.copy_context()
+            ctx.run(_tool_context.set, context)
+            future = self.pool.submit(ctx.run, self._call, name, parameter, deadline)
+            pending[future] = (name, parameter, deadline)
+            with self._lock:
+                self.counters[name]['calls'] += 1
+        while pending:
+            next_deadline = min(d for _, _, d in pending.values())
+            done, _ = wait(pending, timeout=max(0.0, next_deadline - time.monotonic()),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                name, parameter, _ = pending.pop(future)
+                try:
+                    yield name, parameter, future.result(), None
+                except ToolTimeout as e:
+                    self._count(name, 'timeouts')
+                    yield name, parameter, None, str(e)
+                except Exception as e:
+                    self._count(name, 'errors')
+                    yield name, parameter, None, str(e)
+            now = time.monotonic()
+            for future, (name, parameter, deadline) in list(pending.items()):
+                if deadline <= now and not future.done():
+                    del pending[future]
+                    self._count(name, 'timeouts')
+                    yield name, parameter, None, f"timed out after {self.registry.tools[name]['timeout']}s"
+
+    def _count(self, name, counter):
+        with self._lock:
+            self.counters[name][counter] += 1
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(c) for name, c in self.counters.items()}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+tool_executor = ToolExecutor(tool_registry)
+
+# Weather service
+class WeatherError(Exception):
+    pass
+
+class WttrProvider:
+    """Current conditions from wttr.in over a keep-alive session"""
+    name = 'wttr'
+
+    def __init__(self, base_url="https://wttr.in", timeout=5):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def current(self, city):
+        response = self.session.get(f"{self.base_url}/{requests.utils.quote(city)}",
+                                    params={'format': '%C %t %h %w'}, timeout=self.timeout)
+        if response.status_code != 200:
+            raise WeatherError(f"HTTP {response.status_code}")
+        return response.text.strip()
+
+class StubWeatherProvider:
+    """Deterministic made-up weather for offline use and tests"""
+    name = 'stub'
+    CONDITIONS = ('Sunny', 'Partly cloudy', 'Overcast', 'Light rain', 'Mist', 'Snow')
+
+    def __init__(self, delay=0.0):
+        self.delay = delay  # Simulated upstream latency in seconds
+
+    def current(self, city):
+        if self.delay:
+            time.sleep(self.delay)
+        seed = zlib.crc32(city.lower().encode())
+        return (f"{self.CONDITIONS[seed % len(self.CONDITIONS)]} {seed % 45 - 10:+d}°C "
+                f"{seed % 60 + 40}% {seed % 30 + 2}km/h")
+
+WEATHER_PROVIDERS = {'wttr': WttrProvider, 'stub': StubWeatherProvider}
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class WeatherService:
+    """Caches provider results per city.
+
+    Results are fresh for WEATHER_TTL seconds.  Until WEATHER_STALE_TTL
+    they are still returned immediately while one background refresh runs.
+    Concurrent lookups of a city that is not cached share a single upstream
+    call (single flight).  Failures are not cached.
+    """
+
+    def __init__(self, provider=None, ttl=WEATHER_TTL, stale_ttl=WEATHER_STALE_TTL,
+                 max_entries=WEATHER_CACHE_SIZE):
+        self.provider = provider or WEATHER_PROVIDERS[WEATHER_PROVIDER]()
+        self.ttl = ttl
+        self.stale_ttl = max(stale_ttl, ttl)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # city key -> (text, fetched_at)
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.upstream_calls = 0
+        self.upstream_seconds = 0.0
+        self.upstream_max = 0.0
+
+    @staticmethod
+    def key(city):
+        return ' '.join(city.split()).casefold()
+
+    def lookup(self, city):
+        """Return the provider's text for city; raises on upstream failure"""
+        key = self.key(city)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                age = now - entry[1]
+                if age < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+                if age < self.stale_ttl:
+                    self._entries.move_to_end(key)
+                    self.stale_hits += 1
+                    if key not in self._flights:
+                        self._flights[key] = _Flight()
+                        threading.Thread(target=self._fetch, args=(key, city), daemon=True).start()
+                    return entry[0]
+            self.misses += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if leader:
+            self._fetch(key, city)
         else:
-            c.execute("""SELECT content, importance, timestamp FROM rag_memory 
-                        WHERE keywords LIKE ?
-                        ORDER BY importance DESC, timestamp DESC LIMIT ?""",
-                     (f"%{' '.join(query_keywords)}%", limit))
-        
-        results = c.fetchall()
-        conn.close()
-        
-        return [{'content': r[0], 'importance': r[1], 'timestamp': r[2]} for r in results]
-    
-    def store_knowledge(self, topic, content, source="user"):
-        """Store persistent knowledge"""
-        conn = sqlite3.connect(CONTEXT_DB)
-        c = conn.cursor()
-        
-        c.execute("""INSERT OR REPLACE INTO knowledge_base 
-                    (topic, content, source, timestamp) VALUES (?, ?, ?, ?)""",
-                 (topic, content, source, datetime.now().isoformat()))
-        
-        conn.commit()
-        conn.close()
-    
-    def get_knowledge(self, topic):
-        """Retrieve knowledge about a topic"""
-        conn = sqlite3.connect(CONTEXT_DB)
-        c = conn.cursor()
-        
-        c.execute("SELECT content, source, timestamp FROM knowledge_base WHERE topic LIKE ?",
-                 (f"%{topic}%",))
-        
-        results = c.fetchall()
-        conn.close()
-        
-        return [{'content': r[0], 'source': r[1], 'timestamp': r[2]} for r in results]
-    
-    def load_memory_index(self):
-        """Load memory index on startup"""
+            flight.done.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _fetch(self, key, city):
+        with self._lock:
+            flight = self._flights[key]
+        start = time.perf_counter()
         try:
-            conn = sqlite3.connect(CONTEXT_DB)
-            c = conn.cursor()
-            c.execute("SELECT id, content, keywords, importance, timestamp FROM rag_memory")
-            
-            for row in c.fetchall():
-                memory_id, content, keywords_str, importance, timestamp = row
-                keywords = keywords_str.split() if keywords_str else []
-                
-                for keyword in keywords:
-                    self.keyword_index[keyword].append({
-                        'id': memory_id,
-                        'content': content,
-                        'importance': importance,
-                        'timestamp': timestamp
-                    })
-            
-            conn.close()
+            flight.result = self.provider.current(city)
         except Exception as e:
-            print(f"Warning: Could not load memory index: {e}")
+            flight.error = e
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.upstream_calls += 1
+            self.upstream_seconds += elapsed
+            self.upstream_max = max(self.upstream_max, elapsed)
+            if flight.error is None:
+                self._entries[key] = (flight.result, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                self.errors += 1
+            del self._flights[key]
+        flight.done.set()
 
-# Initialize RAG Memory
-rag_memory = RAGMemory()
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                'provider': self.provider.name,
+                'cached_cities': len(self._entries),
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+                'coalesced': self.coalesced,
+                'errors': self.errors,
+                'upstream_calls': self.upstream_calls,
+                'upstream_avg_ms': self.upstream_seconds / self.upstream_calls * 1000 if self.upstream_calls else 0.0,
+                'upstream_max_ms': self.upstream_max * 1000,
+            }
 
-# Function calling tools
-TOOLS = {
-    "weather": {
-        "function": lambda city: get_weather(city),
-        "description": "Get current weather for a specified city",
-        "pattern": r"weather\s+(?:in\s+|for\s+)?(.+)",
-        "example": "weather in New York"
-    },
-    "python": {
-        "function": lambda code: run_python_code(code),
-        "description": "Execute Python code and return output",
-        "pattern": r"run\s+python\s+(.+)",
-        "example": "run python print('hello world')"
-    },
-    "calculate": {
-        "function": lambda expr: calculate_expression(expr),
-        "description": "Calculate mathematical expressions",
-        "pattern": r"calculate\s+(.+)",
-        "example": "calculate 2 + 2 * 3"
-    },
-    "remember": {
-        "function": lambda info: remember_info(info),
-        "description": "Store information in memory",
-        "pattern": r"remember\s+(.+)",
-        "example": "remember I like pizza"
-    },
-    "recall": {
-        "function": lambda query: recall_info(query),
-        "description": "Search stored memories",
-        "pattern": r"(?:recall|what do you know about)\s+(.+)",
-        "example": "recall pizza"
-    }
-}
+weather_service = WeatherService()
 
+@tool_registry.register("weather", r"weather\s+(?:in\s+|for\s+)?(.+)",
+                        "Get weather information", example="weather in New York", usage="weather in [city]",
+                        timeout=8)
 def get_weather(city):
     """Get weather information for a city"""
     try:
-        response = requests.get(f"https://wttr.in/{city}?format=%C+%t+%h+%w", timeout=5)
-        if response.status_code == 200:
-            return f"Weather in {city}: {response.text.strip()}"
-        else:
-            return f"Could not get weather for {city}"
+        return f"Weather in {city}: {weather_service.lookup(city)}"
+    except WeatherError:
+        return f"Could not get weather for {city}"
     except Exception as e:
         return f"Weather service error: {str(e)}"
 
+# Python sandbox workers
+SANDBOX_WORKER_SOURCE = r'''
+import io, json, os, struct, sys, traceback
+try:
+    import resource
+except ImportError:
+    resource = None
+
+config = json.loads(sys.argv[1])
+namespace = {name: __import__(name) for name in config["preimport"]}
+if resource is not None:
+    limit = config["memory_mb"] * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (config["max_files"], config["max_files"]))
+
+# Keep private copies of the pipes and point fds 0/1 at /dev/null, so only
+# framed messages reach the parent whatever the user code writes
+requests_in = os.fdopen(os.dup(0), "rb", buffering=0)
+replies_out = os.fdopen(os.dup(1), "wb", buffering=0)
+null = os.open(os.devnull, os.O_RDWR)
+os.dup2(null, 0)
+os.dup2(null, 1)
+
+def send(message):
+    data = json.dumps(message).encode()
+    replies_out.write(struct.pack(">I", len(data)) + data)
+
+def read_exact(size):
+    data = b""
+    while len(data) < size:
+        chunk = requests_in.read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+class StreamedOutput(io.TextIOBase):
+    def __init__(self):
+        self.pending = []
+        self.size = 0
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.pending.append(text)
+        self.size += len(text)
+        if "\n" in text or self.size >= 4096:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.pending:
+            send({"type": "output", "text": "".join(self.pending)})
+            self.pending = []
+            self.size = 0
+
+while True:
+    header = read_exact(4)
+    if header is None:
+        break
+    request = json.loads(read_exact(struct.unpack(">I", header)[0]))
+    if resource is not None:
+        # RLIMIT_CPU counts the process lifetime, so each run moves the soft limit
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        soft = int(usage.ru_utime + usage.ru_stime) + config["cpu_seconds"]
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+    out, err = StreamedOutput(), io.StringIO()
+    sys.stdout, sys.stderr = out, err
+    error, recycle = "", False
+    try:
+        exec(compile(request["code"], "<stone>", "exec"), dict(namespace, __name__="__main__"))
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            error = f"SystemExit: {e.code}\n"
+    except BaseException as e:
+        recycle = isinstance(e, (MemoryError, RecursionError))
+        error = "".join(traceback.format_exception(type(e), e, e.__traceback__.tb_next))
+    out.flush()
+    sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
+    send({"type": "done", "error": err.getvalue() + error if error else "", "recycle": recycle})
+'''
+
+class SandboxViolation(Exception):
+    """A sandbox run was stopped for exceeding a limit"""
+
+class SandboxWorker:
+    """One pre-started interpreter speaking length-prefixed JSON over its pipes"""
+
+    def __init__(self, config):
+        self.proc = subprocess.Popen([sys.executable, '-I', '-c', SANDBOX_WORKER_SOURCE, config],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL, bufsize=0)
+        self.runs = 0
+        self.buffer = b''
+
+    def send(self, message):
+        data = json.dumps(message).encode()
+        self.proc.stdin.write(struct.pack('>I', len(data)) + data)
+
+    def replies(self, deadline):
+        """Yield decoded replies; raises TimeoutError or EOFError"""
+        fd = self.proc.stdout.fileno()
+        while True:
+            while len(self.buffer) >= 4:
+                size = struct.unpack('>I', self.buffer[:4])[0]
+                if len(self.buffer) < 4 + size:
+                    break
+                message = json.loads(self.buffer[4:4 + size])
+                self.buffer = self.buffer[4 + size:]
+                yield message
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise TimeoutError()
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise EOFError()
+            self.buffer += chunk
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        for pipe in (self.proc.stdin, self.proc.stdout):
+            pipe.close()
+
+class SandboxPool:
+    """Pre-started sandbox interpreters for the python tool.
+
+    Workers import SANDBOX_PREIMPORT once and apply rlimits for address
+    space and open files up front; each run gets a fresh namespace and its
+    own CPU allowance.  Output is streamed back as it is printed.  A worker
+    is replaced after SANDBOX_MAX_RUNS runs or after any violation (timeout,
+    CPU or memory limit, crash, too much output), and replacements start in
+    the background so the pool stays warm.
+    """
+
+    def __init__(self, size=SANDBOX_POOL_SIZE, max_runs=SANDBOX_MAX_RUNS, timeout=SANDBOX_TIMEOUT,
+                 cpu_seconds=SANDBOX_CPU_SECONDS, memory_mb=SANDBOX_MEMORY_MB,
+                 max_files=SANDBOX_MAX_FILES, max_output=SANDBOX_MAX_OUTPUT, preimport=SANDBOX_PREIMPORT):
+        self.size = size
+        self.max_runs = max_runs
+        self.timeout = timeout
+        self.max_output = max_output
+        self.config = json.dumps({'cpu_seconds': cpu_seconds, 'memory_mb': memory_mb,
+                                  'max_files': max_files, 'preimport': list(preimport)})
+        self.idle = queue.Queue()
+        self.started = False
+        self.stopped = False
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.recycled = 0
+        self.violations = 0
+
+    def start(self):
+        with self._lock:
+            if self.started:
+                return
+            self.started = True
+        for _ in range(self.size):
+            self.idle.put(SandboxWorker(self.config))
+
+    def _retire(self, worker):
+        with self._lock:
+            self.recycled += 1
+        threading.Thread(target=self._replace, args=(worker,), name='sandbox-respawn', daemon=True).start()
+
+    def _replace(self, worker):
+        """Reap a retired worker and start its replacement, off the caller's thread"""
+        worker.kill()
+        try:
+            replacement = SandboxWorker(self.config)
+        except OSError as e:
+            print(f"Could not start a sandbox worker: {e}")
+            return
+        if self.stopped:
+            replacement.kill()
+        else:
+            self.idle.put(replacement)
+
+    def run(self, code, on_output=None, timeout=None):
+        """Run code in a warm worker and return (output, error).
+
+        error is '' on success.  Raises SandboxViolation when the run was
+        stopped; the output printed until then is attached as .output.
+        """
+        self.start()
+        deadline = time.monotonic() + (timeout or self.timeout)
+        try:
+            worker = self.idle.get(timeout=max(0.0, deadline - time.monotonic()))
+        except queue.Empty:
+            raise SandboxViolation("no sandbox worker became free in time")
+        output = []
+        size = 0
+        try:
+            worker.send({'code': code})
+            for reply in worker.replies(deadline):
+                if reply['type'] == 'output':
+                    output.append(reply['text'])
+                    size += len(reply['text'])
+                    if on_output:
+                        on_output(reply['text'])
+                    if size > self.max_output:
+                        raise SandboxViolation(f"output exceeded {self.max_output} characters")
+                    continue
+                worker.runs += 1
+                with self._lock:
+                    self.runs += 1
+                if reply['recycle'] or worker.runs >= self.max_runs:
+                    self._retire(worker)
+                else:
+                    self.idle.put(worker)
+                return ''.join(output), reply['error']
+        except (TimeoutError, EOFError, BrokenPipeError, SandboxViolation) as e:
+            try:
+                # The pipe closes just before the process can be reaped
+                returncode = worker.proc.wait(timeout=1) if isinstance(e, EOFError) else None
+            except subprocess.TimeoutExpired:
+                returncode = None
+            self._retire(worker)
+            with self._lock:
+                self.violations += 1
+            if isinstance(e, SandboxViolation):
+                violation = e
+            elif isinstance(e, TimeoutError):
+                violation = SandboxViolation("timed out")
+            elif returncode == -getattr(signal, 'SIGXCPU', -1):
+                violation = SandboxViolation("exceeded its CPU time limit")
+            else:
+                violation = SandboxViolation("worker exited unexpectedly (memory limit?)")
+            violation.output = ''.join(output)
+            raise violation
+        except BaseException:
+            # on_output failed, a reply was malformed, or the caller was interrupted:
+            # the worker's state is unknown, so never hand it out again
+            self._retire(worker)
+            raise
+
+    def stop(self):
+        self.stopped = True
+        while True:
+            try:
+                self.idle.get_nowait().kill()
+            except queue.Empty:
+                break
+
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': self.size > 0,
+                'idle_workers': self.idle.qsize(),
+                'runs': self.runs,
+                'recycled': self.recycled,
+                'violations': self.violations,
+            }
+
+sandbox_pool = SandboxPool()
+atexit.register(sandbox_pool.stop)
+
+@tool_registry.register("python", r"run\s+python\s+(.+)",
+                        "Execute Python code", example="run python print('hello world')", usage="run python [code]",
+                        timeout=12, max_concurrency=2)
 def run_python_code(code):
     """Execute Python code safely"""
     try:
@@ -219,11 +3125,31 @@ def run_python_code(code):
             if pattern in code.lower():
                 return "Security Error: Dangerous operation not allowed"
         
+        if os.name != 'posix' or sandbox_pool.size <= 0:
+            return run_python_subprocess(code)
+        
+        context = current_tool_context()
+        on_output = context.on_output and (lambda text: context.on_output('python', text))
+        try:
+            output, error = sandbox_pool.run(code, on_output)
+        except SandboxViolation as e:
+            return f"{e.output}Error: Code {e}" if e.output else f"Error: Code {e}"
+        
+        if not error:
+            return output if output else "Code executed successfully (no output)"
+        else:
+            return f"Error: {error}"
+    except Exception as e:
+        return f"Execution error: {str(e)}"
+
+def run_python_subprocess(code):
+    """Run code in a fresh interpreter (used when the sandbox pool is disabled)"""
+    try:
         result = subprocess.run(
-            ["python", "-c", code], 
+            [sys.executable, "-c", code], 
             capture_output=True, 
             text=True, 
-            timeout=10
+            timeout=SANDBOX_TIMEOUT
         )
         
         if result.returncode == 0:
@@ -232,29 +3158,169 @@ def run_python_code(code):
             return f"Error: {result.stderr}"
     except subprocess.TimeoutExpired:
         return "Error: Code execution timed out"
-    except Exception as e:
-        return f"Execution error: {str(e)}"
 
+# Calculator
+class CalculationError(ValueError):
+    pass
+
+class Calculator:
+    """Evaluates arithmetic without eval.
+
+    An expression is parsed with ast, checked against a whitelist of
+    operators, functions and constants, and compiled into nested closures
+    that are cached by normalised text, so repeating an expression skips
+    parsing.  Every evaluation step counts against CALC_MAX_OPERATIONS, and
+    integer results (including the predicted size of a power or factorial,
+    checked before computing it) are capped at CALC_MAX_RESULT_BITS, and
+    round() takes at most CALC_MAX_ROUND_DIGITS digits, so no input can keep
+    a worker busy for long.
+    """
+
+    BINARY = {
+        ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+        ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+        ast.Pow: None,  # Size-checked in _power
+    }
+    UNARY = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+    CONSTANTS = {'pi': math.pi, 'e': math.e, 'tau': math.tau, 'inf': math.inf}
+    FUNCTIONS = {
+        'sqrt': math.sqrt, 'exp': math.exp, 'log': math.log, 'log10': math.log10, 'log2': math.log2,
+        'sin': math.sin, 'cos': math.cos, 'tan': math.tan, 'asin': math.asin, 'acos': math.acos,
+        'atan': math.atan, 'atan2': math.atan2, 'sinh': math.sinh, 'cosh': math.cosh, 'tanh': math.tanh,
+        'degrees': math.degrees, 'radians': math.radians, 'hypot': math.hypot,
+        'floor': math.floor, 'ceil': math.ceil, 'abs': abs, 'min': min, 'max': max, 'gcd': math.gcd,
+        'round': None, 'factorial': None,  # Size-checked in _round and _factorial
+    }
+
+    def __init__(self, max_bits=CALC_MAX_RESULT_BITS, max_operations=CALC_MAX_OPERATIONS,
+                 cache_size=CALC_CACHE_SIZE):
+        self.max_bits = max_bits
+        self.max_operations = max_operations
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(expr):
+        # Whitespace runs collapse to one space rather than vanishing, so "1 2"
+        # stays a syntax error instead of becoming 12.  ^ is what most people
+        # type for powers; Python's xor is not supported anyway
+        return ' '.join(expr.split()).lower().replace('^', '**')
+
+    def compile(self, expr):
+        """Return the cached evaluator for expr, parsing it on first use"""
+        key = self.normalize(expr)
+        with self._lock:
+            program = self._cache.get(key)
+            if program is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return program
+            self.misses += 1
+        if len(key) > CALC_MAX_LENGTH:
+            raise CalculationError(f"expression longer than {CALC_MAX_LENGTH} characters")
+        try:
+            tree = ast.parse(key, mode='eval')
+        except SyntaxError:
+            raise CalculationError("invalid expression")
+        program = self._compile(tree.body)
+        with self._lock:
+            self._cache[key] = program
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return program
+
+    def evaluate(self, expr):
+        budget = [self.max_operations]
+        return self.compile(expr)(budget)
+
+    def _compile(self, node):
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            value = node.value
+            self._check(value)
+            return lambda budget: value
+        if isinstance(node, ast.Name):
+            if node.id not in self.CONSTANTS:
+                raise CalculationError(f"unknown name '{node.id}'")
+            value = self.CONSTANTS[node.id]
+            return lambda budget: value
+        if isinstance(node, ast.UnaryOp) and type(node.op) in self.UNARY:
+            op, operand = self.UNARY[type(node.op)], self._compile(node.operand)
+            return lambda budget: self._step(budget, op(operand(budget)))
+        if isinstance(node, ast.BinOp) and type(node.op) in self.BINARY:
+            left, right = self._compile(node.left), self._compile(node.right)
+            op = self.BINARY[type(node.op)] or self._power
+            return lambda budget: self._step(budget, op(left(budget), right(budget)))
+        if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                and node.func.id in self.FUNCTIONS and not node.keywords):
+            func = self.FUNCTIONS[node.func.id] or getattr(self, f'_{node.func.id}')
+            args = [self._compile(arg) for arg in node.args]
+            return lambda budget: self._step(budget, func(*[arg(budget) for arg in args]))
+        raise CalculationError(f"unsupported syntax: {type(node).__name__}")
+
+    def _step(self, budget, value):
+        budget[0] -= 1
+        if budget[0] < 0:
+            raise CalculationError("expression too complex")
+        return self._check(value)
+
+    def _check(self, value):
+        if isinstance(value, int) and value.bit_length() > self.max_bits:
+            raise CalculationError("result too large")
+        return value
+
+    def _power(self, base, exponent):
+        if isinstance(base, int) and isinstance(exponent, int) and exponent > 0 and abs(base) > 1:
+            if (abs(base).bit_length() - 1) * exponent > self.max_bits:
+                raise CalculationError("result too large")
+        return math.pow(base, exponent) if isinstance(base, float) or isinstance(exponent, float) else base ** exponent
+
+    def _round(self, number, ndigits=None):
+        # round(int, -n) builds 10**n, which takes seconds for n in the millions
+        if isinstance(ndigits, int) and abs(ndigits) > CALC_MAX_ROUND_DIGITS:
+            raise CalculationError(f"round() takes at most {CALC_MAX_ROUND_DIGITS} digits")
+        return round(number, ndigits)
+
+    def _factorial(self, n):
+        if not isinstance(n, int) or n < 0:
+            raise CalculationError("factorial needs a non-negative integer")
+        if math.lgamma(n + 1) / math.log(2) > self.max_bits:
+            raise CalculationError("result too large")
+        return math.factorial(n)
+
+    def stats(self):
+        with self._lock:
+            return {'cached_expressions': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+calculator = Calculator()
+
+@tool_registry.register("calculate", r"calculate\s+(.+)",
+                        "Mathematical calculations", example="calculate 2 + 2 * 3", usage="calculate [expression]")
 def calculate_expression(expr):
-    """Safely calculate mathematical expressions"""
-    try:
-        # Remove any dangerous characters/functions
-        safe_expr = re.sub(r'[^0-9+\-*/().\s]', '', expr)
-        result = eval(safe_expr)
-        return f"{expr} = {result}"
-    except Exception as e:
-        return f"Calculation error: {str(e)}"
+    """Safely calculate mathematical expressions; several can be separated with ';'"""
+    results = []
+    for part in filter(None, (p.strip() for p in expr.split(';'))):
+        try:
+            results.append(f"{part} = {calculator.evaluate(part)}")
+        except (CalculationError, ArithmeticError, ValueError, TypeError) as e:
+            results.append(f"Calculation error: {str(e)}")
+    return "\n".join(results) if results else "Calculation error: empty expression"
 
+@tool_registry.register("remember", r"remember\s+(.+)",
+                        "Store information in memory", example="remember I like pizza", usage="remember [info]")
 def remember_info(info):
     """Store information in RAG memory"""
-    # This will be set in the context of the session
-    session_id = getattr(remember_info, 'current_session', 'default')
+    session_id = current_tool_context().session_id
     rag_memory.store_memory(session_id, info, importance=2)
     return f"Remembered: {info}"
 
+@tool_registry.register("recall", r"(?:recall|what do you know about)\s+(.+)",
+                        "Search stored memories", example="recall pizza", usage="recall [query]")
 def recall_info(query):
     """Search stored memories"""
-    session_id = getattr(recall_info, 'current_session', 'default')
+    session_id = current_tool_context().session_id
     memories = rag_memory.search_memory(query, session_id)
     
     if memories:
@@ -267,15 +3333,7 @@ def recall_info(query):
 
 def detect_function_call(message):
     """Detect and extract function calls from user message"""
-    message_lower = message.lower().strip()
-    
-    for tool_name, tool in TOOLS.items():
-        match = re.search(tool['pattern'], message_lower)
-        if match:
-            parameter = match.group(1).strip()
-            return tool_name, parameter
-    
-    return None, None
+    return tool_registry.dispatch(message)
 
 # HTML Template with fixed WebSocket implementation
 HTML_TEMPLATE = """
@@ -465,7 +3523,10 @@ HTML_TEMPLATE = """
             border-radius: 25px;
             color: #00d4ff;
             font-size: 16px;
+            font-family: inherit;
             outline: none;
+            resize: none;
+            display: block;
             transition: all 0.3s ease;
         }
 
@@ -501,6 +3562,21 @@ HTML_TEMPLATE = """
             cursor: not-allowed;
         }
 
+        .stop-btn {
+            display: none;
+            padding: 10px 18px;
+            border-radius: 20px;
+            background: rgba(255, 68, 68, 0.15);
+            border: 1px solid rgba(255, 68, 68, 0.5);
+            color: #ff6666;
+            cursor: pointer;
+            font-size: 14px;
+        }
+
+        .stop-btn.show {
+            display: block;
+        }
+
         .typing-indicator {
             display: none;
             align-items: center;
@@ -624,11 +3700,9 @@ HTML_TEMPLATE = """
             <div class="help-panel">
                 <h3>Available Commands:</h3>
                 <ul>
-                    <li>weather in [city] - Get weather information</li>
-                    <li>run python [code] - Execute Python code</li>
-                    <li>calculate [expression] - Mathematical calculations</li>
-                    <li>remember [info] - Store information in memory</li>
-                    <li>recall [query] - Search stored memories</li>
+                    {% for tool in tools.values() %}
+                    <li>{{ tool.usage }} - {{ tool.description }}</li>
+                    {% endfor %}
                 </ul>
             </div>
 
@@ -640,7 +3714,7 @@ HTML_TEMPLATE = """
                 </div>
 
                 <div class="typing-indicator" id="typingIndicator">
-                    <span>STONE is thinking</span>
+                    <span id="typingText">STONE is thinking</span>
                     <div class="typing-dots">
                         <span></span>
                         <span></span>
@@ -650,11 +3724,12 @@ HTML_TEMPLATE = """
 
                 <div class="input-container">
                     <div class="input-wrapper">
-                        <input type="text" class="message-input" id="messageInput" 
-                               placeholder="Ask STONE anything... (try 'weather in London' or 'remember I like coffee')" 
-                               onkeypress="handleKeyPress(event)">
+                        <textarea class="message-input" id="messageInput" rows="1"
+                               placeholder="Ask STONE anything... (try 'weather in London' or 'remember I like coffee'; Shift+Enter for one command per line)" 
+                               onkeydown="handleKeyPress(event)"></textarea>
                         <button class="send-btn" id="sendBtn" onclick="sendMessage()">▶</button>
                     </div>
+                    <button class="stop-btn" id="stopBtn" onclick="stopGeneration()">■ Stop</button>
                 </div>
             </div>
         </div>
@@ -663,6 +3738,7 @@ HTML_TEMPLATE = """
     <script>
         let currentModel = '';
         let isGenerating = false;
+        let currentRequestId = null;
         let sessionId = localStorage.getItem('stoneSessionId') || generateUUID();
         localStorage.setItem('stoneSessionId', sessionId);
         let socket = null;
@@ -694,26 +3770,54 @@ HTML_TEMPLATE = """
                 document.getElementById('statusText').textContent = 'Disconnected';
             });
 
+            // Frames carry one token, or several coalesced into one string
             socket.on('response_token', function(data) {
                 updateMessage(data.token);
             });
 
+            socket.on('queued', function(data) {
+                document.getElementById('typingText').textContent = `Queued (position ${data.position})`;
+            });
+
             socket.on('response_complete', function(data) {
-                hideTypingIndicator();
-                isGenerating = false;
-                document.getElementById('sendBtn').disabled = false;
+                finishGeneration();
                 saveContext('assistant', data.full_response);
             });
 
+            socket.on('generation_cancelled', function(data) {
+                finishGeneration();
+                if (data.full_response) {
+                    saveContext('assistant', data.full_response);
+                }
+                addMessage('system', 'Generation stopped');
+            });
+
+            socket.on('function_output', function(data) {
+                // Incremental output (the python tool); replaced by the final function_result
+                let div = functionOutputs[data.function];
+                if (!div) {
+                    div = addMessage('function', `🔧 ${data.function}\\n\\n`);
+                    functionOutputs[data.function] = div;
+                }
+                div.textContent += data.output;
+                document.getElementById('messages').scrollTop = 
+                    document.getElementById('messages').scrollHeight;
+            });
+
             socket.on('function_result', function(data) {
-                addMessage('function', `🔧 ${data.function}(${data.parameter})\\n\\n${data.result}`);
+                const text = `🔧 ${data.function}(${data.parameter})\\n\\n${data.result}`;
+                const div = functionOutputs[data.function];
+                delete functionOutputs[data.function];
+                if (div) {
+                    div.textContent = text;
+                } else {
+                    addMessage('function', text);
+                }
             });
 
             socket.on('error', function(data) {
-                hideTypingIndicator();
+                finishGeneration();
                 addMessage('system', `Error: ${data.message}`);
-                isGenerating = false;
-                document.getElementById('sendBtn').disabled = false;
             });
         }
 
@@ -776,9 +3880,11 @@ HTML_TEMPLATE = """
         }
 
         let currentAssistantMessage = null;
+        let functionOutputs = {};
 
         function updateMessage(content) {
             if (!currentAssistantMessage) {
+                document.getElementById('typingText').textContent = 'STONE is thinking';
                 currentAssistantMessage = addMessage('assistant', '');
             }
             currentAssistantMessage.textContent += content;
@@ -820,18 +3926,36 @@ HTML_TEMPLATE = """
             
             showTypingIndicator();
             isGenerating = true;
+            currentRequestId = generateUUID();
             document.getElementById('sendBtn').disabled = true;
+            document.getElementById('stopBtn').classList.add('show');
             currentAssistantMessage = null;
             
             socket.emit('send_message', {
                 model: currentModel,
                 message: message,
-                session_id: sessionId
+                session_id: sessionId,
+                request_id: currentRequestId
             });
         }
 
+        function stopGeneration() {
+            if (isGenerating && currentRequestId) {
+                socket.emit('cancel_generation', {request_id: currentRequestId});
+            }
+        }
+
+        function finishGeneration() {
+            hideTypingIndicator();
+            isGenerating = false;
+            currentRequestId = null;
+            document.getElementById('sendBtn').disabled = false;
+            document.getElementById('stopBtn').classList.remove('show');
+        }
+
         function handleKeyPress(event) {
-            if (event.key === 'Enter') {
+            if (event.key === 'Enter' && !event.shiftKey) {
+                event.preventDefault();
                 sendMessage();
             }
         }
@@ -858,17 +3982,17 @@ HTML_TEMPLATE = """
 @app.route('/')
 def index():
     """Serve the main STONE interface"""
-    return render_template_string(HTML_TEMPLATE)
+    return render_template_string(HTML_TEMPLATE, tools=TOOLS)
 
 @app.route('/api/models')
 def get_models():
     """Get available models from Ollama"""
     try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=10)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            return {"error": "Failed to fetch models", "models": []}, 500
+        tags = ollama.tags(timeout=10)
+        model_labels.update(tags)
+        return tags
+    except OllamaError:
+        return {"error": "Failed to fetch models", "models": []}, 500
     except Exception as e:
         return {"error": str(e), "models": []}, 500
 
@@ -876,16 +4000,10 @@ def get_models():
 def get_context():
     """Retrieve conversation context for a session"""
     session_id = request.args.get('session_id')
-    conn = sqlite3.connect(CONTEXT_DB)
-    c = conn.cursor()
-    
-    c.execute("SELECT message, role FROM context WHERE session_id = ? ORDER BY timestamp DESC LIMIT 10", 
-             (session_id,))
     messages = []
-    for row in reversed(c.fetchall()):  # Reverse to get chronological order
-        messages.append({"message": row[0], "role": row[1]})
+    for message, role in context_cache.turns(session_id, 10):
+        messages.append({"message": message, "role": role})
     
-    conn.close()
     return {"messages": messages}
 
 @app.route('/api/save_context', methods=['POST'])
@@ -896,14 +4014,11 @@ def save_context():
     role = data.get('role')
     message = data.get('message')
     
-    conn = sqlite3.connect(CONTEXT_DB)
-    c = conn.cursor()
-    
-    c.execute("INSERT INTO context (session_id, timestamp, message, role) VALUES (?, ?, ?, ?)",
-             (session_id, datetime.now().isoformat(), message, role))
-    
-    conn.commit()
-    conn.close()
+    # Queue the insert before updating the cache so a concurrent cache miss
+    # either waits for this row or sees the cache write and skips its snapshot
+    write_behind.submit("INSERT INTO context (session_id, ts, message, role) VALUES (?, ?, ?, ?)",
+                        (session_id, now_ms(), message, role), key=session_id)
+    context_cache.append(session_id, role, message)
     
     # Store in RAG memory if it's important
     if role == 'user' and any(keyword in message.lower() for keyword in ['remember', 'important', 'note']):
@@ -916,10 +4031,22 @@ def search_memory():
     """Search RAG memory"""
     query = request.args.get('query', '')
     session_id = request.args.get('session_id')
+    match_all = request.args.get('match', 'any') == 'all'
+    mode = request.args.get('mode', MEMORY_SEARCH_MODE)
+    if mode not in RAGMemory.SEARCH_MODES:
+        return {"error": f"mode must be one of {', '.join(RAGMemory.SEARCH_MODES)}", "memories": []}, 400
     
-    memories = rag_memory.search_memory(query, session_id)
+    memories = rag_memory.search_memory(query, session_id, match_all=match_all, mode=mode)
     return {"memories": memories}
 
+@app.route('/api/memory/stats')
+def memory_stats():
+    """Report in-memory keyword index size"""
+    stats = {"index": rag_memory.index.stats()}
+    if rag_memory.vectors is not None:
+        stats["vectors"] = rag_memory.vectors.stats()
+    return stats
+
 @app.route('/api/knowledge', methods=['GET', 'POST'])
 def knowledge_endpoint():
     """Get or store knowledge"""
@@ -937,164 +4064,737 @@ def knowledge_endpoint():
         rag_memory.store_knowledge(topic, content, source)
         return {"status": "stored"}
 
-# WebSocket handlers
-@socketio.on('send_message')
-def handle_message(data):
-    """Handle incoming messages with streaming response"""
-    model = data.get('model')
-    message = data.get('message')
-    session_id = data.get('session_id', 'default')
-    
-    if not model or not message:
-        emit('error', {'message': 'Model and message are required'})
-        return
-    
+def admin_required(view):
+    """Allow a debug endpoint only with the STONE_ADMIN_TOKEN in the X-Admin-Token header.
+
+    Query-string tokens are refused: they end up in access logs, proxy logs
+    and browser history.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            return jsonify({'error': 'Debug endpoints are disabled; set STONE_ADMIN_TOKEN'}), 403
+        token = request.headers.get('X-Admin-Token', '')
+        if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+            return jsonify({'error': 'Forbidden'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.route('/debug/traces')
+@admin_required
+def debug_traces():
+    """Recent per-request phase timings, newest first"""
+    limit = request.args.get('limit', 50, type=int)
+    min_ms = request.args.get('min_ms', 0.0, type=float)
+    return jsonify(tracer.recent(limit, min_ms))
+
+@app.route('/debug/profile')
+@admin_required
+def debug_profile():
+    """Sample all threads for ?seconds= and return collapsed stacks"""
+    seconds = min(max(request.args.get('seconds', 10, type=float), 0.1), PROFILE_MAX_SECONDS)
+    include_idle = request.args.get('idle', '1') != '0'
     try:
-        # Set session context for function calls
-        remember_info.current_session = session_id
-        recall_info.current_session = session_id
-        
-        # Check for function calls first
-        function_name, parameter = detect_function_call(message)
-        if function_name and parameter:
-            try:
-                result = TOOLS[function_name]['function'](parameter)
+        counts, samples = profiler.capture(seconds, include_idle)
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    body = ''.join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda c: -c[1]))
+    return Response(body, mimetype='text/plain', headers={
+        'Content-Disposition': f'attachment; filename="stone-profile-{int(time.time())}.collapsed"',
+        'X-Profile-Samples': str(samples),
+    })
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text exposition of request, database, memory and tool metrics"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/stats')
+def stats_endpoint():
+    """Report server queue and cache statistics"""
+    return {
+        "scheduler": scheduler.stats(),
+        "active_generations": len(generations),
+        "context_cache": context_cache.stats(),
+        "write_behind": write_behind.stats(),
+        "prompt": prompt_builder.stats(),
+        "response_cache": response_cache.stats(),
+        "tools": tool_executor.stats(),
+        "sandbox": sandbox_pool.stats(),
+        "calculator": calculator.stats(),
+        "weather": weather_service.stats(),
+        "retention": retention.last_report,
+        "change_feed": change_feed.stats() if change_feed else None,
+    }
+
+# Chat turns: the steps of answering one message, shared by both server modes
+class ChatTurn:
+    """One send_message request from validation to the final event.
+
+    prepare() and finish() do the blocking work (tools, SQLite, caches) and
+    are called inline by the threaded handler or on db_executor by the async
+    one; each server mode only supplies the Ollama streaming loop.  emit is
+    a callable(event, payload) that is safe to call from the thread running
+    prepare().
+    """
+
+    def __init__(self, data, sid):
+        self.model = data.get('model')
+        self.message = data.get('message')
+        self.session_id = data.get('session_id', 'default')
+        self.request_id = data.get('request_id') or uuid.uuid4().hex
+        self.sid = sid
+        self.generation = None
+        self.trace = None
+        self.outcome = None  # Set once the request reaches generation, for stone_generation_seconds
+        self.cached = None
+        self.prompt_eval_count = None
+        self.first_token = None
+        self.chunks = 0
+        self.model_label = model_labels.label(self.model)  # Client-supplied; bounded for metrics
+
+    def start(self):
+        """Register the generation; False (with the error payload) if the request is invalid"""
+        if not self.model or not self.message:
+            return False
+        self.generation = generations.start(self.request_id, self.sid)
+        self.started = time.perf_counter()
+        self.trace = tracer.start(self.request_id, session_id=self.session_id, model=self.model)
+        return True
+
+    def prepare(self, emit):
+        """Run tools, retrieve memories and build the prompt; raises ToolsFailed if every tool call failed"""
+        generation, trace, message = self.generation, self.trace, self.message
+        # Check for function calls first; several (one per line) run in parallel
+        calls = tool_registry.dispatch_all(message)
+        trace.mark('tool_detect')
+        if calls:
+            trace.attrs['tools'] = [name for name, _ in calls]
+            results, errors = [], []
+            request_id = self.request_id
+            on_output = lambda name, text: emit(
+                'function_output', {'function': name, 'output': text, 'request_id': request_id})
+            for function_name, parameter, result, error in tool_executor.run(
+                    calls, ToolContext(self.session_id, request_id, on_output)):
                 emit('function_result', {
                     'function': function_name,
                     'parameter': parameter,
-                    'result': result
+                    'result': f"Error: {error}" if error else result
                 })
-                
-                # Continue with AI response about the function result
+                if error:
+                    errors.append(f"{function_name}: {error}")
+                else:
+                    results.append((function_name, parameter, result))
+                if generation.cancelled.is_set():
+                    raise GenerationCancelled()
+            trace.mark('tools')
+            if not results:
+                raise ToolsFailed('; '.join(errors))
+            
+            # Continue with AI response about the function results
+            if len(results) == 1:
+                function_name, parameter, result = results[0]
                 message = f"I executed {function_name} with parameter '{parameter}' and got: {result}. Please provide a natural response about this result."
-            except Exception as e:
-                emit('function_result', {
-                    'function': function_name,
-                    'parameter': parameter,
-                    'result': f"Error: {str(e)}"
-                })
-                return
+            else:
+                lines = "\n".join(f"- {name}('{parameter}'): {result}" for name, parameter, result in results)
+                message = f"I executed these tools and got:\n{lines}\nPlease provide a natural response about these results."
         
-        # Get relevant memories for context
-        memories = rag_memory.search_memory(message, session_id, limit=3)
-        memory_context = ""
-        if memories:
-            memory_context = "\n\nRelevant context from memory:\n"
-            for mem in memories:
-                memory_context += f"- {mem['content']}\n"
+        # Fit memories and conversation history into the model's token budget
+        self.memories = rag_memory.search_memory(message, self.session_id, limit=PROMPT_MEMORY_CANDIDATES)
+        trace.mark('rag_search')
+        history = context_cache.turns(self.session_id, CONTEXT_CACHE_TURNS)
+        trace.mark('context')
+        messages_payload, self.prompt_tokens = prompt_builder.build(
+            self.model, message, history, [mem['content'] for mem in self.memories])
+        trace.mark('prompt_build')
+        trace.attrs['prompt_tokens'] = self.prompt_tokens
         
-        # Get conversation context
-        conn = sqlite3.connect(CONTEXT_DB)
-        c = conn.cursor()
-        c.execute("SELECT message, role FROM context WHERE session_id = ? ORDER BY timestamp DESC LIMIT 6", 
-                 (session_id,))
-        context_messages = []
-        for row in reversed(c.fetchall()):
-            context_messages.append({"role": row[1], "content": row[0]})
-        conn.close()
-        
-        # Add memory context to the current message
-        enhanced_message = message + memory_context
-        
-        # Prepare the request payload for Ollama
-        messages_payload = context_messages + [{"role": "user", "content": enhanced_message}]
-        
-        payload = {
-            "model": model,
+        self.payload = {
+            "model": self.model,
             "messages": messages_payload,
             "stream": True,
             "options": {
                 "temperature": 0.7,
                 "top_p": 0.9,
-                "num_ctx": 4096
+                "num_ctx": prompt_builder.num_ctx(self.model)
             }
         }
         
-        # Stream response from Ollama
-        response = requests.post(
-            f"{OLLAMA_BASE_URL}/api/chat",
-            json=payload,
-            stream=True,
-            timeout=30
-        )
-        
-        if response.status_code != 200:
-            emit('error', {'message': f'Ollama error: {response.status_code}'})
-            return
-        
-        full_response = ""
-        for line in response.iter_lines():
-            if line:
-                try:
-                    chunk = json.loads(line.decode('utf-8'))
-                    if 'message' in chunk and 'content' in chunk['message']:
-                        token = chunk['message']['content']
-                        full_response += token
-                        emit('response_token', {'token': token})
-                    
-                    if chunk.get('done', False):
-                        break
-                        
-                except json.JSONDecodeError:
-                    continue
+        self.outcome = 'error'
+        self.cache_key = response_cache.key(self.payload) if response_cache.usable(self.model) else None
+        self.cached = response_cache.get(self.cache_key) if self.cache_key else None
+        trace.mark('cache_lookup')
+
+    def replay(self, stream):
+        """Send a cached answer through the normal token events"""
+        full_response, self.prompt_eval_count = self.cached
+        for piece in re.findall(r'\s*\S+|\s+$', full_response):
+            if self.generation.cancelled.is_set():
+                break
+            stream.push(piece)
+        stream.flush()
+        self.trace.mark('replay')
+
+    def on_chunk(self, chunk, stream):
+        """Forward one Ollama chunk and record its timings"""
+        if 'message' in chunk and 'content' in chunk['message']:
+            if self.first_token is None and chunk['message']['content']:
+                self.first_token = time.perf_counter()
+                time_to_first_token.observe(self.first_token - self.started, self.model_label)
+                self.trace.mark('first_token')
+            self.chunks += 1
+            stream.push(chunk['message']['content'])
+        if chunk.get('done'):
+            self.prompt_eval_count = chunk.get('prompt_eval_count')
+            if chunk.get('eval_count') and chunk.get('eval_duration'):
+                tokens_per_second.observe(chunk['eval_count'] / (chunk['eval_duration'] / 1e9), self.model_label)
+            elif self.first_token is not None and self.chunks > 1:
+                tokens_per_second.observe((self.chunks - 1) / (time.perf_counter() - self.first_token), self.model_label)
+
+    def finish(self, full_response):
+        """Store the answer; return the final event and its payload"""
+        if self.generation.cancelled.is_set():
+            self.outcome = 'cancelled'
+            return 'generation_cancelled', {'request_id': self.request_id, 'full_response': full_response}
+        self.outcome = 'cached' if self.cached else 'ok'
         
         # Store the response in memory if it contains useful information
-        if len(full_response) > 50:  # Only store substantial responses
-            rag_memory.store_memory(session_id, f"AI Response: {full_response}", importance=1)
+        remembered = len(full_response) > 50  # Only store substantial responses
+        if remembered:
+            rag_memory.store_memory(self.session_id, f"AI Response: {full_response}", importance=1)
         
-        emit('response_complete', {'full_response': full_response})
+        if not self.cached:
+            token_estimator.calibrate(self.model, self.prompt_tokens, self.prompt_eval_count)
+            # An answer built on this session's memories would be invalidated as soon as it is remembered
+            if self.cache_key and not (self.memories and remembered):
+                response_cache.put(self.cache_key, self.model, full_response,
+                                   self.prompt_eval_count or self.prompt_tokens,
+                                   self.session_id if self.memories else None)
+        self.trace.mark('finalize')
         
-    except requests.exceptions.Timeout:
-        emit('error', {'message': 'Request timeout - Ollama may be busy'})
-    except requests.exceptions.ConnectionError:
-        emit('error', {'message': 'Cannot connect to Ollama - is it running?'})
+        return 'response_complete', {
+            'full_response': full_response,
+            'request_id': self.request_id,
+            'prompt_tokens': self.prompt_eval_count or self.prompt_tokens,
+            'prompt_tokens_estimated': self.prompt_tokens,
+            'cached': bool(self.cached),
+        }
+
+    def failed(self, exc):
+        """Map an exception to the event sent to the client"""
+        trace = self.trace
+        if isinstance(exc, GenerationCancelled):
+            self.outcome = self.outcome and 'cancelled'
+            return 'generation_cancelled', {'request_id': self.request_id, 'full_response': ''}
+        if isinstance(exc, ToolsFailed):
+            trace.error = f'tools failed: {exc}'
+            return 'error', {'request_id': self.request_id, 'message': f'Tool call failed - {exc}'}
+        if isinstance(exc, PromptTooLong):
+            trace.error = str(exc)
+            return 'error', {'request_id': self.request_id, 'message': str(exc)}
+        if isinstance(exc, OllamaError):
+            trace.error = str(exc)
+            return 'error', {'request_id': self.request_id, 'message': str(exc)}
+        if isinstance(exc, QueueFullError):
+            trace.error = 'queue full'
+            return 'error', {'request_id': self.request_id, 'message': 'Server busy - too many queued requests, please try again shortly'}
+        if isinstance(exc, (requests.exceptions.Timeout, asyncio.TimeoutError)):
+            trace.error = 'ollama timeout'
+            return 'error', {'request_id': self.request_id, 'message': 'Request timeout - Ollama may be busy'}
+        if isinstance(exc, requests.exceptions.ConnectionError) or (
+                aiohttp is not None and isinstance(exc, aiohttp.ClientConnectionError)):
+            trace.error = 'ollama connection error'
+            return 'error', {'request_id': self.request_id, 'message': 'Cannot connect to Ollama - is it running?'}
+        trace.error = repr(exc)
+        return 'error', {'request_id': self.request_id, 'message': f'Unexpected error: {str(exc)}'}
+
+    def close(self):
+        generations.finish(self.request_id)
+        if self.outcome:
+            generation_seconds.observe(time.perf_counter() - self.started, self.model_label, self.outcome)
+        tracer.finish(self.trace, self.outcome or 'no_generation')
+
+# WebSocket handlers
+@socketio.on('send_message')
+def handle_message(data):
+    """Handle incoming messages with streaming response"""
+    turn = ChatTurn(data, request.sid)
+    if not turn.start():
+        emit('error', {'request_id': turn.request_id, 'message': 'Model and message are required'})
+        return
+    
+    generation, trace = turn.generation, turn.trace
+    sid = request.sid
+    # The socket always lives in this process, so frames skip the message queue
+    stream = TokenCoalescer(lambda frame: socketio.emit('response_token', frame, to=sid, ignore_queue=True),
+                            flusher=stream_flusher)
+    try:
+        turn.prepare(lambda event, payload: socketio.emit(event, payload, to=sid))
+        if turn.cached:
+            turn.replay(stream)
+        else:
+            # Wait for a generation slot, then stream response from Ollama
+            on_queued = lambda position: emit('queued', {'position': position, 'request_id': turn.request_id})
+            with scheduler.slot(turn.model, turn.session_id, on_queued, generation.cancelled):
+                trace.mark('queue_wait')
+                with ollama.chat(turn.payload) as response:
+                    trace.mark('ollama_headers')
+                    generation.response = response
+                    if response.status_code != 200:
+                        raise OllamaError(response.status_code)
+                    try:
+                        for chunk in ollama.iter_chunks(response):
+                            if generation.cancelled.is_set():
+                                break
+                            turn.on_chunk(chunk, stream)
+                    except requests.exceptions.RequestException:
+                        if not generation.cancelled.is_set():
+                            raise
+                    stream.flush()
+                    trace.mark('stream')
+        emit(*turn.finish(stream.full_response))
     except Exception as e:
-        emit('error', {'message': f'Unexpected error: {str(e)}'})
+        emit(*turn.failed(e))
+    finally:
+        stream.close()
+        turn.close()
+
+@socketio.on('cancel_generation')
+def handle_cancel_generation(data):
+    """Stop an in-flight generation started by this client"""
+    # Unknown ids are ignored: the generation may have just finished
+    generations.cancel((data or {}).get('request_id'), request.sid)
 
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
+    connected_sids.add(request.sid)
     print(f"Client connected: {request.sid}")
     emit('status', {'message': 'Connected to STONE server'})
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
-    print(f"Client disconnected: {request.sid}")
+    connected_sids.discard(request.sid)
+    cancelled = generations.cancel_sid(request.sid)
+    print(f"Client disconnected: {request.sid}" + (f" (cancelled {cancelled} generations)" if cancelled else ""))
+
+# Async server mode: python-socketio's AsyncServer on aiohttp
+class WSGIBridge:
+    """aiohttp handler that serves a WSGI app, running each request on an executor thread"""
+
+    SKIP_HEADERS = frozenset({'content-length', 'transfer-encoding', 'connection'})
+
+    def __init__(self, wsgi_app, executor):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+
+    async def __call__(self, request):
+        body = await request.read()
+        host, _, port = request.host.partition(':')
+        environ = {
+            'REQUEST_METHOD': request.method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': request.query_string,
+            'SERVER_NAME': host,
+            'SERVER_PORT': port or ('443' if request.secure else '80'),
+            'SERVER_PROTOCOL': f"HTTP/{request.version.major}.{request.version.minor}",
+            'REMOTE_ADDR': request.remote or '',
+            'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': request.scheme,
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in request.headers.items():
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            if key not in ('HTTP_CONTENT_TYPE', 'HTTP_CONTENT_LENGTH'):
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        status, headers, data = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._call, environ)
+        code, _, reason = status.partition(' ')
+        response = web.Response(status=int(code), reason=reason or None, body=data)
+        for name, value in headers:
+            if name.lower() not in self.SKIP_HEADERS:
+                response.headers.add(name, value)
+        return response
+
+    def _call(self, environ):
+        started = {}
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            started['status'], started['headers'] = status, headers
+            return chunks.append
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            chunks.extend(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return started['status'], started['headers'], b''.join(chunks)
+
+class AsyncChatServer:
+    """Serves the same Socket.IO events and HTTP routes as the threaded server from one event loop.
+
+    Each socket and each streaming generation is a coroutine, so idle
+    connections and generations waiting on Ollama cost no OS thread.
+    Blocking work (ChatTurn.prepare/finish, which touch SQLite and the
+    tools, and the Flask routes) runs on a dedicated executor of
+    ASYNC_DB_WORKERS threads.
+    """
+
+    def __init__(self, workers=ASYNC_DB_WORKERS):
+        if web is None:
+            raise RuntimeError("The async server mode requires aiohttp (pip install aiohttp)")
+        client_manager = AsyncRedisManager(MESSAGE_QUEUE) if MESSAGE_QUEUE else None
+        self.sio = AsyncServer(async_mode='aiohttp', cors_allowed_origins='*', client_manager=client_manager)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='db')
+        self.ollama = AsyncOllamaClient()
+        for event in ('connect', 'disconnect', 'send_message', 'cancel_generation'):
+            self.sio.on(event, getattr(self, event))
+
+    async def connect(self, sid, environ, auth=None):
+        connected_sids.add(sid)
+        print(f"Client connected: {sid}")
+        await self.sio.emit('status', {'message': 'Connected to STONE server'}, to=sid)
+
+    async def disconnect(self, sid, reason=None):
+        connected_sids.discard(sid)
+        cancelled = generations.cancel_sid(sid)
+        print(f"Client disconnected: {sid}" + (f" (cancelled {cancelled} generations)" if cancelled else ""))
+
+    async def cancel_generation(self, sid, data):
+        generations.cancel((data or {}).get('request_id'), sid)
+
+    async def send_message(self, sid, data):
+        turn = ChatTurn(data, sid)
+        emit = lambda event, payload: self.sio.emit(event, payload, to=sid)
+        if not turn.start():
+            await emit('error', {'request_id': turn.request_id, 'message': 'Model and message are required'})
+            return
+        
+        loop = asyncio.get_running_loop()
+        emit_threadsafe = lambda event, payload: asyncio.run_coroutine_threadsafe(emit(event, payload), loop)
+        generation, trace = turn.generation, turn.trace
+        frames = []
+        try:
+            await loop.run_in_executor(self.executor, turn.prepare, emit_threadsafe)
+            stream = TokenCoalescer(frames.append)
+            if turn.cached:
+                turn.replay(stream)
+            else:
+                on_queued = lambda position: emit('queued', {'position': position, 'request_id': turn.request_id})
+                async with scheduler.slot_async(turn.model, turn.session_id, on_queued, generation.cancelled):
+                    trace.mark('queue_wait')
+                    # A task of its own, so a user cancel interrupts only the stream
+                    # and this handler carries on to save the partial reply
+                    generation.task = asyncio.create_task(self.stream_reply(sid, turn, stream, frames))
+                    try:
+                        await generation.task
+                    except asyncio.CancelledError:
+                        if not generation.cancelled.is_set():
+                            raise
+                    finally:
+                        generation.task = None
+                    stream.flush()
+                    trace.mark('stream')
+            await self.send_frames(sid, frames)
+            await emit(*await loop.run_in_executor(self.executor, turn.finish, stream.full_response))
+        except Exception as e:
+            await emit(*turn.failed(e))
+        finally:
+            turn.close()
+
+    async def stream_reply(self, sid, turn, stream, frames):
+        chunks = self.ollama.chat_stream(turn.payload, on_headers=lambda: turn.trace.mark('ollama_headers'))
+        next_chunk = None
+        try:
+            while True:
+                deadline = stream.deadline
+                if next_chunk is None and deadline is None:
+                    chunk = await chunks.__anext__()
+                else:
+                    # A frame is pending: wait for the next chunk only until it is due
+                    next_chunk = next_chunk or asyncio.ensure_future(chunks.__anext__())
+                    timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                    done, _ = await asyncio.wait((next_chunk,), timeout=timeout)
+                    if not done:
+                        stream.flush()
+                        await self.send_frames(sid, frames)
+                        continue
+                    chunk, next_chunk = next_chunk.result(), None
+                if turn.generation.cancelled.is_set():
+                    break
+                turn.on_chunk(chunk, stream)
+                await self.send_frames(sid, frames)
+        except StopAsyncIteration:
+            pass
+        finally:
+            if next_chunk is not None:
+                next_chunk.cancel()
+
+    async def send_frames(self, sid, frames):
+        for frame in frames:
+            await self.sio.emit('response_token', frame, to=sid, ignore_queue=True)
+        frames.clear()
+
+    async def _cleanup(self, aio_app):
+        await self.ollama.close()
+        self.executor.shutdown(wait=False)
+
+    def application(self):
+        """aiohttp application: Socket.IO at /socket.io/, everything else through Flask"""
+        aio_app = web.Application(client_max_size=16 * 1024 * 1024)
+        self.sio.attach(aio_app)
+        aio_app.router.add_route('*', '/{path:.*}', WSGIBridge(app, self.executor))
+        aio_app.on_cleanup.append(self._cleanup)
+        return aio_app
+
+    def run(self, host, port):
+        web.run_app(self.application(), host=host, port=port, print=None)
+
+# Retention
+class RetentionEngine:
+    """Applies RETENTION_POLICIES with set-based selection and chunked deletes.
+
+    Rows to drop are found in one read-only pass (ROW_NUMBER() OVER a
+    per-session partition for count limits, plus an age cut-off), which in
+    WAL mode never blocks writers.  They are then deleted in
+    RETENTION_CHUNK_SIZE transactions with a pause between each, so the
+    write lock is only ever held briefly.  Subscribers are told which keys
+    (and sessions) went away, and freed pages are released with
+    incremental_vacuum.
+    """
+
+    TABLES = {
+        # table: (key column, session column)
+        'context': ('id', 'session_id'),
+        'rag_memory': ('doc_id', 'session_id'),
+        'response_cache': ('cache_key', 'session_id'),
+    }
+
+    def __init__(self, policies=RETENTION_POLICIES, chunk_size=RETENTION_CHUNK_SIZE,
+                 pause_ms=RETENTION_PAUSE_MS, vacuum_pages=RETENTION_VACUUM_PAGES):
+        self.policies = policies
+        self.chunk_size = chunk_size
+        self.pause = pause_ms / 1000
+        self.vacuum_pages = vacuum_pages
+        self.listeners = defaultdict(list)
+        self.last_report = None
+
+    def subscribe(self, table, callback):
+        """Register callback(keys, session_ids) for rows removed from table"""
+        self.listeners[table].append(callback)
+
+    def candidates(self, table, policy):
+        key, session_column = self.TABLES[table]
+        exempt = ''
+        params = []
+        if policy.get('keep_importance') is not None:
+            exempt = 'WHERE importance < ?'
+            params.append(policy['keep_importance'])
+        selects = []
+        if policy.get('keep_last') is not None:
+            partition = f"PARTITION BY {session_column}" if policy.get('per_session') else ''
+            selects.append(f"""SELECT {key}, {session_column} FROM (
+                                   SELECT {key}, {session_column},
+                                          ROW_NUMBER() OVER ({partition} ORDER BY ts DESC, {key} DESC) AS rn
+                                   FROM {table} {exempt})
+                               WHERE rn > ?""")
+            params.append(policy['keep_last'])
+        if policy.get('max_age_days') is not None:
+            age_filter = f"{exempt} {'AND' if exempt else 'WHERE'} ts < ?"
+            selects.append(f"SELECT {key}, {session_column} FROM {table} {age_filter}")
+            if exempt:
+                params.append(policy['keep_importance'])
+            params.append(now_ms() - int(policy['max_age_days'] * 86400000))
+        if not selects:
+            return []
+        return db.query(' UNION '.join(selects), params)
+
+    def apply(self, table, policy):
+        key = self.TABLES[table][0]
+        start = time.perf_counter()
+        rows = self.candidates(table, policy)
+        select_seconds = time.perf_counter() - start
+        lock_total = lock_max = 0.0
+        for offset in range(0, len(rows), self.chunk_size):
+            chunk = rows[offset:offset + self.chunk_size]
+            keys = [r[0] for r in chunk]
+            placeholders = ','.join('?' * len(keys))
+            lock_start = time.perf_counter()
+            with db.transaction() as c:
+                c.execute(f"DELETE FROM {table} WHERE {key} IN ({placeholders})", keys)
+            held = time.perf_counter() - lock_start
+            lock_total += held
+            lock_max = max(lock_max, held)
+            sessions = {r[1] for r in chunk}
+            for callback in self.listeners[table]:
+                try:
+                    callback(keys, sessions)
+                except Exception as e:
+                    print(f"Retention listener error on {table}: {e}")
+            time.sleep(self.pause)
+        elapsed = time.perf_counter() - start
+        return {
+            'rows_deleted': len(rows),
+            'seconds': elapsed,
+            'select_seconds': select_seconds,
+            'rows_per_second': len(rows) / elapsed if elapsed else 0.0,
+            'max_lock_ms': lock_max * 1000,
+            'total_lock_ms': lock_total * 1000,
+        }
+
+    def vacuum(self):
+        """Return free pages to the filesystem a few at a time"""
+        if db.query("PRAGMA auto_vacuum")[0][0] != 2:
+            return 0  # incremental_vacuum is a no-op outside INCREMENTAL mode
+        free_pages = db.query("PRAGMA freelist_count")[0][0]
+        # Bounded by the pages free at the start: other writers can keep freeing more
+        steps = -(-free_pages // self.vacuum_pages)
+        freed = 0
+        for _ in range(steps):
+            with db.connection() as c:
+                # executescript steps the pragma to completion; execute() frees a single page
+                c.executescript(f"PRAGMA incremental_vacuum({self.vacuum_pages})")
+            remaining = db.query("PRAGMA freelist_count")[0][0]
+            if remaining >= free_pages:
+                break  # Nothing was returned; don't spin
+            freed += free_pages - remaining
+            free_pages = remaining
+            if not remaining:
+                break
+            time.sleep(self.pause)
+        return freed
+
+    def run(self):
+        report = {table: self.apply(table, policy) for table, policy in self.policies.items()}
+        report['vacuum_pages_freed'] = self.vacuum()
+        self.last_report = report
+        return report
+
+retention = RetentionEngine()
+retention.subscribe('rag_memory', lambda keys, sessions: rag_memory.forget(keys))
+retention.subscribe('context', lambda keys, sessions: context_cache.invalidate(sessions))
+retention.subscribe('rag_memory', lambda keys, sessions: response_cache.invalidate_sessions(sessions))
+retention.subscribe('response_cache', lambda keys, sessions: response_cache.forget(keys))
+
+# Multi-worker change feed
+class ChangeFeed:
+    """Applies other workers' rag_memory and context writes to this process's caches.
+
+    Every worker records its own writes in change_log (see
+    change_log_triggers) and polls for other origins' rows every
+    CHANGE_FEED_POLL_MS: new memories are added to the keyword and vector
+    indexes, deleted ones are forgotten, and sessions whose turns changed
+    are dropped from the context cache.  Rows older than
+    CHANGE_LOG_RETENTION_S are pruned; a worker that fell further behind
+    than that rebuilds its indexes and caches instead.
+    """
+
+    BATCH = 10000
+
+    def __init__(self, origin, since, poll_ms=CHANGE_FEED_POLL_MS, retention_s=CHANGE_LOG_RETENTION_S):
+        self.origin = origin
+        self.last_seq = since
+        self.poll_interval = poll_ms / 1000
+        self.retention_ms = retention_s * 1000
+        self.polls = 0
+        self.applied = 0
+        self.resyncs = 0
+        self.max_lag_ms = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='change-feed', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        last_prune = time.monotonic()
+        while not self._stop.wait(self.poll_interval):
+            try:
+                while self.poll() == self.BATCH:
+                    pass
+                if time.monotonic() - last_prune > 60:
+                    db.execute("DELETE FROM change_log WHERE ts < ?", (now_ms() - self.retention_ms,))
+                    last_prune = time.monotonic()
+            except Exception as e:
+                print(f"Change feed error: {e}")
+
+    def poll(self):
+        """Apply one batch of new change_log rows; returns how many were read"""
+        self.polls += 1
+        rows = db.query("""SELECT seq, origin, kind, ref, session_id, ts FROM change_log
+                           WHERE seq > ? ORDER BY seq LIMIT ?""", (self.last_seq, self.BATCH))
+        if not rows:
+            return 0
+        if rows[0][0] > self.last_seq + 1:
+            # seq has no gaps, so the rows in between were pruned before we read them
+            self.resync()
+            return 0
+        added, removed = [], []
+        memory_sessions, context_sessions = set(), set()
+        now = now_ms()
+        for seq, origin, kind, ref, session_id, ts in rows:
+            if origin == self.origin:
+                continue
+            if kind == 'memory+':
+                added.append(ref)
+            elif kind == 'memory-':
+                removed.append(ref)
+                memory_sessions.add(session_id)
+            else:
+                context_sessions.add(session_id)
+            self.applied += 1
+            self.max_lag_ms = max(self.max_lag_ms, now - ts)
+        # Deletions first: INSERT OR REPLACE logs the old rowid's removal before the new row
+        if removed:
+            rag_memory.forget(removed)
+            response_cache.invalidate_sessions(memory_sessions, persist=False)
+        if added:
+            rag_memory.index_rows(added)
+        if context_sessions:
+            context_cache.invalidate(context_sessions)
+        self.last_seq = rows[-1][0]
+        return len(rows)
+
+    def resync(self):
+        """Rebuild everything derived from the shared tables"""
+        self.resyncs += 1
+        self.last_seq = db.query("SELECT COALESCE(MAX(seq), 0) FROM change_log")[0][0]
+        rag_memory.load_memory_index()
+        context_cache.clear()
+        response_cache.clear()
+
+    def stats(self):
+        return {
+            'origin': self.origin,
+            'last_seq': self.last_seq,
+            'polls': self.polls,
+            'applied': self.applied,
+            'resyncs': self.resyncs,
+            'max_lag_ms': self.max_lag_ms,
+        }
+
+change_feed = ChangeFeed(WORKER_ID, CHANGE_FEED_START) if WORKER_ID else None
 
 # Utility functions
 def cleanup_old_context():
-    conn = sqlite3.connect(CONTEXT_DB)
-    c = conn.cursor()
-
-    # Get all session_ids
-    c.execute("SELECT DISTINCT session_id FROM context")
-    session_ids = [row[0] for row in c.fetchall()]
-    
-    # For each session, keep only the latest 100 messages
-    for sid in session_ids:
-        c.execute("""
-            DELETE FROM context 
-            WHERE rowid NOT IN (
-                SELECT rowid FROM context 
-                WHERE session_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT 100
-            ) AND session_id = ?
-        """, (sid, sid))
-    
-    # Clean RAG memory globally
-    c.execute("""
-        DELETE FROM rag_memory 
-        WHERE rowid NOT IN (
-            SELECT rowid FROM rag_memory 
-            ORDER BY timestamp DESC 
-            LIMIT 1000
-        )
-    """)
-    
-    conn.commit()
-    conn.close()
+    """Apply the retention policies and return a per-table report"""
+    return retention.run()
 
 def start_background_tasks():
     """Start background maintenance tasks"""
@@ -1102,40 +4802,65 @@ def start_background_tasks():
         while True:
             time.sleep(3600)  # Run every hour
             try:
-                cleanup_old_context()
-                print("Performed maintenance cleanup")
+                report = cleanup_old_context()
+                deleted = sum(r['rows_deleted'] for r in report.values() if isinstance(r, dict))
+                max_lock = max(r['max_lock_ms'] for r in report.values() if isinstance(r, dict))
+                print(f"Performed maintenance cleanup: {deleted} rows removed, max lock {max_lock:.1f} ms")
             except Exception as e:
                 print(f"Maintenance error: {e}")
     
-    maintenance_thread = threading.Thread(target=maintenance_loop, daemon=True)
-    maintenance_thread.start()
+    if RUN_MAINTENANCE:
+        maintenance_thread = threading.Thread(target=maintenance_loop, daemon=True)
+        maintenance_thread.start()
+    if change_feed is not None:
+        change_feed.start()
 
 if __name__ == '__main__':
     print("🚀 Starting STONE Enhanced Server...")
     print(f"   Server will run on: http://localhost:{PORT}")
     print(f"   Ollama URL: {OLLAMA_BASE_URL}")
     print(f"   Database: {CONTEXT_DB}")
+    print(f"   Server mode: {SERVER_MODE}")
+    if WORKER_ID:
+        print(f"   Worker: {WORKER_ID} (message queue: {MESSAGE_QUEUE or 'none'}, "
+              f"maintenance: {'on' if RUN_MAINTENANCE else 'off'})")
     print("   Features: Token Streaming, Function Calling, RAG Memory, Context Storage")
     
     # Test Ollama connection
     try:
-        response = requests.get(f"{OLLAMA_BASE_URL}/api/tags", timeout=5)
-        if response.status_code == 200:
-            models = response.json().get('models', [])
-            print(f"   ✅ Ollama connected - {len(models)} models available")
-        else:
-            print(f"   ⚠️  Ollama connection issue: HTTP {response.status_code}")
+        tags = ollama.tags(timeout=5)
+        model_labels.update(tags)
+        models = tags.get('models', [])
+        print(f"   ✅ Ollama connected - {len(models)} models available")
+    except OllamaError as e:
+        print(f"   ⚠️  Ollama connection issue: HTTP {e.status}")
     except Exception as e:
         print(f"   ❌ Ollama connection failed: {e}")
         print("   Make sure Ollama is running: ollama serve")
     
     # Start background tasks
     start_background_tasks()
+    if os.name == 'posix' and sandbox_pool.size > 0:
+        sandbox_pool.start()  # Warm the python tool's workers before the first call
     
     # Run the server
     try:
-        socketio.run(app, host='0.0.0.0', port=PORT, debug=False, allow_unsafe_werkzeug=True)
+        if SERVER_MODE == 'async':
+            AsyncChatServer().run('0.0.0.0', PORT)
+        else:
+            socketio.run(app, host='0.0.0.0', port=PORT, debug=False, allow_unsafe_werkzeug=True)
     except KeyboardInterrupt:
         print("\n👋 STONE server shutting down...")
     except Exception as e:
-        print(f"❌ Server error: {e}")
\ No newline at end of file
+        print(f"❌ Server error: {e}")
+    finally:
+        if rag_memory.vectors is not None:
+            rag_memory.vectors.flush()
+        if change_feed is not None:
+            change_feed.stop()
+        write_behind.stop()
+        tool_executor.shutdown()
+        sandbox_pool.stop()
+        tracer.close()
+        ollama.close()
+        db.close_all()